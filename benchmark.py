@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the profiler and uploader offline.
+
+A local fixture site serves synthetic pages with a configurable number and
+size of resources, and a fake harstorage accepts uploads at
+/results/upload. Nothing leaves the machine, so results are comparable
+between versions of the tool.
+
+Three benchmarks are run:
+
+    har_write: time and size of writing a synthetic HAR in each har_format
+    upload: uploads per second for each uploader mode (form, stream, gzip,
+        with one and several workers)
+    profile: pages profiled per minute against the fixture site, with and
+        without the browser pool; needs browsermob proxy and a browser, so
+        it only runs with --profile
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+
+from harfiles import HAR_FORMATS, har_extension, write_har, write_json
+from harprofiler import ProfilerSession
+from haruploader import Uploader
+
+logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
+log = logging.getLogger('benchmark')
+log.setLevel(logging.INFO)
+
+UPLOAD_MODES = (
+    ('form', {}),
+    ('stream', {'stream': True}),
+    ('gzip', {'compress': True}),
+    ('form-4-workers', {'workers': 4}),
+    ('stream-4-workers', {'stream': True, 'workers': 4}),
+)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves /page/<n>: an html page that loads `resources` scripts of
+    `resource_size` bytes each from /static/<n>/<i>.js.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        site = self.server.site
+        if parts[0] == 'page' and len(parts) == 2:
+            scripts = ''.join(
+                '<script src="/static/{}/{}.js"></script>\n'.format(
+                    parts[1], i
+                )
+                for i in range(site['resources'])
+            )
+            body = '<html><head>\n{}</head><body>{}</body></html>'.format(
+                scripts, 'x' * site['page_size']
+            )
+            self._send('text/html', body)
+        elif parts[0] == 'static':
+            self._send(
+                'application/javascript',
+                '//' + 'x' * max(site['resource_size'] - 2, 0)
+            )
+        else:
+            self.send_error(404)
+
+
+class StorageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Accepts POSTs to /results/upload like harstorage, counting uploads and
+    body bytes. GET /stats returns the counts so far.
+    """
+    # keep-alive like a real server, without waiting on delayed ACKs
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            size = 0
+            while True:
+                length = int(self.rfile.readline().split(';')[0], 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return len(self.rfile.read(length))
+
+    def do_POST(self):
+        size = self._read_body()
+        if self.path != '/results/upload':
+            self.send_error(404)
+            return
+        with self.server.lock:
+            self.server.uploads += 1
+            self.server.upload_bytes += size
+        body = 'Successful'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        with self.server.lock:
+            body = json.dumps({
+                'uploads': self.server.uploads,
+                'upload_bytes': self.server.upload_bytes,
+            })
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(handler):
+    """
+    Starts a server on a free local port in a background thread.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    return server
+
+
+def start_fixture_site(resources=20, resource_size=10000, page_size=5000):
+    server = start_http_server(FixtureHandler)
+    server.site = {
+        'resources': resources,
+        'resource_size': resource_size,
+        'page_size': page_size,
+    }
+    return server
+
+
+def _serve_fake_storage(conn):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StorageHandler)
+    server.lock = threading.Lock()
+    server.uploads = 0
+    server.upload_bytes = 0
+    conn.send('http://127.0.0.1:{}'.format(server.server_address[1]))
+    conn.close()
+    server.serve_forever()
+
+
+def start_fake_storage():
+    """
+    Starts the fake harstorage in its own process, so the uploader being
+    measured doesn't share the GIL with the server. Returns the process and
+    the server's url; stop it with `process.terminate()`.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve_fake_storage, args=(child,)
+    )
+    process.daemon = True
+    process.start()
+    url = parent.recv()
+    parent.close()
+    return process, url
+
+
+def storage_stats(url):
+    """
+    Uploads and body bytes the fake harstorage at `url` has received.
+    """
+    return requests.get(url + '/stats').json()
+
+
+def synthetic_har(label, resources=20, resource_size=10000):
+    """
+    A HAR shaped like one the profiler saves for a fixture page.
+    """
+    entries = [
+        {
+            'pageref': label,
+            'startedDateTime': '2014-01-01T00:00:00.000Z',
+            'time': 20 + i,
+            'request': {
+                'method': 'GET',
+                'url': 'http://127.0.0.1/static/0/{}.js'.format(i),
+                'httpVersion': 'HTTP/1.1',
+                'headers': [], 'cookies': [], 'queryString': [],
+                'headersSize': 300, 'bodySize': 0,
+            },
+            'response': {
+                'status': 200, 'statusText': 'OK', 'httpVersion': 'HTTP/1.1',
+                'headers': [], 'cookies': [], 'redirectURL': '',
+                'headersSize': 200, 'bodySize': resource_size,
+                'content': {
+                    'size': resource_size,
+                    'mimeType': 'application/javascript',
+                },
+            },
+            'cache': {},
+            'timings': {
+                'blocked': 0, 'dns': 1, 'connect': 1, 'send': 0,
+                'wait': 15, 'receive': 3 + i, 'ssl': -1,
+            },
+        }
+        for i in range(resources)
+    ]
+    return {'log': {
+        'version': '1.2',
+        'creator': {'name': 'benchmark', 'version': '1'},
+        'pages': [{
+            'id': label,
+            'title': label,
+            'startedDateTime': '2014-01-01T00:00:00.000Z',
+            'pageTimings': {'onContentLoad': 200, 'onLoad': 500},
+        }],
+        'entries': entries,
+    }}
+
+
+def bench_har_write(work_dir, count, resources, resource_size):
+    """
+    Mean time and size of writing a synthetic HAR in each format.
+    """
+    results = {}
+    for har_format in HAR_FORMATS:
+        har = synthetic_har('bench', resources, resource_size)
+        paths = [
+            os.path.join(work_dir, 'bench-{}{}'.format(
+                i, har_extension(har_format)
+            ))
+            for i in range(count)
+        ]
+        start = time.time()
+        for path in paths:
+            write_har(har, path, har_format)
+        elapsed = time.time() - start
+        results[har_format] = {
+            'mean_seconds': elapsed / count,
+            'bytes': os.path.getsize(paths[0]),
+        }
+        for path in paths:
+            os.remove(path)
+    return results
+
+
+def bench_upload(work_dir, count, resources, resource_size):
+    """
+    Uploads per second to a fake harstorage for each uploader mode.
+    """
+    storage, url = start_fake_storage()
+    har = synthetic_har('bench', resources, resource_size)
+    results = {}
+    try:
+        for mode, options in UPLOAD_MODES:
+            har_dir = os.path.join(work_dir, 'upload-' + mode)
+            os.makedirs(har_dir)
+            for i in range(count):
+                write_har(
+                    har, os.path.join(har_dir, 'bench-{}.har'.format(i))
+                )
+            uploader = Uploader(
+                har_dir, url, options.get('workers', 1),
+                options.get('stream', False), options.get('compress', False)
+            )
+            before = storage_stats(url)
+            start = time.time()
+            uploader.upload_hars()
+            elapsed = time.time() - start
+            after = storage_stats(url)
+            uploads = after['uploads'] - before['uploads']
+            results[mode] = {
+                'uploads': uploads,
+                'uploads_per_second': uploads / elapsed,
+                'bytes_sent': after['upload_bytes'] - before['upload_bytes'],
+            }
+            shutil.rmtree(har_dir)
+    finally:
+        storage.terminate()
+        storage.join()
+    return results
+
+
+def bench_profile(config_file, work_dir, pages, resources, resource_size):
+    """
+    Pages profiled per minute against the fixture site, with a new browser
+    for every page and with the browser pool.
+    """
+    site = start_fixture_site(resources, resource_size)
+    results = {}
+    try:
+        config = yaml.load(file(config_file))
+        for mode, pool in (('session', False), ('pool', True)):
+            har_dir = os.path.join(work_dir, 'profile-' + mode)
+            # only the fixture site is profiled, and nothing is uploaded
+            config = dict(config, har_dir=har_dir, browser_pool=pool,
+                          catalog=None, blob_dir=None, harstorage_url=None,
+                          upload_spool=False, url_sources=None, journeys=None,
+                          profiles=None, login_user=None)
+            urls = [
+                '{}/page/{}'.format(site.url, i) for i in range(pages)
+            ]
+            start = time.time()
+            with ProfilerSession(config) as session:
+                for url in urls:
+                    session.profile(url)
+            elapsed = time.time() - start
+            results[mode] = {
+                'pages': session.pages,
+                'pages_per_minute': session.pages * 60.0 / elapsed,
+                'startup_seconds': session.startup_time,
+            }
+            shutil.rmtree(har_dir, ignore_errors=True)
+    finally:
+        site.shutdown()
+        site.server_close()
+    return results
+
+
+def version():
+    """
+    The git commit being benchmarked, if there is one.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='harbench-')
+    results = {
+        'version': version(),
+        'python': platform.python_version(),
+        'started': time.time(),
+        'settings': {
+            'count': args.count,
+            'resources': args.resources,
+            'resource_size': args.resource_size,
+        },
+    }
+    try:
+        log.info('benchmarking HAR writes')
+        results['har_write'] = bench_har_write(
+            work_dir, args.count, args.resources, args.resource_size
+        )
+        log.info('benchmarking uploads')
+        results['upload'] = bench_upload(
+            work_dir, args.count, args.resources, args.resource_size
+        )
+        if args.profile:
+            log.info('benchmarking the profiler')
+            results['profile'] = bench_profile(
+                args.config, work_dir, args.pages, args.resources,
+                args.resource_size
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print('version {version}, python {python}'.format(**results))
+    print('\nHAR write:')
+    for har_format, r in sorted(results['har_write'].items()):
+        print('    {:<10} {:>8.2f} ms {:>10} bytes'.format(
+            har_format, r['mean_seconds'] * 1000, r['bytes']
+        ))
+    print('\nupload:')
+    for mode, r in sorted(results['upload'].items()):
+        print('    {:<18} {:>8.1f} uploads/s {:>12} bytes sent'.format(
+            mode, r['uploads_per_second'], r['bytes_sent']
+        ))
+    if 'profile' in results:
+        print('\nprofile:')
+        for mode, r in sorted(results['profile'].items()):
+            print('    {:<10} {:>8.1f} pages/min'.format(
+                mode, r['pages_per_minute']
+            ))
+
+
+def main():
+    """
+    Runs as standalone script.
+
+    Options:
+        -o, --output = Path to save the results to as JSON
+        --count = Number of HARs to write and upload per mode (default: 50)
+        --resources = Resources per synthetic page (default: 20)
+        --resource-size = Bytes per resource (default: 10000)
+        --profile = Also benchmark the profiler; needs browsermob proxy and
+                    a browser
+        --pages = Pages to profile per profiler mode (default: 10)
+        -c, --config = harprofiler config file for --profile
+                       (default: config.yaml)
+
+    Example:
+        python benchmark.py --resources 50 -o bench-$(git rev-parse HEAD).json
+    """
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument(
+        '-o', '--output',
+        help="Path to save the results to as JSON"
+    )
+    parser.add_argument(
+        '--count',
+        default=50,
+        type=int,
+        help="Number of HARs to write and upload per mode (default: 50)"
+    )
+    parser.add_argument(
+        '--resources',
+        default=20,
+        type=int,
+        help="Resources per synthetic page (default: 20)"
+    )
+    parser.add_argument(
+        '--resource-size',
+        default=10000,
+        type=int,
+        help="Bytes per resource (default: 10000)"
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help="Also benchmark the profiler; needs browsermob proxy and a "
+             "browser"
+    )
+    parser.add_argument(
+        '--pages',
+        default=10,
+        type=int,
+        help="Pages to profile per profiler mode (default: 10)"
+    )
+    parser.add_argument(
+        '-c', '--config',
+        default='config.yaml',
+        help="harprofiler config file for --profile (default: config.yaml)"
+    )
+    args = parser.parse_args()
+
+    # the tools log every file; only the results matter here
+    for name in ('haruploader', 'harprofiler'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    results = run(args)
+    print_results(results)
+    if args.output:
+        write_json(results, args.output)
+        log.info('saved results to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
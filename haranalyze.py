@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+Analyze a local archive of HAR files.
+
+HAR files are parsed in batches by a pool of processes and flattened into
+one row per request, held as NumPy columns. Aggregates are then computed
+over the whole archive at once instead of file by file.
+"""
+
+import argparse
+import json
+import logging
+from multiprocessing import Pool
+import urlparse
+
+import numpy as np
+
+from harfiles import find_har_files, load_har
+from harstats import entry_bytes
+
+logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
+log = logging.getLogger('haranalyze')
+log.setLevel(logging.INFO)
+
+PHASES = ('dns', 'connect', 'ssl', 'send', 'wait', 'receive')
+NUMERIC_COLUMNS = PHASES + ('time', 'bytes')
+TEXT_COLUMNS = ('label', 'host', 'mime', 'url')
+BATCH_SIZE = 200
+
+
+def _timing(timings, phase):
+    # -1 means the phase didn't apply, e.g. no ssl or a reused connection
+    return max(timings.get(phase, -1) or 0, 0)
+
+
+def parse_batch(paths):
+    """
+    Parses a batch of HAR files into column lists with one row per
+    request. Files that can't be parsed are logged and skipped.
+    """
+    columns = dict((name, []) for name in NUMERIC_COLUMNS + TEXT_COLUMNS)
+    for path in paths:
+        try:
+            har = load_har(path)
+            pages = har['log']['pages']
+            default_label = pages[0]['id'] if pages else ''
+            entries = har['log']['entries']
+        except Exception as e:
+            log.warning('skipping {}: {}'.format(path, e))
+            continue
+
+        for entry in entries:
+            timings = entry.get('timings', {})
+            for phase in PHASES:
+                columns[phase].append(_timing(timings, phase))
+            columns['time'].append(max(entry.get('time') or 0, 0))
+            columns['bytes'].append(entry_bytes(entry))
+
+            url = entry['request']['url']
+            mime = entry['response'].get('content', {}).get('mimeType', '')
+            columns['label'].append(entry.get('pageref') or default_label)
+            columns['host'].append(urlparse.urlsplit(url).netloc)
+            columns['mime'].append(mime.split(';')[0].strip().lower())
+            columns['url'].append(url)
+
+    for name in NUMERIC_COLUMNS:
+        columns[name] = np.array(columns[name], dtype=np.float64)
+    return columns
+
+
+class HarTable:
+    """
+    Requests from many HAR files, one row per request, stored as columns.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    @classmethod
+    def load(cls, paths, processes=None, batch_size=BATCH_SIZE):
+        """
+        Loads every HAR file found at the given paths.
+        """
+        files = [f for path in paths for f in find_har_files(path)]
+        batches = [
+            files[i:i + batch_size] for i in range(0, len(files), batch_size)
+        ]
+        log.info('parsing {} HAR files in {} batches'.format(
+            len(files), len(batches)
+        ))
+
+        if len(batches) > 1 and processes != 1:
+            pool = Pool(processes)
+            try:
+                parsed = pool.map(parse_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parsed = [parse_batch(batch) for batch in batches]
+
+        columns = {}
+        for name in NUMERIC_COLUMNS:
+            columns[name] = np.concatenate(
+                [batch[name] for batch in parsed] or [np.zeros(0)]
+            )
+        for name in TEXT_COLUMNS:
+            columns[name] = np.array(
+                [value for batch in parsed for value in batch[name]],
+                dtype=object
+            )
+        return cls(columns)
+
+    def _groups(self, by):
+        keys, index = np.unique(
+            self.columns[by].astype(unicode), return_inverse=True
+        )
+        return keys, index
+
+    def phase_breakdown(self, by='label'):
+        """
+        Request count and mean time spent in each timing phase, per label
+        or per host.
+        """
+        keys, index = self._groups(by)
+        counts = np.bincount(index, minlength=len(keys))
+        result = {}
+        for name in PHASES + ('time',):
+            sums = np.bincount(
+                index, weights=self.columns[name], minlength=len(keys)
+            )
+            result[name] = sums / np.maximum(counts, 1)
+        return [
+            dict(
+                [(by, key), ('requests', int(counts[i]))] +
+                [(name, float(result[name][i])) for name in result]
+            )
+            for i, key in enumerate(keys)
+        ]
+
+    def bytes_by_mime(self, by='label'):
+        """
+        Total bytes per MIME type, per label or per host.
+        """
+        keys, index = self._groups(by)
+        mimes, mime_index = self._groups('mime')
+        totals = np.zeros((len(keys), len(mimes)))
+        np.add.at(totals, (index, mime_index), self.columns['bytes'])
+        return dict(
+            (key, dict(
+                (mimes[j] or 'unknown', int(totals[i, j]))
+                for j in np.nonzero(totals[i])[0]
+            ))
+            for i, key in enumerate(keys)
+        )
+
+    def slowest(self, count=10):
+        """
+        The `count` slowest requests over the whole archive.
+        """
+        order = np.argsort(-self.columns['time'], kind='mergesort')[:count]
+        return [
+            {
+                'label': self.columns['label'][i],
+                'url': self.columns['url'][i],
+                'time': float(self.columns['time'][i]),
+                'bytes': int(self.columns['bytes'][i]),
+            }
+            for i in order
+        ]
+
+    def report(self, by='label', top=10):
+        return {
+            'requests': len(self),
+            'phases': self.phase_breakdown(by),
+            'bytes_by_mime': self.bytes_by_mime(by),
+            'slowest': self.slowest(top),
+        }
+
+
+def print_report(report, by):
+    print('{} requests'.format(report['requests']))
+
+    print('\nmean timings (ms) by {}:'.format(by))
+    header = ['requests'] + list(PHASES) + ['time']
+    print('{:<50} '.format(by) + ' '.join(
+        '{:>9}'.format(name) for name in header
+    ))
+    for row in report['phases']:
+        print(u'{:<50} '.format(row[by][:50]) + ' '.join(
+            '{:>9.1f}'.format(row[name]) for name in header
+        ))
+
+    print('\nbytes by MIME type:')
+    for key in sorted(report['bytes_by_mime']):
+        print(key)
+        mimes = report['bytes_by_mime'][key]
+        for mime in sorted(mimes, key=mimes.get, reverse=True):
+            print('    {:<40} {:>12}'.format(mime, mimes[mime]))
+
+    print('\nslowest requests:')
+    for row in report['slowest']:
+        print('{time:>9.1f} ms {bytes:>10} B  {url}'.format(**row))
+
+
+def main():
+    """
+    Runs as standalone script, explicitly passed paths to HAR files.
+
+    Args:
+        Paths to HAR files or directories containing HAR files.
+
+    Options:
+        --by = Group by 'label' or 'host' (default: label)
+        --top = Number of slowest requests to list (default: 10)
+        --processes = Number of parsing processes (default: one per CPU)
+        --json = Print the report as JSON
+
+    Example:
+        python haranalyze.py ./hars --by host --top 20
+    """
+    parser = argparse.ArgumentParser(prog='haranalyze.py')
+    parser.add_argument(
+        'harpaths',
+        nargs='+',
+        help="Paths to HAR files or directories containing HAR files"
+    )
+    parser.add_argument(
+        '--by',
+        choices=['label', 'host'],
+        default='label',
+        help="Group by 'label' or 'host' (default: label)"
+    )
+    parser.add_argument(
+        '--top',
+        default=10,
+        type=int,
+        help="Number of slowest requests to list (default: 10)"
+    )
+    parser.add_argument(
+        '--processes',
+        default=None,
+        type=int,
+        help="Number of parsing processes (default: one per CPU)"
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help="Print the report as JSON"
+    )
+    args = parser.parse_args()
+
+    table = HarTable.load(args.harpaths, args.processes)
+    report = table.report(args.by, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args.by)
+
+
+if __name__ == "__main__":
+    main()
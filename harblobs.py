@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed storage for the response bodies captured in HARs.
+
+With body capture on, every HAR carries its own copy of the same scripts and
+stylesheets, across urls and across each cold/warm pair. A BlobStore keeps
+one gzipped copy of each body, named by its SHA-256, and the HAR keeps only
+a reference to it in the response content's `_blob` field. rehydrate() puts
+the bodies back for tools that expect a standard HAR, such as harstorage.
+"""
+
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+
+from harfiles import find_har_files, load_har, write_har
+
+logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
+log = logging.getLogger('harblobs')
+log.setLevel(logging.INFO)
+
+# bodies smaller than this stay in the HAR; a reference would save little
+DEFAULT_MIN_SIZE = 512
+
+BLOB_PREFIX = 'sha256:'
+
+
+class BlobStore:
+    """
+    A directory of gzipped response bodies, stored as
+    `<blob_dir>/<first two hex digits>/<sha256>.gz`.
+    """
+
+    def __init__(self, blob_dir, min_size=DEFAULT_MIN_SIZE):
+        self.blob_dir = blob_dir
+        self.min_size = min_size
+
+    def _path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest + '.gz')
+
+    def put(self, text):
+        """
+        Stores a body, unless the store already has it. Returns its
+        reference.
+        """
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.isfile(path):
+            blob_dir = os.path.dirname(path)
+            if not os.path.isdir(blob_dir):
+                try:
+                    os.makedirs(blob_dir)
+                except OSError:
+                    # another worker made it first
+                    if not os.path.isdir(blob_dir):
+                        raise
+            fd, tmp_path = tempfile.mkstemp(
+                dir=blob_dir, prefix='.', suffix='.tmp'
+            )
+            try:
+                with os.fdopen(fd, 'wb') as raw:
+                    f = gzip.GzipFile(fileobj=raw, mode='wb')
+                    f.write(data)
+                    f.close()
+                os.chmod(tmp_path, 0o644)
+                os.rename(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        return BLOB_PREFIX + digest
+
+    def get(self, ref):
+        """
+        Returns the body a reference points to.
+        """
+        if not ref.startswith(BLOB_PREFIX):
+            raise ValueError('unknown blob reference: {}'.format(ref))
+        with gzip.open(self._path(ref[len(BLOB_PREFIX):]), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def dehydrate(self, har):
+        """
+        Moves the response bodies of a HAR into the store, replacing each
+        with a reference. Returns the number of characters taken out of the
+        HAR.
+        """
+        saved = 0
+        for entry in har['log']['entries']:
+            content = entry['response'].get('content', {})
+            text = content.get('text')
+            if text is None or len(text) < self.min_size:
+                continue
+            content['_blob'] = self.put(text)
+            del content['text']
+            saved += len(text)
+        return saved
+
+    def rehydrate(self, har):
+        """
+        Puts the bodies referenced by a HAR back in place, making it a
+        standard HAR again. Returns the number of bodies restored.
+        """
+        restored = 0
+        for entry in har['log']['entries']:
+            content = entry['response'].get('content', {})
+            ref = content.pop('_blob', None)
+            if ref is not None:
+                content['text'] = self.get(ref)
+                restored += 1
+        return restored
+
+
+def main():
+    """
+    Runs as standalone script, explicitly passed paths to HAR files.
+
+    Writes standard HAR files with the bodies from the blob store put back.
+
+    Args:
+        Paths to HAR files or directories containing HAR files.
+
+    Options:
+        --blob-dir = Path to the blob store
+        -o, --output = Directory to write the rehydrated HARs to
+
+    Example:
+        python harblobs.py ./hars --blob-dir ./hars/blobs -o ./rehydrated
+    """
+    parser = argparse.ArgumentParser(prog='harblobs.py')
+    parser.add_argument(
+        'harpaths',
+        nargs='+',
+        help="Paths to HAR files or directories containing HAR files"
+    )
+    parser.add_argument(
+        '--blob-dir',
+        required=True,
+        help="Path to the blob store"
+    )
+    parser.add_argument(
+        '-o', '--output',
+        required=True,
+        help="Directory to write the rehydrated HARs to"
+    )
+    args = parser.parse_args()
+
+    store = BlobStore(args.blob_dir)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for path in args.harpaths:
+        for har_path in find_har_files(path):
+            har = load_har(har_path)
+            store.rehydrate(har)
+            name = os.path.basename(har_path)
+            if name.endswith('.gz'):
+                name = name[:-len('.gz')]
+            write_har(har, os.path.join(args.output, name))
+            log.info('rehydrated {}'.format(har_path))
+
+
+if __name__ == "__main__":
+    main()
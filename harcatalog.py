@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""
+A local SQLite index of captured HAR files.
+
+The profiler adds each HAR it saves and the uploader records where each
+file ended up, so finding e.g. every HAR for a label in the last week is a
+single indexed query instead of a directory walk that parses every file.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from harfiles import find_har_files, load_har
+from harstats import har_metrics
+
+logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
+log = logging.getLogger('harcatalog')
+log.setLevel(logging.INFO)
+
+# <label>-<epoch>[-w<worker>][-s<sample>][-<anything else>].har[.gz]
+HAR_NAME_PATTERN = re.compile(
+    r'^(?P<label>.+?)-(?P<epoch>\d+(?:\.\d+)?)(?:-[a-z]\w*)*\.har(?:\.gz)?$'
+)
+
+UPLOAD_DIRS = {
+    'completed_uploads': 'success',
+    'failed_uploads': 'failed',
+}
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hars (
+        name TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        label TEXT,
+        url TEXT,
+        epoch REAL,
+        cached INTEGER,
+        on_content_load REAL,
+        on_load REAL,
+        entries INTEGER,
+        total_bytes INTEGER,
+        mtime REAL,
+        size INTEGER,
+        upload_status TEXT
+    );
+    CREATE INDEX IF NOT EXISTS hars_label_epoch ON hars (label, epoch);
+    CREATE INDEX IF NOT EXISTS hars_epoch ON hars (epoch);
+"""
+
+COLUMNS = (
+    'name', 'path', 'label', 'url', 'epoch', 'cached', 'on_content_load',
+    'on_load', 'entries', 'total_bytes', 'mtime', 'size', 'upload_status',
+)
+
+
+def parse_har_name(name):
+    """
+    Returns the (label, epoch) encoded in a HAR file name by the profiler,
+    or (None, None) for names it didn't generate.
+    """
+    match = HAR_NAME_PATTERN.match(name)
+    if match is None:
+        return None, None
+    return match.group('label'), float(match.group('epoch'))
+
+
+def upload_status_for(path):
+    """
+    Infers the upload status of a HAR from the folder the uploader left it
+    in.
+    """
+    parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return UPLOAD_DIRS.get(parent, 'pending')
+
+
+class Catalog:
+    """
+    SQLite index of HAR files, keyed by file name so that rows follow the
+    files as the uploader moves them around.
+
+    A Catalog can be shared between threads.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            db_path, timeout=30, check_same_thread=False
+        )
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _upsert(self, row):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO hars ({}) VALUES ({})'.format(
+                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))
+            ),
+            [row.get(column) for column in COLUMNS]
+        )
+
+    def _row_for(self, path, har, url=None, status=None):
+        name = os.path.basename(path)
+        name_label, epoch = parse_har_name(name)
+        pages = har['log']['pages']
+        entries = har['log']['entries']
+        label = pages[0]['id'] if pages else name_label
+        metrics = har_metrics(har)
+        stat = os.stat(path)
+        if url is None and entries:
+            url = entries[0]['request']['url']
+        return {
+            'name': name,
+            'path': os.path.abspath(path),
+            'label': label,
+            'url': url,
+            'epoch': epoch if epoch is not None else stat.st_mtime,
+            'cached': int(bool(label) and label.endswith('-cached')),
+            'on_content_load': metrics['onContentLoad'],
+            'on_load': metrics['onLoad'],
+            'entries': metrics['requests'],
+            'total_bytes': metrics['bytes'],
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'upload_status': status or upload_status_for(path),
+        }
+
+    def record(self, path, har=None, url=None, status=None):
+        """
+        Adds or refreshes the row for the HAR at `path`. Pass the parsed
+        `har` if you have it to avoid reading the file again.
+        """
+        if har is None:
+            har = load_har(path)
+        row = self._row_for(path, har, url, status)
+        with self.lock:
+            with self.conn:
+                self._upsert(row)
+
+    def set_upload_status(self, path, status, new_path=None):
+        """
+        Records the upload status of a HAR, and its new path if the
+        uploader moved it.
+        """
+        name = os.path.basename(path)
+        with self.lock:
+            with self.conn:
+                if new_path is None:
+                    self.conn.execute(
+                        'UPDATE hars SET upload_status = ? WHERE name = ?',
+                        (status, name)
+                    )
+                else:
+                    self.conn.execute(
+                        'UPDATE hars SET upload_status = ?, path = ? '
+                        'WHERE name = ?',
+                        (status, os.path.abspath(new_path), name)
+                    )
+
+    def rebuild(self, paths):
+        """
+        Indexes every HAR file found at `paths`, skipping files whose path,
+        mtime and size already match the index. Returns the number of files
+        indexed and skipped.
+        """
+        indexed = skipped = 0
+        for path in paths:
+            for har_path in find_har_files(path):
+                stat = os.stat(har_path)
+                with self.lock:
+                    known = self.conn.execute(
+                        'SELECT path, mtime, size FROM hars WHERE name = ?',
+                        (os.path.basename(har_path),)
+                    ).fetchone()
+                if (known is not None and
+                        known['path'] == os.path.abspath(har_path) and
+                        known['mtime'] == stat.st_mtime and
+                        known['size'] == stat.st_size):
+                    skipped += 1
+                    continue
+                try:
+                    self.record(har_path)
+                except Exception as e:
+                    log.warning('skipping {}: {}'.format(har_path, e))
+                    continue
+                indexed += 1
+        log.info('indexed {} HAR files, {} already up to date'.format(
+            indexed, skipped
+        ))
+        return indexed, skipped
+
+    def query(self, label=None, since=None, until=None, cached=None,
+              status=None):
+        """
+        Returns the catalog rows matching every given filter, oldest first.
+        `since` and `until` are epoch seconds.
+        """
+        clauses, params = [], []
+        for clause, value in [
+            ('label = ?', label),
+            ('epoch >= ?', since),
+            ('epoch < ?', until),
+            ('cached = ?', None if cached is None else int(cached)),
+            ('upload_status = ?', status),
+        ]:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        sql = 'SELECT * FROM hars'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY epoch'
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params)]
+
+
+def parse_since(value):
+    """
+    Parses an epoch timestamp, or a time relative to now such as '30m',
+    '12h' or '7d'.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value[-1:] in units:
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def main():
+    """
+    Runs as standalone script.
+
+    Commands:
+        rebuild PATH [PATH ...] = Index the HAR files at the given paths
+        query = List indexed HARs
+
+    Options:
+        --db = Path to the catalog database (default: ./hars/catalog.sqlite)
+
+    Query options:
+        --label = Only HARs with this label
+        --since = Only HARs captured since an epoch or e.g. 12h, 7d
+        --status = Only HARs with this upload status
+                   (pending, retry, success or failed)
+        --json = Print the rows as JSON
+
+    Example:
+        python harcatalog.py rebuild ./hars
+        python harcatalog.py query --label my-label --since 7d
+    """
+    parser = argparse.ArgumentParser(prog='harcatalog.py')
+    parser.add_argument(
+        '--db',
+        default='./hars/catalog.sqlite',
+        help="Path to the catalog database (default: ./hars/catalog.sqlite)"
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild', help="Index the HAR files at the given paths"
+    )
+    rebuild_parser.add_argument(
+        'harpaths',
+        nargs='+',
+        help="Paths to HAR files or directories containing HAR files"
+    )
+
+    query_parser = subparsers.add_parser('query', help="List indexed HARs")
+    query_parser.add_argument('--label', help="Only HARs with this label")
+    query_parser.add_argument(
+        '--since',
+        help="Only HARs captured since an epoch or e.g. 12h, 7d"
+    )
+    query_parser.add_argument(
+        '--status',
+        choices=['pending', 'retry', 'success', 'failed'],
+        help="Only HARs with this upload status"
+    )
+    query_parser.add_argument(
+        '--json',
+        action='store_true',
+        help="Print the rows as JSON"
+    )
+    args = parser.parse_args()
+
+    catalog = Catalog(args.db)
+    try:
+        if args.command == 'rebuild':
+            catalog.rebuild(args.harpaths)
+        else:
+            since = parse_since(args.since) if args.since else None
+            rows = catalog.query(args.label, since, status=args.status)
+            if args.json:
+                print(json.dumps(rows, indent=2))
+            else:
+                for row in rows:
+                    print(
+                        u'{epoch:.0f} {label} onLoad={on_load} '
+                        u'entries={entries} bytes={total_bytes} '
+                        u'[{upload_status}] {path}'.format(**row)
+                    )
+    finally:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+Compare a run's HAR files against a stored baseline and fail on
+regressions.
+
+HARs are grouped by label (the page id the profiler gives each HAR, so
+cached loads are compared with cached loads). For every label, the median
+of each metric is compared with the baseline median. A metric regresses
+when the increase is over its budget and, where both sides have enough
+samples, a Mann-Whitney U test says the increase is unlikely to be noise.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import yaml
+
+from harcatalog import parse_har_name, parse_since
+from harfiles import find_har_files, load_har, write_json
+from harstats import METRICS, har_metrics, mann_whitney_u, percentile
+
+logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
+log = logging.getLogger('harcompare')
+log.setLevel(logging.INFO)
+
+# A metric regresses when its median grows by more than `absolute` *and*
+# by more than `relative` times the baseline median.
+DEFAULT_BUDGETS = {
+    'onContentLoad': {'absolute': 100, 'relative': 0.10},
+    'onLoad': {'absolute': 200, 'relative': 0.10},
+    'requests': {'absolute': 2, 'relative': 0.05},
+    'bytes': {'absolute': 20000, 'relative': 0.05},
+}
+DEFAULT_ALPHA = 0.05
+
+# fewer samples than this on either side can't show significance, so the
+# budget alone decides
+MIN_SAMPLES = 3
+
+
+def collect(paths, since=None):
+    """
+    Returns {label: {metric: [values]}} for the HAR files at `paths`,
+    optionally only those captured since an epoch.
+    """
+    groups = {}
+    for path in paths:
+        for har_path in find_har_files(path):
+            if since is not None:
+                epoch = parse_har_name(os.path.basename(har_path))[1]
+                if epoch is None or epoch < since:
+                    continue
+            try:
+                har = load_har(har_path)
+                label = har['log']['pages'][0]['id']
+                metrics = har_metrics(har)
+            except Exception as e:
+                log.warning('skipping {}: {}'.format(har_path, e))
+                continue
+            group = groups.setdefault(
+                label, dict((metric, []) for metric in METRICS)
+            )
+            for metric in METRICS:
+                if metrics[metric] is not None:
+                    group[metric].append(metrics[metric])
+    return groups
+
+
+def save_baseline(groups, path):
+    write_json({'labels': groups}, path)
+
+
+def load_baseline(path):
+    """
+    Loads a baseline saved by save_baseline(), or collects one from a
+    directory of HAR files.
+    """
+    if os.path.isdir(path):
+        return collect([path])
+    with open(path) as f:
+        return json.load(f)['labels']
+
+
+def compare_metric(baseline, current, budget, alpha=DEFAULT_ALPHA):
+    """
+    Compares one metric's samples. Returns a result dict whose `status` is
+    'regression', 'improvement' or 'ok'.
+    """
+    base = percentile(baseline, 50)
+    cur = percentile(current, 50)
+    delta = cur - base
+    relative = delta / float(base) if base else None
+
+    over_budget = (
+        delta > budget.get('absolute', 0) and
+        (relative is None or relative > budget.get('relative', 0))
+    )
+    p_value = None
+    if len(baseline) >= MIN_SAMPLES and len(current) >= MIN_SAMPLES:
+        p_value = mann_whitney_u(baseline, current)
+
+    if over_budget and (p_value is None or p_value < alpha):
+        status = 'regression'
+    elif delta < 0 and -delta > budget.get('absolute', 0):
+        status = 'improvement'
+    else:
+        status = 'ok'
+    return {
+        'baseline': base,
+        'current': cur,
+        'delta': delta,
+        'relative': relative,
+        'p_value': p_value,
+        'status': status,
+    }
+
+
+def compare(baseline, current, budgets=None, alpha=DEFAULT_ALPHA):
+    """
+    Compares every label of the current run with the baseline. Returns a
+    list of per label and metric result dicts. Labels without a baseline
+    are reported with status 'new'.
+    """
+    budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+    results = []
+    for label in sorted(current):
+        for metric in METRICS:
+            if metric not in budgets:
+                continue
+            values = current[label][metric]
+            base_values = baseline.get(label, {}).get(metric)
+            if not values:
+                continue
+            if not base_values:
+                result = {'current': percentile(values, 50), 'status': 'new'}
+            else:
+                result = compare_metric(
+                    base_values, values, budgets[metric], alpha
+                )
+            result.update({'label': label, 'metric': metric})
+            results.append(result)
+    return results
+
+
+def print_results(results):
+    for r in results:
+        if r['status'] == 'new':
+            print(u'{:<12} {} {}: {} (no baseline)'.format(
+                'NEW', r['label'], r['metric'], r['current']
+            ))
+            continue
+        print(
+            u'{:<12} {} {}: {:g} -> {:g} ({:+g}{}){}'.format(
+                r['status'].upper(), r['label'], r['metric'],
+                r['baseline'], r['current'], r['delta'],
+                '' if r['relative'] is None
+                else ', {:+.1%}'.format(r['relative']),
+                '' if r['p_value'] is None
+                else ' p={:.3f}'.format(r['p_value'])
+            )
+        )
+
+
+def main():
+    """
+    Runs as standalone script.
+
+    Commands:
+        baseline PATH [PATH ...] -o FILE = Save the HARs at the given paths
+                                           as a baseline
+        compare PATH [PATH ...] --baseline FILE = Compare the HARs at the
+                                                  given paths with a
+                                                  baseline file or directory
+
+    Options:
+        --since = Only use HARs captured since an epoch or e.g. 12h, 7d
+        -c, --config = harprofiler config file to read `budgets` and
+                       `regression_alpha` from
+
+    Exits with status 1 if compare finds a regression.
+
+    Example:
+        python harcompare.py baseline ./hars -o baseline.json
+        python harcompare.py compare ./hars --since 2h --baseline baseline.json
+    """
+    parser = argparse.ArgumentParser(prog='harcompare.py')
+    subparsers = parser.add_subparsers(dest='command')
+
+    baseline_parser = subparsers.add_parser(
+        'baseline', help="Save the HARs at the given paths as a baseline"
+    )
+    baseline_parser.add_argument('-o', '--output', required=True)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help="Compare the HARs at the given paths with a baseline"
+    )
+    compare_parser.add_argument(
+        '--baseline',
+        required=True,
+        help="Baseline file, or a directory of baseline HAR files"
+    )
+    compare_parser.add_argument(
+        '-c', '--config',
+        help="harprofiler config file to read `budgets` and "
+             "`regression_alpha` from"
+    )
+    compare_parser.add_argument(
+        '--json',
+        action='store_true',
+        help="Print the results as JSON"
+    )
+
+    for subparser in [baseline_parser, compare_parser]:
+        subparser.add_argument(
+            'harpaths',
+            nargs='+',
+            help="Paths to HAR files or directories containing HAR files"
+        )
+        subparser.add_argument(
+            '--since',
+            help="Only use HARs captured since an epoch or e.g. 12h, 7d"
+        )
+    args = parser.parse_args()
+
+    since = parse_since(args.since) if args.since else None
+    current = collect(args.harpaths, since)
+
+    if args.command == 'baseline':
+        save_baseline(current, args.output)
+        log.info('saved a baseline of {} labels to {}'.format(
+            len(current), args.output
+        ))
+        return
+
+    config = yaml.load(file(args.config)) if args.config else {}
+    results = compare(
+        load_baseline(args.baseline),
+        current,
+        config.get('budgets'),
+        config.get('regression_alpha', DEFAULT_ALPHA)
+    )
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+    regressions = [r for r in results if r['status'] == 'regression']
+    if regressions:
+        log.error('{} metrics over budget'.format(len(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
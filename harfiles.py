@@ -0,0 +1,336 @@
+"""
+Read and write HAR files on disk.
+
+HARs are saved either as JSON (`.har`) or gzip-compressed JSON (`.har.gz`).
+Writes go to a hidden temp file in the destination directory that is then
+renamed into place, so anything scanning the directory for HARs never sees
+a partially written file.
+"""
+
+import codecs
+from contextlib import contextmanager
+import gzip
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+
+HAR_FORMATS = ('pretty', 'compact', 'gzip')
+
+CHUNK_SIZE = 64 * 1024
+
+# deflate can't compress better than about 1032:1, so a gzip file smaller
+# than this can't hold 4 GiB or more
+GZIP_ISIZE_SAFE = 2 ** 32 // 1032
+
+
+def is_har_file(name):
+    return name.endswith('.har') or name.endswith('.har.gz')
+
+
+def har_extension(har_format):
+    if har_format == 'gzip':
+        return '.har.gz'
+    return '.har'
+
+
+def find_har_files(path):
+    """
+    Yields `path` if it is a HAR file, or every HAR file below it if it is
+    a directory (including completed_uploads/ and failed_uploads/).
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if is_har_file(name):
+                yield os.path.join(dirpath, name)
+
+
+def open_har(path):
+    """
+    Opens a HAR file for reading, decompressing it if needed.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def har_size(path):
+    """
+    Size in bytes of a HAR's JSON, without reading a plain HAR or
+    decompressing a gzipped one when its gzip trailer can tell.
+
+    The trailer holds the uncompressed size mod 2**32 (of the last member,
+    and the HARs written here have only one), so only a gzipped HAR big
+    enough to hold 4 GiB or more is decompressed to count its size.
+    """
+    if not path.endswith('.gz'):
+        return os.path.getsize(path)
+    if os.path.getsize(path) < GZIP_ISIZE_SAFE:
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+    size = 0
+    with open_har(path) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            size += len(chunk)
+    return size
+
+
+def har_digest(path, chunk_size=64 * 1024):
+    """
+    SHA-256 hex digest of a HAR's JSON, read in chunks. Gzipped files are
+    hashed decompressed, so a HAR hashes the same whichever way it's saved
+    (as long as its JSON is the same).
+    """
+    digest = hashlib.sha256()
+    with open_har(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_har(path):
+    with open_har(path) as f:
+        return json.load(f)
+
+
+def load_json(path):
+    """
+    Reads a JSON document written by `write_json`.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(data, path, mode=0o644):
+    """
+    Atomically writes any JSON document, such as a run summary, to `path`.
+    """
+    write_har(data, path, 'pretty', mode)
+
+
+@contextmanager
+def _atomic_har_file(path, har_format, mode):
+    """
+    Opens a temp file next to `path` for writing a HAR in the given format,
+    and renames it into place once the block has finished without error.
+    """
+    if har_format not in HAR_FORMATS:
+        raise ValueError('unknown HAR format: {}'.format(har_format))
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            if har_format == 'gzip':
+                f = gzip.GzipFile(fileobj=raw, mode='wb')
+            else:
+                f = raw
+            yield f
+            if f is not raw:
+                f.close()
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def write_har(har, path, har_format='pretty', mode=0o644):
+    """
+    Atomically writes a HAR dict to `path` in the given format.
+    """
+    with _atomic_har_file(path, har_format, mode) as f:
+        writer = codecs.getwriter('utf-8')(f)
+        if har_format == 'pretty':
+            json.dump(har, writer, indent=2, ensure_ascii=False)
+        else:
+            json.dump(har, writer, separators=(',', ':'), ensure_ascii=False)
+
+
+def entry_outline(entry):
+    """
+    The parts of a HAR entry that har_metrics() and the catalog use.
+    """
+    response = entry.get('response', {})
+    return {
+        'request': {'url': entry.get('request', {}).get('url')},
+        'response': dict(
+            (key, response[key]) for key in ('headersSize', 'bodySize')
+            if key in response
+        ),
+    }
+
+
+class HarStream:
+    """
+    Copies a HAR document that arrives in chunks of JSON to a file as it is
+    read, decoding one value at a time so that the whole document is never
+    in memory.
+    """
+
+    def __init__(self, chunks, out):
+        self.chunks = iter(chunks)
+        self.out = out
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+
+    def _read(self, size):
+        """
+        Reads at least `size` more bytes, unless the document ends first.
+        Returns False if there was nothing left to read.
+        """
+        parts = [self.buffer]
+        added = 0
+        for chunk in self.chunks:
+            parts.append(chunk)
+            added += len(chunk)
+            if added >= size:
+                break
+        self.buffer = ''.join(parts)
+        return added > 0
+
+    def _flush(self):
+        """
+        Writes out everything read up to the current position.
+        """
+        self.out.write(self.buffer[:self.pos])
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+
+    def _peek(self):
+        while True:
+            while (self.pos < len(self.buffer) and
+                    self.buffer[self.pos] in ' \t\r\n'):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read(1):
+                raise ValueError('HAR ends unexpectedly')
+
+    def _next(self, *expected):
+        char = self._peek()
+        if char not in expected:
+            raise ValueError('expected {} in HAR, found {!r}'.format(
+                ' or '.join(expected), char
+            ))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes the JSON value at the current position. A value that isn't
+        complete yet is decoded again once there is twice as much to go on,
+        so a large value takes few attempts.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number could go on in the next chunk
+                if end < len(self.buffer):
+                    self.pos = end
+                    return value
+            except ValueError:
+                pass
+            if not self._read(max(len(self.buffer) - self.pos, CHUNK_SIZE)):
+                value, self.pos = self.decoder.raw_decode(
+                    self.buffer, self.pos
+                )
+                return value
+
+    def members(self):
+        """
+        Yields the keys of the object at the current position. The caller
+        reads each key's value before asking for the next key.
+        """
+        self._next('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._next(':')
+            self._peek()
+            yield key
+            if self._next(',', '}') == '}':
+                return
+
+    def elements(self):
+        """
+        Yields once for each element of the array at the current position.
+        The caller reads each element before asking for the next one.
+        """
+        self._next('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            self._peek()
+            yield
+            if self._next(',', ']') == ']':
+                return
+
+    def copy(self, patch_pages=None):
+        """
+        Copies the HAR, with its pages changed by `patch_pages(pages)` and
+        written out again. Returns an outline of the HAR: its pages, and
+        the entry_outline() of each entry.
+        """
+        outline = {'log': {'pages': [], 'entries': []}}
+        for key in self.members():
+            if key != 'log':
+                self.value()
+                continue
+            for key in self.members():
+                if key == 'pages':
+                    self._flush()
+                    pages = self.value()
+                    if patch_pages is not None:
+                        patch_pages(pages)
+                    text = json.dumps(
+                        pages, separators=(',', ':'), ensure_ascii=False
+                    )
+                    if isinstance(text, unicode):
+                        text = text.encode('utf-8')
+                    self.out.write(text)
+                    self.buffer = self.buffer[self.pos:]
+                    self.pos = 0
+                    outline['log']['pages'] = pages
+                elif key == 'entries':
+                    for _ in self.elements():
+                        outline['log']['entries'].append(
+                            entry_outline(self.value())
+                        )
+                        self._flush()
+                else:
+                    self.value()
+        self.pos = len(self.buffer)
+        self._flush()
+        for chunk in self.chunks:
+            self.out.write(chunk)
+        return outline
+
+
+def stream_har(chunks, path, har_format='compact', patch_pages=None,
+               mode=0o644):
+    """
+    Atomically writes a HAR that arrives as chunks of JSON, such as the
+    proxy's response, holding no more than one entry in memory at a time.
+    Only the pages are parsed and serialized again, after
+    `patch_pages(pages)`; the rest is copied as it arrived, so the HAR can
+    only be saved `compact` or `gzip`. Returns an outline of the HAR for
+    har_metrics() and the catalog.
+    """
+    if har_format == 'pretty':
+        raise ValueError("a streamed HAR can't be saved pretty")
+    with _atomic_har_file(path, har_format, mode) as f:
+        return HarStream(chunks, f).copy(patch_pages)
@@ -0,0 +1,158 @@
+"""
+Timings of the profiler's and uploader's own phases.
+
+Code wraps each phase in `metrics.timer('<phase>')`. The durations are
+summed per phase, sent to StatsD as they happen if it is configured, and
+can be written out at the end of a run in the Prometheus text format (e.g.
+for node_exporter's textfile collector).
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+log = logging.getLogger('harmetrics')
+log.setLevel(logging.INFO)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = defaultdict(
+            lambda: {'count': 0, 'sum': 0.0, 'max': 0.0, 'errors': 0}
+        )
+        self.statsd = None
+        self.statsd_prefix = 'harprofiler'
+        self.socket = None
+
+    def configure(self, config):
+        """
+        Sends timings to StatsD if `statsd_host` is set in the config.
+        """
+        self.statsd = None
+        if config.get('statsd_host'):
+            self.statsd = (
+                config['statsd_host'], int(config.get('statsd_port', 8125))
+            )
+            self.statsd_prefix = config.get('statsd_prefix') or 'harprofiler'
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line, self.statsd)
+        except socket.error as e:
+            log.debug('statsd send failed: {}'.format(e))
+
+    def record(self, phase, seconds, error=False):
+        with self.lock:
+            stats = self.phases[phase]
+            stats['count'] += 1
+            stats['sum'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            if error:
+                stats['errors'] += 1
+        if self.statsd is not None:
+            self._send('{}.{}:{:.3f}|ms'.format(
+                self.statsd_prefix, phase, seconds * 1000
+            ))
+            if error:
+                self._send('{}.{}.errors:1|c'.format(
+                    self.statsd_prefix, phase
+                ))
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(phase, time.time() - start, error=True)
+            raise
+        self.record(phase, time.time() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return dict((phase, dict(stats))
+                        for phase, stats in self.phases.items())
+
+    def merge(self, snapshot):
+        """
+        Adds the phases of another process's snapshot() to these.
+        """
+        with self.lock:
+            for phase, other in snapshot.items():
+                stats = self.phases[phase]
+                stats['count'] += other['count']
+                stats['sum'] += other['sum']
+                stats['max'] = max(stats['max'], other['max'])
+                stats['errors'] += other['errors']
+
+    def prometheus(self, prefix='harprofiler'):
+        phases = sorted(self.snapshot().items())
+        lines = [
+            '# HELP {}_phase_seconds Time spent in each phase.'.format(prefix),
+            '# TYPE {}_phase_seconds summary'.format(prefix),
+        ]
+        for phase, stats in phases:
+            lines.append('{}_phase_seconds_sum{{phase="{}"}} {:.6f}'.format(
+                prefix, phase, stats['sum']
+            ))
+            lines.append('{}_phase_seconds_count{{phase="{}"}} {}'.format(
+                prefix, phase, stats['count']
+            ))
+        lines += [
+            '# HELP {}_phase_seconds_max Longest single run of each '
+            'phase.'.format(prefix),
+            '# TYPE {}_phase_seconds_max gauge'.format(prefix),
+        ]
+        for phase, stats in phases:
+            lines.append('{}_phase_seconds_max{{phase="{}"}} {:.6f}'.format(
+                prefix, phase, stats['max']
+            ))
+        lines += [
+            '# HELP {}_phase_errors_total Runs of each phase that raised '
+            'an error.'.format(prefix),
+            '# TYPE {}_phase_errors_total counter'.format(prefix),
+        ]
+        for phase, stats in phases:
+            lines.append('{}_phase_errors_total{{phase="{}"}} {}'.format(
+                prefix, phase, stats['errors']
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='harprofiler'):
+        """
+        Atomically writes the Prometheus text format to `path`.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp'
+        )
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.prometheus(prefix))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+    def summary(self):
+        lines = []
+        for phase, stats in sorted(
+                self.snapshot().items(), key=lambda item: -item[1]['sum']):
+            lines.append(
+                '{:<20} {:>6} x {:>8.3f}s mean {:>8.3f}s max '
+                '{:>9.1f}s total{}'.format(
+                    phase, stats['count'], stats['sum'] / stats['count'],
+                    stats['max'], stats['sum'],
+                    ' ({} errors)'.format(stats['errors'])
+                    if stats['errors'] else ''
+                )
+            )
+        return '\n'.join(lines)
+
+
+# the registry every module records into
+metrics = Metrics()
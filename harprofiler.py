@@ -10,153 +10,1363 @@
 #
 
 import argparse
-import json
+from contextlib import contextmanager
+import itertools
 import logging
+import multiprocessing
 import os
 import re
+import shutil
+import signal
+import sys
 import textwrap
+import threading
 import time
+from traceback import format_exception_only
+import urlparse
 import yaml
 
 from browsermobproxy import Server
+import requests
 from pyvirtualdisplay import Display
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
 
-from haruploader import Uploader
+from harblobs import DEFAULT_MIN_SIZE, BlobStore
+from harcatalog import Catalog
+from harmetrics import metrics
+from harfiles import (
+    CHUNK_SIZE, HAR_FORMATS, har_extension, load_json, stream_har, write_har,
+    write_json
+)
+from harscheduler import DEFAULT_INTERVAL, DEFAULT_JITTER, Scheduler
+from harsources import iter_url_configs, shard_of
+from harspool import (
+    DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_RETRY_DELAY, DEFAULT_RETRY_DELAY, Spool
+)
+from harstats import har_metrics, summarize_metrics
+from haruploader import Uploader, UploadPipeline
 
 
 logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
 log = logging.getLogger('harprofiler')
 log.setLevel(logging.INFO)
 
+# Each parallel worker gets its own block of ports: the browsermob server
+# listens on the first one and hands out proxy ports from the rest.
+WORKER_PORT_SPAN = 1000
+
+# Built-in network profiles for the proxy's bandwidth (kbps) and added
+# per-request latency (ms) limits, modelled on WebPageTest's presets.
+# `network_profiles` in the config adds to or overrides these.
+NETWORK_PROFILES = {
+    '3g': {'downstream_kbps': 1600, 'upstream_kbps': 768, 'latency': 300},
+    'dsl': {'downstream_kbps': 1500, 'upstream_kbps': 384, 'latency': 50},
+    'cable': {'downstream_kbps': 5000, 'upstream_kbps': 1000, 'latency': 28},
+}
+
+# what a pooled proxy is reset to when the next page has no network profile
+NO_LIMITS = {'downstream_kbps': 0, 'upstream_kbps': 0, 'latency': 0}
+
+DEFAULT_LOGIN_URL = 'https://courses.edx.org/login'
+
+# seconds to wait for the browser to leave the login page once the form is
+# submitted
+DEFAULT_LOGIN_TIMEOUT = 30
+
+# CSS selectors for the login form fields. Each one matches both the old
+# and the new style login page.
+DEFAULT_LOGIN_SELECTORS = {
+    'email': '#email, #login-email',
+    'password': '#password, #login-password',
+}
+
+# the cookie fields webdriver's add_cookie accepts
+COOKIE_FIELDS = ('name', 'value', 'path', 'domain', 'secure', 'httpOnly',
+                 'expiry')
+
+# Puts Firefox back in the state of a fresh browser: clears its HTTP and
+# image caches, cookies, DNS cache, site data (localStorage, IndexedDB,
+# service workers) and HSTS state, and closes its idle keep-alive
+# connections, which also closes the proxy's upstream connections for them.
+# Runs asynchronously in the browser's chrome context, where the XPCOM
+# services are reachable; the clear-data service is missing from older
+# versions, and flags it doesn't know are skipped.
+FIREFOX_RESET_SCRIPT = textwrap.dedent("""
+    var done = arguments[arguments.length - 1];
+    var Cc = Components.classes, Ci = Components.interfaces;
+    Cc['@mozilla.org/netwerk/cache-storage-service;1']
+        .getService(Ci.nsICacheStorageService).clear();
+    Cc['@mozilla.org/image/tools;1'].getService(Ci.imgITools)
+        .getImgCacheForDocument(null).clearCache(false);
+    Cc['@mozilla.org/cookiemanager;1']
+        .getService(Ci.nsICookieManager).removeAll();
+    Cc['@mozilla.org/network/dns-service;1']
+        .getService(Ci.nsIDNSService).clearCache(true);
+    Cc['@mozilla.org/observer-service;1']
+        .getService(Ci.nsIObserverService)
+        .notifyObservers(null, 'net:prune-all-connections', null);
+    if (!Ci.nsIClearDataService) {
+        done();
+        return;
+    }
+    var flags = 0;
+    ['CLEAR_DOM_STORAGES', 'CLEAR_DOM_QUOTA', 'CLEAR_HSTS',
+     'CLEAR_AUTH_CACHE', 'CLEAR_DNS_CACHE'].forEach(function (name) {
+        flags |= Ci.nsIClearDataService[name] || 0;
+    });
+    Cc['@mozilla.org/clear-data-service;1']
+        .getService(Ci.nsIClearDataService)
+        .deleteData(flags, {onDataDeleted: function () { done(); }});
+    """)
+
+# config keys for what the proxy records, and the new_har option each sets
+CAPTURE_OPTIONS = (
+    ('capture_headers', 'captureHeaders'),
+    ('capture_content', 'captureContent'),
+    ('capture_binary_content', 'captureBinaryContent'),
+)
+
+# what a journey step can do, besides waiting for an element with wait_for
+JOURNEY_ACTIONS = ('navigate', 'click', 'fill')
+
+# seconds a journey step waits for the elements it needs
+DEFAULT_STEP_TIMEOUT = 30
+
+# Seconds before webdriver gives up on a page load or a script, and before
+# the watchdog gives up on a call to the proxy's REST API. The watchdog
+# gives webdriver `watchdog_grace` seconds more to time out on its own
+# before it kills the browser.
+DEFAULT_PAGE_LOAD_TIMEOUT = 120
+DEFAULT_SCRIPT_TIMEOUT = 30
+DEFAULT_HAR_FETCH_TIMEOUT = 120
+DEFAULT_WATCHDOG_GRACE = 30
+# seconds a browser may take to start before the watchdog kills it
+DEFAULT_WEBDRIVER_STARTUP_TIMEOUT = 120
+
+# config keys that can't change without restarting the proxy server,
+# display, browsers and upload pipeline of a daemon: running browsers keep
+# the timeouts they were started with, and the pipeline's uploader, spool
+# and blob store are set up once
+SESSION_KEYS = (
+    'browsermob_dir', 'browsermob_port', 'browser', 'headless',
+    'firefox_preferences', 'virtual_display', 'virtual_display_size_x',
+    'virtual_display_size_y', 'page_load_timeout', 'script_timeout',
+    'catalog', 'har_dir', 'blob_dir', 'blob_min_size', 'harstorage_url',
+    'upload_pipeline', 'upload_workers', 'upload_stream', 'upload_gzip',
+    'upload_spool', 'upload_max_attempts', 'upload_retry_delay',
+    'upload_max_retry_delay',
+)
+
+_last_epoch = [0.0]
+
+
+def next_epoch():
+    """
+    Returns the current time, nudged forward if needed so that no two calls
+    in this process ever return the same value.
+    """
+    epoch = max(time.time(), _last_epoch[0] + 0.00001)
+    _last_epoch[0] = epoch
+    return epoch
+
+
+def start_display(size_x, size_y):
+    log.info('starting virtual display')
+    display = Display(visible=0, size=(size_x, size_y))
+    with metrics.timer('display_startup'):
+        display.start()
+    return display
+
+
+def start_server(browsermob_dir, port=None, proxy_port_range=None):
+    log.info('starting browsermob proxy')
+    options = {'port': port} if port is not None else {}
+    server = Server(
+        '{}/bin/browsermob-proxy'.format(browsermob_dir), options
+    )
+    if proxy_port_range is not None:
+        server.command.append(
+            '--proxyPortRange={}-{}'.format(*proxy_port_range)
+        )
+    with metrics.timer('proxy_startup'):
+        server.start()
+    return server
+
+
+def resolve_network_profile(config, name):
+    """
+    Returns the proxy limits for a network profile named in the config.
+    """
+    profiles = dict(NETWORK_PROFILES, **(config.get('network_profiles') or {}))
+    if name not in profiles:
+        raise ValueError('unknown network profile: {} (known: {})'.format(
+            name, ', '.join(sorted(profiles))
+        ))
+    return profiles[name]
+
+
+class LoginSession:
+    """
+    Logs in once and reuses the session cookies in every new webdriver.
+
+    It logs in again only when the session has expired: when a session
+    cookie's expiry has passed, when it is older than `login_session_ttl`
+    seconds, or when a page load is redirected back to the login page. With
+    `login_cookie_file` set, the cookies are saved there and reused by the
+    next run too.
+    """
+
+    def __init__(self, config):
+        self.user = config.get('login_user')
+        self.password = config.get('login_password')
+        self.login_url = config.get('login_url') or DEFAULT_LOGIN_URL
+        self.selectors = dict(
+            DEFAULT_LOGIN_SELECTORS, **(config.get('login_selectors') or {})
+        )
+        self.ttl = config.get('login_session_ttl')
+        self.timeout = config.get('login_timeout', DEFAULT_LOGIN_TIMEOUT)
+        self.cookie_file = config.get('login_cookie_file')
+        self.cookies = None
+        self.logged_in_at = None
+        self.logins = 0
+
+        if self.cookie_file and os.path.isfile(self.cookie_file):
+            self.cookies = load_json(self.cookie_file)
+            self.logged_in_at = os.path.getmtime(self.cookie_file)
+
+    def expired(self):
+        if not self.cookies:
+            return True
+        now = time.time()
+        if self.ttl is not None and now - self.logged_in_at > self.ttl:
+            return True
+        return any(
+            cookie.get('expiry') is not None and cookie['expiry'] < now
+            for cookie in self.cookies
+        )
+
+    def invalidate(self):
+        self.cookies = None
+
+    def login(self, driver):
+        log.info('logging in...')
+
+        error_msg = 'must specify login credentials in yaml config file'
+        if self.user is None:
+            raise RuntimeError(error_msg)
+        if self.password is None:
+            raise RuntimeError(error_msg)
+
+        with metrics.timer('login'):
+            driver.get(self.login_url)
+            email_field = driver.find_element_by_css_selector(
+                self.selectors['email']
+            )
+            password_field = driver.find_element_by_css_selector(
+                self.selectors['password']
+            )
+            email_field.send_keys(self.user)
+            password_field.send_keys(self.password)
+            password_field.submit()
+            # the login page logs in with a script, so the session cookies
+            # only exist once it has sent the browser on
+            try:
+                WebDriverWait(driver, self.timeout).until(
+                    lambda driver: not self.on_login_page(driver)
+                )
+            except TimeoutException:
+                raise RuntimeError(
+                    'login did not complete within {}s, still on {}'.format(
+                        self.timeout, driver.current_url
+                    )
+                )
+
+        self.cookies = [
+            dict((k, cookie[k]) for k in COOKIE_FIELDS if k in cookie)
+            for cookie in driver.get_cookies()
+        ]
+        self.logged_in_at = time.time()
+        self.logins += 1
+        if self.cookie_file:
+            write_json(self.cookies, self.cookie_file, mode=0o600)
+
+    def apply(self, driver):
+        """
+        Gets `driver` logged in, with the cached cookies if they are still
+        good or by logging in otherwise.
+        """
+        if self.expired():
+            self.login(driver)
+            return
+
+        # webdriver only takes cookies for the site it is on
+        parts = urlparse.urlsplit(self.login_url)
+        driver.get('{}://{}/robots.txt'.format(parts.scheme, parts.netloc))
+        for cookie in self.cookies:
+            driver.add_cookie(cookie)
+
+    def on_login_page(self, driver):
+        """
+        True if the last page load was bounced to the login page, i.e. the
+        session has expired server-side.
+        """
+        return driver.current_url.split('?')[0] == self.login_url
+
+
+class BrowserLauncher:
+    """
+    Starts browsers that send their traffic through a browsermob proxy.
+
+    Firefox profiles are cloned from a template profile that is built once,
+    with any `firefox_preferences` from the config already written to it,
+    instead of being built from scratch for every page. With `headless`
+    set, Firefox or Chrome runs without a display, so no virtual display is
+    needed.
+    """
+
+    def __init__(self, config):
+        self.browser = config.get('browser') or 'firefox'
+        if self.browser not in ('firefox', 'chrome'):
+            raise ValueError('browser must be firefox or chrome')
+        self.headless = bool(config.get('headless'))
+        self.firefox_preferences = config.get('firefox_preferences') or {}
+        self.page_load_timeout = config.get(
+            'page_load_timeout', DEFAULT_PAGE_LOAD_TIMEOUT
+        )
+        self.script_timeout = config.get(
+            'script_timeout', DEFAULT_SCRIPT_TIMEOUT
+        )
+        self.template = None
+        self.startup_times = []
+
+    def _template_profile(self):
+        if self.template is None:
+            log.info('building template firefox profile')
+            self.template = webdriver.FirefoxProfile()
+            for name, value in self.firefox_preferences.items():
+                self.template.set_preference(name, value)
+            self.template.update_preferences()
+        return self.template.path
+
+    def _start_firefox(self, proxy):
+        profile = webdriver.FirefoxProfile(self._template_profile())
+        profile.set_proxy(proxy.selenium_proxy())
+        options = webdriver.FirefoxOptions()
+        if self.headless:
+            options.add_argument('-headless')
+        return webdriver.Firefox(firefox_profile=profile, options=options)
+
+    def _start_chrome(self, proxy):
+        options = webdriver.ChromeOptions()
+        options.add_argument('--proxy-server={}'.format(proxy.proxy))
+        # browsermob re-signs https traffic with its own certificate
+        options.add_argument('--ignore-certificate-errors')
+        if self.headless:
+            options.add_argument('--headless')
+        return webdriver.Chrome(options=options)
+
+    def start(self, proxy):
+        start = time.time()
+        with metrics.timer('webdriver_startup'):
+            if self.browser == 'chrome':
+                driver = self._start_chrome(proxy)
+            else:
+                driver = self._start_firefox(proxy)
+        self.startup_times.append(time.time() - start)
+        if self.page_load_timeout:
+            driver.set_page_load_timeout(self.page_load_timeout)
+        if self.script_timeout:
+            driver.set_script_timeout(self.script_timeout)
+        return driver
+
+    def reset(self, driver):
+        """
+        Clears what a running browser kept from its last page, so that its
+        next page load is a cold one (see FIREFOX_RESET_SCRIPT). Chrome's
+        DevTools protocol can clear its cache, cookies and the last page's
+        site data, but not its keep-alive connections to the proxy.
+        """
+        last_url = driver.current_url
+        driver.get('about:blank')
+        if self.browser == 'chrome':
+            driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            parts = urlparse.urlsplit(last_url or '')
+            if parts.scheme in ('http', 'https'):
+                driver.execute_cdp_cmd('Storage.clearDataForOrigin', {
+                    'origin': '{}://{}'.format(parts.scheme, parts.netloc),
+                    'storageTypes': 'all',
+                })
+        else:
+            with driver.context(driver.CONTEXT_CHROME):
+                driver.execute_async_script(FIREFOX_RESET_SCRIPT)
+
+    def mean_startup_time(self):
+        if not self.startup_times:
+            return 0.0
+        return sum(self.startup_times) / len(self.startup_times)
+
+    def close(self):
+        if self.template is not None:
+            shutil.rmtree(self.template.path, ignore_errors=True)
+            self.template = None
+
+
+def process_tree(pid):
+    """
+    Returns `pid` and the pids of all of its descendants, read from /proc.
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command name in parentheses may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    tree, todo = [], [pid]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, []))
+    return tree
+
+
+def process_tree_rss(pid):
+    """
+    Resident memory in bytes of a process and all of its descendants.
+    """
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open('/proc/{}/status'.format(child)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except IOError:
+            continue
+    return total
+
+
+def kill_process_tree(pid):
+    """
+    Kills a process and all of its descendants.
+    """
+    pids = process_tree(pid) if os.path.isdir('/proc') else [pid]
+    for child in pids:
+        try:
+            os.kill(child, signal.SIGKILL)
+        except OSError:
+            # it exited on its own
+            pass
+
+
+def browser_pid(driver):
+    """
+    The pid of the webdriver service that started a browser, or None.
+    """
+    try:
+        return driver.service.process.pid
+    except AttributeError:
+        return None
+
+
+def server_pid(server):
+    """
+    The pid of a browsermob proxy server's process, or None.
+    """
+    try:
+        return server.process.pid
+    except AttributeError:
+        return None
+
+
+def stop_server(server):
+    """
+    Stops a browsermob proxy server. Server.stop() only kills the process
+    it started, which can leave the JVM behind, so the rest of its process
+    tree is killed too. Errors are logged, not raised.
+    """
+    pid = server_pid(server)
+    pids = process_tree(pid) if pid and os.path.isdir('/proc') else []
+    try:
+        server.stop()
+    except Exception as e:
+        log.warning('error stopping browsermob proxy: {}'.format(e))
+    for child in pids:
+        try:
+            os.kill(child, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class PhaseTimeout(Exception):
+    """
+    A phase of profiling a url hung, and the watchdog killed the browser or
+    proxy it was waiting on.
+    """
+
+    def __init__(self, phase, timeout, killed):
+        Exception.__init__(self, '{} hung for {}s, killed the {}'.format(
+            phase, timeout, killed
+        ))
+        self.phase = phase
+        self.timeout = timeout
+        self.killed = killed
+
+
+@contextmanager
+def watchdog(phase, timeout, target, pid):
+    """
+    Runs a block that waits on the `target` ('browser' or 'proxy') with the
+    process tree of `pid`. If the block runs for `timeout` seconds, the
+    process tree is killed, which makes the call it is blocked in fail, and
+    the block raises PhaseTimeout. Without a timeout or pid the block runs
+    unguarded.
+
+    `pid` can also be a function that returns the pids to kill when the
+    watchdog fires, for a process that doesn't exist yet when the block
+    starts.
+    """
+    if not timeout or pid is None:
+        yield
+        return
+
+    fired = []
+
+    def kill():
+        log.warning('{} hung for {}s, killing the {}'.format(
+            phase, timeout, target
+        ))
+        fired.append(True)
+        for hung in (pid() if callable(pid) else [pid]):
+            kill_process_tree(hung)
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except Exception:
+        if fired:
+            raise PhaseTimeout(phase, timeout, target)
+        raise
+    finally:
+        timer.cancel()
+    if fired:
+        raise PhaseTimeout(phase, timeout, target)
+
+
+@contextmanager
+def unguarded(driver=None):
+    """
+    A quit_browser() guard that doesn't guard anything.
+    """
+    yield
+
+
+def quit_browser(driver, proxy, broken=False, guard=unguarded):
+    """
+    Quits a browser and closes its proxy, each in a `guard(driver)` block
+    (see HarProfiler._guard; without a driver it guards the proxy). After
+    an error, e.g. once the watchdog has killed them, failures to do so are
+    only logged.
+    """
+    try:
+        try:
+            with guard(driver):
+                driver.quit()
+        finally:
+            with guard():
+                proxy.close()
+    except Exception as e:
+        if not broken:
+            raise
+        log.warning('error quitting browser: {}'.format(e))
+
+
+class PooledBrowser:
+    """
+    A running browser and the proxy it sends its traffic through.
+    """
+
+    def __init__(self, driver, proxy):
+        self.driver = driver
+        self.proxy = proxy
+        self.pages = 0
+        # ProxyRules.key of the rules set up on the proxy
+        self.rules = None
+
+    def memory(self):
+        """
+        Resident memory in bytes of the webdriver service and the browser
+        it started, or None where that can't be measured.
+        """
+        pid = browser_pid(self.driver)
+        if pid is None or not os.path.isdir('/proc'):
+            return None
+        return process_tree_rss(pid)
+
+    def quit(self, guard=unguarded):
+        quit_browser(self.driver, self.proxy, guard=guard)
+
+
+class BrowserPool:
+    """
+    Keeps proxied browsers running between pages, so that each page doesn't
+    pay for starting a new browser and proxy.
+
+    A browser's cache, cookies, site data and (in Firefox) DNS cache and
+    idle connections are cleared before it is handed out again, so every
+    page still starts with a cold load (see BrowserLauncher.reset for what
+    Chrome keeps). Browsers are
+    recycled after `pool_recycle_pages` pages, or once the browser's
+    processes use more than `pool_recycle_memory_mb`, so that leaks in long
+    running browsers don't skew the timings.
+    """
+
+    def __init__(self, browsers, config):
+        self.browsers = browsers
+        self.idle = []
+        self.started = 0
+        self.recycled = 0
+        self.configure(config)
+
+    def configure(self, config):
+        self.recycle_pages = int(config.get('pool_recycle_pages') or 50)
+        self.recycle_memory = config.get('pool_recycle_memory_mb')
+
+    def lease(self, start):
+        """
+        Returns an idle browser, reset for a cold load, or a new one from
+        `start()`, which returns a (driver, proxy) tuple.
+        """
+        while self.idle:
+            browser = self.idle.pop()
+            try:
+                self.browsers.reset(browser.driver)
+                return browser
+            except Exception as e:
+                log.warning('discarding pooled browser: {}'.format(e))
+                self._discard(browser)
+        driver, proxy = start()
+        self.started += 1
+        return PooledBrowser(driver, proxy)
+
+    def _recycle_reason(self, browser):
+        if browser.pages >= self.recycle_pages:
+            return 'after {} pages'.format(browser.pages)
+        if self.recycle_memory:
+            memory = browser.memory()
+            if memory is not None and memory > self.recycle_memory * 2**20:
+                return 'using {:.0f}MB'.format(memory / 2.0**20)
+        return None
+
+    def release(self, browser, broken=False, guard=unguarded):
+        """
+        Returns a leased browser to the pool, or quits it in `guard` blocks
+        (see quit_browser) if it broke or is due to be recycled.
+        """
+        browser.pages += 1
+        reason = 'after an error' if broken else self._recycle_reason(browser)
+        if reason is None:
+            self.idle.append(browser)
+            return
+        log.info('recycling browser {}'.format(reason))
+        self.recycled += 1
+        self._discard(browser, guard)
+
+    def _discard(self, browser, guard=unguarded):
+        try:
+            browser.quit(guard)
+        except Exception as e:
+            log.warning('error quitting browser: {}'.format(e))
+
+    def close(self):
+        while self.idle:
+            self._discard(self.idle.pop())
+
+
+def host_pattern(host):
+    """
+    Returns a url regex for a host name in which `*` matches any part of a
+    name, e.g. `*.edx.org`. The scheme, port and path are optional, so the
+    regex matches both request urls and the host:port of https CONNECTs.
+    """
+    regex = re.escape(host).replace(r'\*', r'[^/:]*')
+    return r'^(https?://)?{}(:\d+)?(/.*)?$'.format(regex)
+
+
+class ProxyRules:
+    """
+    What a proxy records and which requests it lets through, set per url
+    (or globally) in the config:
+
+        capture_headers, capture_content, capture_binary_content: what the
+            HAR records, passed to new_har()
+        host_whitelist: if set, only these hosts are let through
+        host_blacklist: these hosts are not let through
+        blocked_status: the status blocked requests get (default 204)
+        rewrite_rules: a list of {match, replace} url rewrites
+
+    Hosts are names as in host_pattern(), e.g. `*.edx.org`.
+    """
+
+    def __init__(self, config):
+        self.har_options = dict(
+            (option, bool(config[key]))
+            for key, option in CAPTURE_OPTIONS
+            if config.get(key) is not None
+        )
+        self.whitelist = tuple(
+            host_pattern(host) for host in config.get('host_whitelist') or []
+        )
+        self.blacklist = tuple(
+            host_pattern(host) for host in config.get('host_blacklist') or []
+        )
+        self.blocked_status = int(config.get('blocked_status') or 204)
+        self.rewrites = tuple(
+            (rule['match'], rule['replace'])
+            for rule in config.get('rewrite_rules') or []
+        )
+        # what apply() sets up on the proxy, to tell whether a pooled
+        # proxy already has the same rules
+        self.key = (
+            self.whitelist, self.blacklist, self.blocked_status, self.rewrites
+        )
+
+    def apply(self, proxy):
+        if self.whitelist:
+            proxy.whitelist(','.join(self.whitelist), self.blocked_status)
+        for pattern in self.blacklist:
+            proxy.blacklist(pattern, self.blocked_status)
+        for match, replace in self.rewrites:
+            proxy.rewrite_url(match, replace)
+
+    @staticmethod
+    def clear(proxy, timeout=None):
+        """
+        Removes the rules apply() set up, before a pooled proxy is used
+        with other rules.
+        """
+        # the client has no calls for these two
+        for rules in ('whitelist', 'blacklist'):
+            requests.delete('{}/proxy/{}/{}'.format(
+                proxy.host, proxy.port, rules
+            ), timeout=timeout)
+        proxy.clear_all_rewrite_url_rules()
+
+
+def make_blob_store(config):
+    """
+    The store for response bodies if `blob_dir` is set, otherwise None and
+    bodies stay in the HARs.
+    """
+    if not config.get('blob_dir'):
+        return None
+    return BlobStore(
+        config['blob_dir'], config.get('blob_min_size', DEFAULT_MIN_SIZE)
+    )
+
+
+def har_chunks(proxy, timeout=None):
+    """
+    Yields the proxy's HAR in chunks as it arrives, instead of parsing it
+    whole like `proxy.har` does. `timeout` is the seconds to wait for the
+    proxy to respond or send more.
+    """
+    response = requests.get(
+        '{}/proxy/{}/har'.format(proxy.host, proxy.port), stream=True,
+        timeout=timeout
+    )
+    try:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
+
+
+def find_page(pages, page_ref):
+    """
+    The page with id `page_ref`, or the last page if there's no such page.
+    """
+    page = pages[-1]
+    for candidate in pages:
+        if candidate.get('id') == page_ref:
+            page = candidate
+    return page
+
+
+def apply_page_timings(page, timings):
+    """
+    Sets a HAR page's onContentLoad and onLoad from the browser's
+    Navigation Timing, and records the raw browser timings in custom
+    (underscore-prefixed) HAR fields:
+
+        page._navigationTiming: every Navigation Timing field
+        page._resourceTiming: the Resource Timing entries
+        pageTimings._firstPaint, pageTimings._firstContentfulPaint: in ms
+            since navigation start, where the browser reports them
+    """
+    navigation = timings['navigation']
+    start = navigation['navigationStart']
+    page_timings = page.setdefault('pageTimings', {})
+    page_timings['onContentLoad'] = (
+        navigation['domContentLoadedEventEnd'] - start
+    )
+    page_timings['onLoad'] = navigation['loadEventEnd'] - start
+
+    paint = timings.get('paint') or {}
+    if 'first-paint' in paint:
+        page_timings['_firstPaint'] = paint['first-paint']
+    if 'first-contentful-paint' in paint:
+        page_timings['_firstContentfulPaint'] = paint['first-contentful-paint']
+
+    page['_navigationTiming'] = navigation
+    page['_resourceTiming'] = timings.get('resources') or []
+
+
+def apply_step_timings(page, step_time, timings=None):
+    """
+    Adds a journey step's timings to its HAR page: `_stepTime` in
+    pageTimings, the ms from starting the step until it was done, and the
+    browser's `timings` if the step loaded a new document. Steps that
+    didn't, e.g. a click handled by the page's scripts, get the HAR value
+    for timings that don't apply, -1, as onContentLoad and onLoad.
+    """
+    if timings is not None:
+        apply_page_timings(page, timings)
+    else:
+        page_timings = page.setdefault('pageTimings', {})
+        page_timings['onContentLoad'] = -1
+        page_timings['onLoad'] = -1
+    page['pageTimings']['_stepTime'] = step_time
+
+
+def parse_journey_step(step):
+    """
+    Returns a journey step as a mapping of its action (one of
+    JOURNEY_ACTIONS, or wait_for for a step that only waits), target url or
+    css selector, text to fill in, the selector to wait for once the
+    action is done, and name.
+    """
+    actions = [action for action in JOURNEY_ACTIONS if action in step]
+    if len(actions) > 1:
+        raise ValueError(
+            'journey step has more than one action: {}'.format(step)
+        )
+    if actions:
+        action = actions[0]
+    elif 'wait_for' in step:
+        action = 'wait_for'
+    else:
+        raise ValueError(
+            'journey step needs one of {} or wait_for: {}'.format(
+                ', '.join(JOURNEY_ACTIONS), step
+            )
+        )
+    if action == 'fill' and 'text' not in step:
+        raise ValueError('fill step needs text: {}'.format(step))
+    return {
+        'action': action,
+        'target': step[action],
+        'text': step.get('text'),
+        'wait_for': step.get('wait_for'),
+        'name': step.get('name') or action,
+    }
+
+
+def journey_url_config(journey):
+    """
+    The `urls` entry that profiles one of `journeys`: the url of its first
+    step, which has to navigate, with the parsed steps as its `journey`
+    option. Any other keys of the journey (e.g. `login_first` or
+    `samples`) are options too.
+    """
+    options = dict(journey)
+    name = options.pop('name', None)
+    steps = [parse_journey_step(step) for step in options.pop('steps', [])]
+    if not name or not steps:
+        raise ValueError('journey needs a name and steps: {}'.format(journey))
+    if steps[0]['action'] != 'navigate':
+        raise ValueError('journey {} must start by navigating'.format(name))
+    options['url'] = steps[0]['target']
+    options['journey'] = {'name': name, 'steps': steps}
+    return options
+
 
 class HarProfiler:
 
-    def __init__(self, config, url, login_first=False):
+    def __init__(self, config, url, login_first=False, server=None,
+                 worker=None, catalog=None, login_session=None,
+                 browsers=None, pool=None, uploads=None):
         self.url = url
         self.login_first = login_first
-
-        self.login_user = config.get('login_user')
-        self.login_password = config.get('login_password')
+        self.login_session = login_session
+        if login_first and login_session is None:
+            self.login_session = LoginSession(config)
 
         self.browsermob_dir = config['browsermob_dir']
         self.har_dir = config['har_dir']
+        self.har_format = config.get('har_format') or 'pretty'
+        if self.har_format not in HAR_FORMATS:
+            raise ValueError('har_format must be one of: {}'.format(
+                ', '.join(HAR_FORMATS)
+            ))
         self.label_prefix = config['label_prefix'] or ''
         self.run_cached = config['run_cached']
-        self.virtual_display = config['virtual_display']
+        self.samples = int(config.get('samples') or 1)
+        self.virtual_display = (
+            config['virtual_display'] and not config.get('headless')
+        )
         self.virtual_display_size_x = config['virtual_display_size_x']
         self.virtual_display_size_y = config['virtual_display_size_y']
 
-        self.label = '{}{}'.format(self.label_prefix, self.slugify(url))
+        self.network_profile = config.get('network_profile')
+        self.network_limits = None
+        if self.network_profile is not None:
+            self.network_limits = resolve_network_profile(
+                config, self.network_profile
+            )
+
+        self.label = '{}{}'.format(
+            self.label_prefix, self.slugify(self._label_name())
+        )
+        if self.network_profile is not None:
+            self.label += '-{}'.format(self.slugify(self.network_profile))
         self.cached_label = '{}-cached'.format(self.label)
 
-        epoch = time.time()
-        self.har_name = '{}-{}.har'.format(self.label, epoch)
-        self.cached_har_name = '{}-{}.har'.format(self.cached_label, epoch)
+        # parallel workers tag their file names so that the same url
+        # profiled by two workers at once can't produce the same name
+        self.epoch = next_epoch()
+        self.worker_suffix = '' if worker is None else '-w{}'.format(worker)
+        self.har_name = self.har_file_name()
+        self.cached_har_name = self.har_file_name(cached=True)
+
+        # har_metrics() of every cold and warm load, for the summary
+        self.results = {'cold': [], 'warm': []}
+
+        # a server shared by a ProfilerSession, or the one started in
+        # __enter__ when the profiler is used on its own
+        self.server = server
+        self.catalog = catalog
+        self.browsers = browsers or BrowserLauncher(config)
+        self.pool = pool
+        self.uploads = uploads
+        self.blobs = make_blob_store(config)
+
+        self.page_load_timeout = config.get(
+            'page_load_timeout', DEFAULT_PAGE_LOAD_TIMEOUT
+        )
+        self.script_timeout = config.get(
+            'script_timeout', DEFAULT_SCRIPT_TIMEOUT
+        )
+        self.har_fetch_timeout = config.get(
+            'har_fetch_timeout', DEFAULT_HAR_FETCH_TIMEOUT
+        )
+        self.watchdog_grace = config.get(
+            'watchdog_grace', DEFAULT_WATCHDOG_GRACE
+        )
+        self.webdriver_startup_timeout = config.get(
+            'webdriver_startup_timeout', DEFAULT_WEBDRIVER_STARTUP_TIMEOUT
+        )
+        # the phase the profiler is in, and what went wrong if it failed
+        self.phase = None
+        self.failure = None
+        # what the watchdog killed, even where a hang was only logged
+        self.killed = set()
+        self.proxy_rules = ProxyRules(config)
+
+        # compact and gzip HARs are copied from the proxy to disk as they
+        # arrive; pretty printing or moving bodies to the blob store needs
+        # the whole HAR parsed
+        self.stream_har = self.har_format != 'pretty' and self.blobs is None
 
     def __enter__(self):
         if self.virtual_display:
-            log.info('starting virtual display')
-            self.display = Display(visible=0, size=(
+            self.display = start_display(
                 self.virtual_display_size_x,
                 self.virtual_display_size_y
-            ))
-            self.display.start()
-
-        log.info('starting browsermob proxy')
-        self.server = Server('{}/bin/browsermob-proxy'.format(
-            self.browsermob_dir)
-        )
-        self.server.start()
+            )
+        self.server = start_server(self.browsermob_dir)
         return self
 
     def __exit__(self, type, value, traceback):
         log.info('stopping browsermob proxy')
-        self.server.stop()
+        stop_server(self.server)
         if self.virtual_display:
             log.info('stopping virtual display')
             self.display.stop()
+        self.browsers.close()
 
     def _make_proxied_webdriver(self):
-        proxy = self.server.create_proxy()
-        profile = webdriver.FirefoxProfile()
-        profile.set_proxy(proxy.selenium_proxy())
-        driver = webdriver.Firefox(firefox_profile=profile)
+        with self._guard('proxy_setup', self.har_fetch_timeout):
+            proxy = self.server.create_proxy()
+        launched = False
+        try:
+            with self._guard_launch(self.webdriver_startup_timeout):
+                driver = self.browsers.start(proxy)
+            launched = True
+        finally:
+            if not launched:
+                self._close_proxy(proxy)
         return (driver, proxy)
 
-    def _save_har(self, har, cached=False):
+    def _close_proxy(self, proxy):
+        """
+        Closes the proxy of a browser that failed to start. Errors are only
+        logged, so the failure is recorded for the launch.
+        """
+        phase = self.phase
+        try:
+            with self._cleanup_guard():
+                proxy.close()
+        except Exception as e:
+            log.warning('error closing proxy: {}'.format(e))
+        self.phase = phase
+
+    def har_file_name(self, cached=False, sample=None):
+        """
+        Name of the HAR file for one page load. With more than one sample
+        per url, each sample's file is numbered.
+        """
+        label = self.cached_label if cached else self.label
+        sample_suffix = '' if sample is None else '-s{}'.format(sample)
+        return '{}-{:.6f}{}{}{}'.format(
+            label, self.epoch, self.worker_suffix, sample_suffix,
+            har_extension(self.har_format)
+        )
+
+    def _label_name(self):
+        return self.url
+
+    def _browser_deadline(self, timeout):
+        """
+        How long the watchdog lets a browser call run that webdriver gives
+        up on after `timeout` seconds.
+        """
+        return timeout + self.watchdog_grace if timeout else None
+
+    @contextmanager
+    def _guard(self, phase, timeout, driver=None):
+        """
+        Runs a phase under the watchdog, which kills the browser of
+        `driver`, or without a driver the proxy server, if the phase runs
+        for `timeout` seconds.
+        """
+        self.phase = phase
+        if driver is not None:
+            target, pid = 'browser', browser_pid(driver)
+        else:
+            target, pid = 'proxy', server_pid(self.server)
+        try:
+            with watchdog(phase, timeout, target, pid):
+                yield
+        except PhaseTimeout:
+            self.killed.add(target)
+            raise
+
+    @contextmanager
+    def _guard_launch(self, timeout):
+        """
+        Runs a browser launch under the watchdog. Until the launch returns
+        there is no driver to find the browser by, so a launch that runs
+        for `timeout` seconds has the processes it started killed instead.
+        """
+        self.phase = 'webdriver_startup'
+        launched = None
+        if os.path.isdir('/proc'):
+            running = set(process_tree(os.getpid()))
+
+            def launched():
+                return [pid for pid in process_tree(os.getpid())
+                        if pid not in running]
+
+        try:
+            with watchdog('webdriver_startup', timeout, 'browser', launched):
+                yield
+        except PhaseTimeout:
+            self.killed.add('browser')
+            raise
+
+    def _cleanup_guard(self, driver=None):
+        """
+        The guard for quitting a browser (with `driver`) or closing a proxy.
+        """
+        if driver is not None:
+            return self._guard(
+                'cleanup', self._browser_deadline(self.script_timeout), driver
+            )
+        return self._guard('cleanup', self.har_fetch_timeout)
+
+    def _release(self, browser, driver, proxy, broken):
+        """
+        Returns the browser to the pool or quits it. By now the url has
+        been profiled or has failed, so a hang here is logged, not raised;
+        a proxy server killed for it is still restarted (see
+        ProfilerSession.profile).
+        """
+        phase = self.phase
+        try:
+            if self.pool is not None:
+                self.pool.release(browser, broken, self._cleanup_guard)
+            else:
+                quit_browser(driver, proxy, broken, self._cleanup_guard)
+        except PhaseTimeout as e:
+            log.warning('error quitting browser: {}'.format(e))
+        finally:
+            if broken:
+                # the failure is recorded for the phase that broke it
+                self.phase = phase
+
+    def _har_path(self, cached=False, sample=None):
         if not os.path.isdir(self.har_dir):
             os.makedirs(self.har_dir)
-        if not cached:
-            har_name = self.har_name
-        elif cached:
-            har_name = self.cached_har_name
+        har_name = self.har_file_name(cached, sample)
 
         log.info('saving HAR file: {}'.format(har_name))
-        with open(os.path.join(self.har_dir, har_name), 'w') as f:
-            json.dump(har, f, indent=2, ensure_ascii=False)
+        return os.path.join(self.har_dir, har_name)
 
-    def _login(self, driver):
-        log.info('logging in...')
+    def _save_har(self, har, cached=False, sample=None):
+        har_path = self._har_path(cached, sample)
+        with metrics.timer('har_save'):
+            if self.blobs is not None:
+                self.blobs.dehydrate(har)
+            write_har(har, har_path, self.har_format)
+        self._har_saved(har_path, har)
 
-        error_msg = 'must specify login credentials in yaml config file'
-        if self.login_user is None:
-            raise RuntimeError(error_msg)
-        if self.login_password is None:
-            raise RuntimeError(error_msg)
+    def _save_recording(self, proxy, patch_pages, cached=False,
+                        sample=None):
+        """
+        Fetches the proxy's HAR, changes its pages with
+        `patch_pages(pages)` and saves it. Returns the HAR, or its outline if
+        it was streamed (see harfiles.stream_har).
+        """
+        if self.stream_har:
+            har_path = self._har_path(cached, sample)
+            with self._guard('har_fetch', self.har_fetch_timeout), \
+                    metrics.timer('har_fetch'):
+                har = stream_har(
+                    har_chunks(proxy, self.har_fetch_timeout or None),
+                    har_path, self.har_format, patch_pages
+                )
+            self._har_saved(har_path, har)
+            return har
 
-        driver.get('https://courses.edx.org/login')
+        with self._guard('har_fetch', self.har_fetch_timeout), \
+                metrics.timer('har_fetch'):
+            har = proxy.har
+        patch_pages(har['log']['pages'])
+        self._save_har(har, cached, sample)
+        return har
 
-        # handle both old and new style logins
-        try:
-            email_field = driver.find_element_by_id('email')
-            password_field = driver.find_element_by_id('password')
-        except NoSuchElementException:
-            email_field = driver.find_element_by_id('login-email')
-            password_field = driver.find_element_by_id('login-password')
-        email_field.send_keys(self.login_user)
-        password_field.send_keys(self.login_password)
-        password_field.submit()
+    def _har_saved(self, har_path, har):
+        if self.catalog is not None:
+            self.catalog.record(har_path, har, url=self.url)
+        if self.uploads is not None:
+            self.uploads.submit(har_path)
 
-    def _add_page_event_timings(self, driver, har):
+    def _collect_page_timings(self, driver):
+        """
+        Fetches the Navigation Timing fields, Resource Timing entries and
+        paint timings of the current page in one script call.
+        """
         jscript = textwrap.dedent("""
             var performance = window.performance || {};
-            var timings = performance.timing || {};
-            return timings;
+            var timing = performance.timing || {};
+            var result = {navigation: {}, resources: [], paint: {}};
+            // Browsers without toJSON still expose the fields as
+            // (inherited) properties, so copy the plain values over.
+            var plain = function (object, types) {
+                var copy = {};
+                var source = object.toJSON ? object.toJSON() : object;
+                for (var key in source) {
+                    if (types.indexOf(typeof source[key]) !== -1) {
+                        copy[key] = source[key];
+                    }
+                }
+                return copy;
+            };
+            result.navigation = plain(timing, ['number']);
+            if (performance.getEntriesByType) {
+                performance.getEntriesByType('resource').forEach(
+                    function (entry) {
+                        result.resources.push(
+                            plain(entry, ['number', 'string'])
+                        );
+                    }
+                );
+                performance.getEntriesByType('paint').forEach(
+                    function (entry) {
+                        result.paint[entry.name] = entry.startTime;
+                    }
+                );
+            }
+            return result;
             """)
-        timings = driver.execute_script(jscript)
-        har['log']['pages'][0]['pageTimings']['onContentLoad'] = (
-            timings['domContentLoadedEventEnd'] - timings['navigationStart']
-        )
-        har['log']['pages'][0]['pageTimings']['onLoad'] = (
-            timings['loadEventEnd'] - timings['navigationStart']
-        )
-        return har
+        return driver.execute_script(jscript)
 
     def load_page(self):
-        try:
+        if self.samples == 1:
+            self._load_sample()
+            return
+
+        for sample in range(self.samples):
+            log.info('sample {} of {}'.format(sample + 1, self.samples))
+            self._load_sample(sample)
+        self._save_summary()
+
+    def _load_sample(self, sample=None):
+        """
+        Loads the page cold in a new (or freshly reset pooled) browser, then
+        again warm if run_cached is set.
+        """
+        browser = None
+        if self.pool is not None:
+            browser = self.pool.lease(self._make_proxied_webdriver)
+            driver, proxy = browser.driver, browser.proxy
+        else:
             driver, proxy = self._make_proxied_webdriver()
+        broken = True
+        try:
+            with self._guard('proxy_setup', self.har_fetch_timeout):
+                self._apply_proxy_rules(proxy, browser)
 
             if self.login_first:
-                self._login(driver)
+                with self._guard(
+                        'login',
+                        self._browser_deadline(self.page_load_timeout),
+                        driver):
+                    self.login_session.apply(driver)
+
+            with self._guard('proxy_setup', self.har_fetch_timeout):
+                if self.network_limits is not None:
+                    log.info('limiting network to {} profile'.format(
+                        self.network_profile
+                    ))
+                    proxy.limits(self.network_limits)
+                elif self.pool is not None:
+                    # the last page may have left limits on a pooled proxy
+                    proxy.limits(NO_LIMITS)
 
-            proxy.new_har(self.label)
             log.info('loading page: {}'.format(self.url))
-            driver.get(self.url)
-            har = self._add_page_event_timings(driver, proxy.har)
-            self._save_har(har)
+            har = self._record(driver, proxy, self.label, sample=sample)
+            self.results['cold'].append(har_metrics(har))
 
             if self.run_cached:
-                proxy.new_har(self.cached_label)
                 log.info('loading cached page: {}'.format(self.url))
-                driver.get(self.url)
-                har = self._add_page_event_timings(driver, proxy.har)
-                self._save_har(har, cached=True)
-        except Exception:
-            raise
+                har = self._record(
+                    driver, proxy, self.cached_label, True, sample
+                )
+                self.results['warm'].append(har_metrics(har))
+            broken = False
         finally:
-            driver.quit()
+            self._release(browser, driver, proxy, broken)
+
+    def _apply_proxy_rules(self, proxy, browser=None):
+        """
+        Sets up the url's host filters and rewrites on the proxy before
+        anything is loaded. A pooled proxy is left alone if it already has
+        the same rules, and cleared first if it has others.
+        """
+        rules = self.proxy_rules
+        if browser is not None:
+            if browser.rules == rules.key:
+                return
+            if browser.rules is not None:
+                ProxyRules.clear(proxy, self.har_fetch_timeout or None)
+            browser.rules = rules.key
+        rules.apply(proxy)
+
+    def _record(self, driver, proxy, label, cached=False, sample=None):
+        """
+        Loads the url while the proxy records a new HAR under `label`, saves
+        the HAR and returns it (or its outline, if it was streamed). If the
+        load lands on the login page, the login session has expired, so it
+        logs in again and reloads.
+        """
+        page_load = self._browser_deadline(self.page_load_timeout)
+        with self._guard('proxy_setup', self.har_fetch_timeout):
+            proxy.new_har(label, self.proxy_rules.har_options)
+        with self._guard('page_load', page_load, driver), \
+                metrics.timer('page_load'):
+            driver.get(self.url)
+        if self.login_first and self.login_session.on_login_page(driver):
+            log.info('login session expired')
+            self.login_session.invalidate()
+            with self._guard('login', page_load, driver):
+                self.login_session.apply(driver)
+            with self._guard('proxy_setup', self.har_fetch_timeout):
+                proxy.new_har(label, self.proxy_rules.har_options)
+            with self._guard('page_load', page_load, driver), \
+                    metrics.timer('page_load'):
+                driver.get(self.url)
+        with self._guard(
+                'page_timings',
+                self._browser_deadline(self.script_timeout), driver):
+            timings = self._collect_page_timings(driver)
+        return self._save_recording(
+            proxy,
+            lambda pages: apply_page_timings(find_page(pages, label), timings),
+            cached, sample
+        )
+
+    def summary(self):
+        summary = {
+            'label': self.label,
+            'url': self.url,
+            'samples': self.samples,
+            'cold': summarize_metrics(self.results['cold']),
+        }
+        if self.results['warm']:
+            summary['warm'] = summarize_metrics(self.results['warm'])
+        return summary
+
+    def _save_summary(self):
+        summary_name = '{}-{:.6f}{}-summary.json'.format(
+            self.label, self.epoch, self.worker_suffix
+        )
+        log.info('saving summary: {}'.format(summary_name))
+        write_json(self.summary(), os.path.join(self.har_dir, summary_name))
+
+    def failed(self, error):
+        """
+        Records why profiling the url failed, in `failure` and in a
+        `<label>-<epoch>-failure.json` file next to the HARs.
+        """
+        self.failure = {
+            'url': self.url,
+            'label': self.label,
+            'network_profile': self.network_profile,
+            'worker': self.worker_suffix[len('-w'):] or None,
+            'phase': getattr(error, 'phase', None) or self.phase,
+            'error': type(error).__name__,
+            'message': format_exception_only(
+                type(error), error
+            )[-1].strip(),
+            'timed_out': isinstance(error, (PhaseTimeout, TimeoutException)),
+            'killed': getattr(error, 'killed', None),
+            'time': time.time(),
+        }
+        if self.failure['killed']:
+            self.killed.add(self.failure['killed'])
+        failure_name = '{}-{:.6f}{}-failure.json'.format(
+            self.label, self.epoch, self.worker_suffix
+        )
+        log.error('profiling {} failed in {}: {}'.format(
+            self.url, self.failure['phase'], self.failure['message']
+        ))
+        if not os.path.isdir(self.har_dir):
+            os.makedirs(self.har_dir)
+        write_json(self.failure, os.path.join(self.har_dir, failure_name))
 
     def slugify(self, text):
         pattern = re.compile(r'[^a-z0-9]+')
@@ -164,22 +1374,634 @@ class HarProfiler:
         return slug
 
 
-def main(config_file='config.yaml'):
-    config = yaml.load(file(config_file))
+class JourneyProfiler(HarProfiler):
+    """
+    Profiles a journey, e.g. from the dashboard to a course to one of its
+    videos: its steps run one after another in the same browser, and each
+    is recorded as its own page of one HAR, with the id
+    `<label>-<step number>-<step name>`.
+
+    A step navigates to a url, clicks or fills in the element matching a
+    css selector, or only waits, then waits for the element matching its
+    `wait_for` selector if it has one.
+    """
+
+    def __init__(self, config, url, login_first=False, **kwargs):
+        self.journey = config['journey']
+        self.steps = self.journey['steps']
+        self.step_timeout = config.get(
+            'journey_step_timeout', DEFAULT_STEP_TIMEOUT
+        )
+        HarProfiler.__init__(self, config, url, login_first, **kwargs)
+
+    def _label_name(self):
+        return self.journey['name']
+
+    def _find(self, driver, selector):
+        return WebDriverWait(driver, self.step_timeout).until(
+            lambda driver: driver.find_element_by_css_selector(selector)
+        )
+
+    def _run_step(self, driver, step):
+        action, target = step['action'], step['target']
+        if action == 'navigate':
+            driver.get(target)
+        elif action == 'click':
+            self._find(driver, target).click()
+        elif action == 'fill':
+            element = self._find(driver, target)
+            element.clear()
+            element.send_keys(step['text'])
+        if step['wait_for']:
+            self._find(driver, step['wait_for'])
 
-    for url_config in config['urls']:
-        if isinstance(url_config, basestring):
-            login_first = False
-            url = url_config
+    def _step_deadline(self):
+        """
+        How long the watchdog lets a step run: it can load a page, then
+        wait for two elements. Like the page load, unguarded if the page
+        load timeout is off.
+        """
+        if not self.page_load_timeout:
+            return None
+        return self._browser_deadline(
+            self.page_load_timeout + 2 * self.step_timeout
+        )
+
+    def _run_steps(self, driver, proxy, label):
+        """
+        Runs the steps while the proxy records each as a page of a new HAR.
+        Returns the (step time, browser timings) of each page by id, or
+        None if the first step landed on the login page.
+        """
+        timings = {}
+        navigation_start = None
+        step_deadline = self._step_deadline()
+        for number, step in enumerate(self.steps, 1):
+            page_ref = '{}-{}-{}'.format(
+                label, number, self.slugify(step['name'])
+            )
+            with self._guard('proxy_setup', self.har_fetch_timeout):
+                if number == 1:
+                    proxy.new_har(page_ref, self.proxy_rules.har_options)
+                else:
+                    proxy.new_page(page_ref)
+            log.info('journey step {}: {} {}'.format(
+                number, step['action'], step['target']
+            ))
+            start = time.time()
+            with self._guard('journey_step', step_deadline, driver), \
+                    metrics.timer('journey_step'):
+                self._run_step(driver, step)
+            step_time = (time.time() - start) * 1000
+            if (number == 1 and self.login_first and
+                    self.login_session.on_login_page(driver)):
+                return None
+
+            with self._guard(
+                    'page_timings',
+                    self._browser_deadline(self.script_timeout), driver):
+                page_timings = self._collect_page_timings(driver)
+            started = page_timings['navigation'].get('navigationStart')
+            if started == navigation_start:
+                # still the same document
+                timings[page_ref] = (step_time, None)
+            else:
+                timings[page_ref] = (step_time, page_timings)
+            navigation_start = started
+        return timings
+
+    def _record(self, driver, proxy, label, cached=False, sample=None):
+        """
+        Runs the journey while the proxy records it, saves the HAR and
+        returns it (or its outline, if it was streamed). If the first step
+        lands on the login page, it logs in again and starts over.
+        """
+        timings = self._run_steps(driver, proxy, label)
+        if timings is None:
+            log.info('login session expired')
+            self.login_session.invalidate()
+            with self._guard(
+                    'login',
+                    self._browser_deadline(self.page_load_timeout),
+                    driver):
+                self.login_session.apply(driver)
+            timings = self._run_steps(driver, proxy, label)
+
+        def patch_pages(pages):
+            for page in pages:
+                if page.get('id') in timings:
+                    apply_step_timings(page, *timings[page['id']])
+
+        return self._save_recording(proxy, patch_pages, cached, sample)
+
+
+class ProfilerSession:
+    """
+    Runs many HarProfilers against one browsermob proxy server and one
+    virtual display.
+
+    Each url still gets its own proxy port and webdriver, but the server
+    JVM and the Xvfb display are only started and stopped once per run.
+    With `browser_pool` set, the proxies and browsers are kept running
+    between urls too, in a BrowserPool.
+
+    With `harstorage_url` set, each HAR is uploaded by an UploadPipeline as
+    soon as it is saved, unless `upload_pipeline` is false.
+    """
+
+    def __init__(self, config, worker=None):
+        self.config = config
+        self.worker = worker
+        self.pages = 0
+        self.display = None
+        self.server = None
+        self.catalog = None
+        self.spool = None
+        self.uploads = None
+        self.failures = []
+        self.login_session = LoginSession(config)
+        self.browsers = BrowserLauncher(config)
+        self.pool = None
+        if config.get('browser_pool'):
+            self.pool = BrowserPool(self.browsers, config)
+        self.display_startup_time = 0.0
+        self.startup_time = 0.0
+        self.teardown_time = 0.0
+        self.started = time.time()
+
+    def __enter__(self):
+        self.started = time.time()
+        if self.config.get('catalog'):
+            self.catalog = Catalog(self.config['catalog'])
+        if (self.config.get('harstorage_url') and
+                self.config.get('upload_pipeline', True)):
+            self.spool = open_spool(self.config)
+            self.uploads = UploadPipeline(
+                make_uploader(self.config, self.catalog, self.spool)
+            )
+        # only what would otherwise be paid for every url counts here
+        start = time.time()
+        if self.browsers.headless:
+            log.info('running headless, skipping virtual display')
+        elif self.config['virtual_display']:
+            self.display = start_display(
+                self.config['virtual_display_size_x'],
+                self.config['virtual_display_size_y']
+            )
+            self.display_startup_time = time.time() - start
+        self._start_server()
+        self.startup_time = time.time() - start
+        return self
+
+    def _start_server(self):
+        port, proxy_port_range = None, None
+        if self.worker is not None:
+            port = (self.config.get('browsermob_port', 8080) +
+                    self.worker * WORKER_PORT_SPAN)
+            proxy_port_range = (port + 1, port + WORKER_PORT_SPAN - 1)
+        self.server = start_server(
+            self.config['browsermob_dir'], port, proxy_port_range
+        )
+
+    def restart_server(self):
+        """
+        Replaces a proxy server the watchdog killed. Pooled browsers send
+        their traffic through its proxies, so they go too.
+        """
+        log.warning('restarting browsermob proxy')
+        if self.pool is not None:
+            self.pool.close()
+        stop_server(self.server)
+        self._start_server()
+
+    def __exit__(self, type, value, traceback):
+        if self.pool is not None:
+            self.pool.close()
+            log.info('started {} browsers for {} urls'.format(
+                self.pool.started, self.pages
+            ))
+        start = time.time()
+        log.info('stopping browsermob proxy')
+        stop_server(self.server)
+        if self.display is not None:
+            log.info('stopping virtual display')
+            self.display.stop()
+        self.teardown_time = time.time() - start
+        if self.uploads is not None:
+            log.info('waiting for queued uploads')
+            self.uploads.close()
+        if self.spool is not None:
+            self.spool.close()
+        if self.catalog is not None:
+            self.catalog.close()
+        self.browsers.close()
+        log.info(
+            'profiled {} urls with a shared proxy server and display, '
+            'saving ~{:.1f}s over starting them for each url'.format(
+                self.pages, self.time_saved()
+            )
+        )
+        self.log_startup_times()
+        if self.failures:
+            log.warning('{} of {} urls failed, see the *-failure.json files '
+                        'in {}'.format(len(self.failures),
+                                       self.pages + len(self.failures),
+                                       self.config['har_dir']))
+
+    def log_startup_times(self):
+        """
+        Logs how much of the run went into starting the display and the
+        browsers, to compare headless and virtual display runs.
+        """
+        elapsed = time.time() - self.started
+        browser_time = sum(self.browsers.startup_times)
+        display = (
+            'headless, no virtual display' if self.browsers.headless
+            else 'virtual display {:.1f}s'.format(self.display_startup_time)
+        )
+        log.info(
+            'startup: {}; {} {:.1f}s mean over {} browsers; '
+            '{:.0%} of the run'.format(
+                display, self.browsers.browser,
+                self.browsers.mean_startup_time(),
+                len(self.browsers.startup_times),
+                (self.display_startup_time + browser_time) / elapsed
+                if elapsed else 0
+            )
+        )
+
+    def reload(self, config):
+        """
+        Takes a changed config without restarting the server, display or
+        browsers. Returns False if the change needs a restart, see
+        SESSION_KEYS.
+        """
+        if any(config.get(key) != self.config.get(key)
+               for key in SESSION_KEYS):
+            return False
+        keys = set(config) | set(self.config)
+        if any(config.get(key) != self.config.get(key)
+               for key in keys if key.startswith('login_')):
+            self.login_session = LoginSession(config)
+        if self.pool is not None:
+            self.pool.configure(config)
+        self.config = config
+        return True
+
+    def time_saved(self):
+        """
+        Estimated wall-clock seconds saved compared with starting and
+        stopping the proxy server and display for every url.
+        """
+        lifecycle = self.startup_time + self.teardown_time
+        return lifecycle * max(self.pages - 1, 0)
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            'worker': self.worker,
+            'pages': self.pages,
+            'failed': len(self.failures),
+            'elapsed': elapsed,
+            'pages_per_minute': self.pages * 60.0 / elapsed if elapsed else 0,
+        }
+
+    def profile(self, url, login_first=False, options=None):
+        """
+        Profiles one url, or the journey in `options` if there is one.
+        `options` override settings from the config for this url only.
+
+        If profiling fails, the failure is recorded (see
+        HarProfiler.failed) instead of raised, so the run goes on with the
+        next url, and a proxy server the watchdog killed is restarted.
+        """
+        config = dict(self.config, **(options or {}))
+        if 'journey' in config:
+            profiler_class = JourneyProfiler
         else:
-            login_first = url_config[1]
-            url = url_config[0]
-        with HarProfiler(config, url, login_first) as profiler:
+            profiler_class = HarProfiler
+        profiler = profiler_class(
+            config, url, login_first, server=self.server,
+            worker=self.worker, catalog=self.catalog,
+            login_session=self.login_session, browsers=self.browsers,
+            pool=self.pool, uploads=self.uploads
+        )
+        try:
             profiler.load_page()
+        except Exception as e:
+            profiler.failed(e)
+            self.failures.append(profiler.failure)
+        else:
+            self.pages += 1
+        if 'proxy' in profiler.killed:
+            self.restart_server()
+        return profiler
+
+
+def _profile_worker(args):
+    """
+    Profiles a slice of the jobs in a worker process, with a proxy server,
+    display and browsers that no other worker shares.
+
+    Every worker reads the url sources itself and takes every `workers`th
+    job, so the jobs never have to be held in memory or sent between
+    processes.
+    """
+    config, worker, workers = args
+    with ProfilerSession(config, worker) as session:
+        for i, job in enumerate(profile_jobs(config, select_urls(config))):
+            if i % workers == worker:
+                session.profile(*job)
+    stats = session.stats()
+    stats['metrics'] = metrics.snapshot()
+    return stats
+
+
+def run_workers(config, workers):
+    """
+    Spreads the profile_jobs() of the config round-robin over `workers`
+    processes and logs the throughput of each one.
+    """
+    start = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(
+            _profile_worker,
+            [(config, worker, workers) for worker in range(workers)]
+        )
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    for stats in results:
+        metrics.merge(stats.pop('metrics'))
+        log.info(
+            'worker {worker}: {pages} urls in {elapsed:.1f}s '
+            '({pages_per_minute:.1f} urls/min), {failed} failed'.format(
+                **stats
+            )
+        )
+    total = sum(stats['pages'] for stats in results)
+    log.info('{} workers: {} urls in {:.1f}s ({:.1f} urls/min)'.format(
+        len(results), total, elapsed, total * 60.0 / elapsed
+    ))
+    return results
+
+
+def parse_url_config(url_config):
+    """
+    Returns a (url, login_first, options) tuple for an entry of `urls` in
+    the config.
+
+    An entry is either a url, a [url, login_first] list, or a mapping with
+    a `url` key, an optional `login_first` key and any settings to override
+    for that url, e.g. `samples`.
+    """
+    if isinstance(url_config, basestring):
+        return url_config, False, {}
+    if isinstance(url_config, dict):
+        options = dict(url_config)
+        url = options.pop('url')
+        login_first = options.pop('login_first', False)
+        return url, login_first, options
+    return url_config[0], url_config[1], {}
+
+
+def open_spool(config):
+    """
+    Opens the upload spool, `upload_spool.sqlite` in the HAR directory
+    unless `upload_spool` says otherwise. Returns None if `upload_spool` is
+    set to false.
+    """
+    path = config.get(
+        'upload_spool', os.path.join(config['har_dir'], 'upload_spool.sqlite')
+    )
+    if not path:
+        return None
+    return Spool(
+        path,
+        config.get('upload_max_attempts', DEFAULT_MAX_ATTEMPTS),
+        config.get('upload_retry_delay', DEFAULT_RETRY_DELAY),
+        config.get('upload_max_retry_delay', DEFAULT_MAX_RETRY_DELAY)
+    )
+
+
+def make_uploader(config, catalog=None, spool=None):
+    return Uploader(
+        config['har_dir'],
+        config['harstorage_url'],
+        config.get('upload_workers', 1),
+        config.get('upload_stream', False),
+        config.get('upload_gzip', False),
+        catalog,
+        spool,
+        make_blob_store(config)
+    )
+
+
+def select_urls(config):
+    """
+    Yields the `urls` entries this node profiles, read lazily from `urls`
+    and `url_sources`, then those of its `journeys`. With `shard_count` set,
+    the urls are split into that many shards by a stable hash of the url
+    (or of the journey's name), and only those of shard `shard_index`
+    (counting from 0) are yielded.
+    """
+    shard_count = int(config.get('shard_count') or 1)
+    shard_index = int(config.get('shard_index') or 0)
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('shard_index must be from 0 to shard_count - 1')
+    url_configs = itertools.chain(
+        iter_url_configs(config),
+        (journey_url_config(journey)
+         for journey in config.get('journeys') or [])
+    )
+    for url_config in url_configs:
+        if shard_count == 1:
+            yield url_config
+            continue
+        url, _, options = parse_url_config(url_config)
+        if 'journey' in options:
+            url = options['journey']['name']
+        if shard_of(url, shard_count) == shard_index:
+            yield url_config
+
+
+def profile_jobs(config, url_configs):
+    """
+    Yields a (url, login_first, options) job for every url and network
+    profile to sweep it with. `profiles` is a list of network profile
+    names, set globally or per url.
+    """
+    for url_config in url_configs:
+        url, login_first, options = parse_url_config(url_config)
+        profiles = options.pop('profiles', config.get('profiles')) or [None]
+        for profile in profiles:
+            job_options = dict(options)
+            if profile is not None:
+                job_options['network_profile'] = profile
+            yield url, login_first, job_options
+
 
+def report_metrics(config):
+    """
+    Logs the per-phase summary of the run and writes the Prometheus metrics
+    file if `metrics_file` is set.
+    """
+    log.info('time per phase:\n{}'.format(metrics.summary()))
+    if config.get('metrics_file'):
+        metrics.write_prometheus(config['metrics_file'])
+
+
+def load_config(config_file, overrides=None):
+    """
+    Reads the config file, with `overrides` (e.g. from the command line)
+    taking precedence.
+    """
+    config = yaml.load(file(config_file))
+    config.update(overrides or {})
+    return config
+
+
+def load_daemon_config(config_file, overrides=None):
+    config = load_config(config_file, overrides)
+    config['browser_pool'] = True
+    return config
+
+
+def make_scheduler(config, scheduler=None):
+    """
+    Schedules every profile job of the config, keeping the due times of
+    jobs an existing `scheduler` already has.
+    """
+    if scheduler is None:
+        scheduler = Scheduler()
+    scheduler.interval = config.get('daemon_interval', DEFAULT_INTERVAL)
+    scheduler.jitter = config.get('daemon_jitter', DEFAULT_JITTER)
+    scheduler.update(profile_jobs(config, select_urls(config)))
+    return scheduler
+
+
+def profile_scheduled(session, job):
+    """
+    Profiles one scheduled job and uploads its HARs. Errors are logged
+    rather than raised, so one bad url doesn't stop the daemon.
+
+    With the session's upload pipeline, the HARs are already queued as they
+    are saved; sweeping the HAR directory queues the retries that have come
+    due.
+    """
+    config = session.config
+    try:
+        session.profile(*job)
+    except Exception:
+        log.exception('profiling {} failed'.format(job[0]))
+    if session.uploads is not None:
+        try:
+            session.uploads.sweep()
+        except Exception:
+            log.exception('queueing HARs for upload failed')
+    elif config.get('harstorage_url'):
+        spool = open_spool(config)
+        try:
+            make_uploader(config, session.catalog, spool).upload_hars()
+        except Exception:
+            log.exception('uploading HARs failed')
+        finally:
+            if spool is not None:
+                spool.close()
+    if config.get('metrics_file'):
+        metrics.write_prometheus(config['metrics_file'])
+
+
+def run_daemon(config_file, overrides=None):
+    """
+    Profiles the configured urls continuously, each on its own interval,
+    with a proxy server, display and pool of browsers that stay running.
+
+    SIGHUP reloads the config file. Jobs that are still in it keep their
+    schedule, and the server, display and browsers are only restarted if
+    one of the SESSION_KEYS changed. SIGTERM or SIGINT stop the daemon
+    once the current url is done.
+    """
+    requested = {'reload': False, 'stop': False}
+
+    def request(action):
+        def handler(signum, frame):
+            requested[action] = True
+        return handler
+
+    signal.signal(signal.SIGHUP, request('reload'))
+    signal.signal(signal.SIGTERM, request('stop'))
+    signal.signal(signal.SIGINT, request('stop'))
+
+    config = load_daemon_config(config_file, overrides)
+    metrics.configure(config)
+    scheduler = make_scheduler(config)
+    log.info('scheduled {} jobs'.format(len(scheduler.jobs)))
+
+    while not requested['stop']:
+        with ProfilerSession(config) as session:
+            while not requested['stop']:
+                if requested['reload']:
+                    requested['reload'] = False
+                    log.info('reloading {}'.format(config_file))
+                    try:
+                        config = load_daemon_config(config_file, overrides)
+                    except Exception:
+                        log.exception('keeping the old config')
+                        continue
+                    metrics.configure(config)
+                    make_scheduler(config, scheduler)
+                    log.info('scheduled {} jobs'.format(len(scheduler.jobs)))
+                    if not session.reload(config):
+                        log.info('restarting the profiler session')
+                        break
+
+                job = scheduler.pop()
+                if job is None:
+                    # signals cut the sleep short; a job may have come due
+                    # since pop(), which makes the wait 0
+                    wait = scheduler.wait_time()
+                    time.sleep(60 if wait is None else min(wait, 60))
+                    continue
+                profile_scheduled(session, job)
+
+    report_metrics(config)
+
+
+def main(config_file='config.yaml', workers=1, overrides=None):
+    """
+    Profiles every url of the config and uploads the HARs. Returns the
+    number of urls that failed.
+    """
+    config = load_config(config_file, overrides)
+    metrics.configure(config)
+
+    if workers > 1:
+        failed = sum(stats['failed'] for stats in run_workers(config, workers))
+    else:
+        with ProfilerSession(config) as session:
+            for job in profile_jobs(config, select_urls(config)):
+                session.profile(*job)
+        failed = len(session.failures)
+
+    # with the upload pipeline, this only finds what it left: files from
+    # earlier runs and retries that have come due
     if config.get('harstorage_url'):
-        uploader = Uploader(config['har_dir'], config['harstorage_url'])
-        uploader.upload_hars()
+        catalog = Catalog(config['catalog']) if config.get('catalog') else None
+        spool = open_spool(config)
+        try:
+            make_uploader(config, catalog, spool).upload_hars()
+        finally:
+            if catalog is not None:
+                catalog.close()
+            if spool is not None:
+                spool.close()
+
+    report_metrics(config)
+    return failed
 
 
 if __name__ == '__main__':
@@ -189,6 +2011,39 @@ if __name__ == '__main__':
         default='config.yaml',
         help='Path to configuration file (Default: config.yaml)'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        default=1,
+        type=int,
+        help='Number of urls to profile in parallel (Default: 1)'
+    )
+    parser.add_argument(
+        '-d', '--daemon',
+        action='store_true',
+        help='Keep running, profiling each url on its own interval'
+    )
+    parser.add_argument(
+        '--shard-index',
+        type=int,
+        help='Profile only the urls of this shard, counting from 0 '
+             '(Default: shard_index from the config, or 0)'
+    )
+    parser.add_argument(
+        '--shard-count',
+        type=int,
+        help='Number of shards the urls are split into, e.g. one per '
+             'profiling node (Default: shard_count from the config, or 1)'
+    )
     args = parser.parse_args()
 
-    main(args.config)
+    overrides = {}
+    if args.shard_index is not None:
+        overrides['shard_index'] = args.shard_index
+    if args.shard_count is not None:
+        overrides['shard_count'] = args.shard_count
+
+    if args.daemon:
+        run_daemon(args.config, overrides)
+    elif main(args.config, args.workers, overrides):
+        # failed urls are recorded rather than raised; still let cron know
+        sys.exit(1)
@@ -0,0 +1,93 @@
+"""
+Schedules profile jobs on per-url intervals for daemon mode.
+
+Every job runs once per `interval` seconds, give or take `jitter` (a
+fraction of the interval), so that urls which share an interval drift
+apart instead of all coming due at the same moment.
+"""
+
+import heapq
+import json
+import random
+import time
+
+DEFAULT_INTERVAL = 3600
+DEFAULT_JITTER = 0.1
+
+
+def job_key(job):
+    """
+    A stable key for a (url, login_first, options) job, so a job keeps its
+    place in the schedule when the config is reloaded.
+    """
+    return json.dumps(job, sort_keys=True)
+
+
+class Scheduler:
+    """
+    A queue of jobs ordered by when they are next due.
+
+    A job's options may set its own `interval` in seconds; other jobs use
+    the scheduler's default.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, jitter=DEFAULT_JITTER,
+                 clock=time.time):
+        self.interval = interval
+        self.jitter = jitter
+        self.clock = clock
+        # key: (job, interval, due)
+        self.jobs = {}
+        self.queue = []
+
+    def _next_due(self, interval, now):
+        return now + interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _push(self, key, due):
+        job, interval, _ = self.jobs[key]
+        self.jobs[key] = (job, interval, due)
+        heapq.heappush(self.queue, (due, key))
+
+    def update(self, jobs):
+        """
+        Replaces the scheduled jobs. Jobs that were already scheduled keep
+        their due time; new ones come due within the jitter of their first
+        interval, so a fresh daemon starts working straight away without
+        starting every url at once.
+        """
+        now = self.clock()
+        old = self.jobs
+        self.jobs = {}
+        self.queue = []
+        for url, login_first, options in jobs:
+            options = dict(options)
+            interval = float(options.pop('interval', self.interval))
+            job = (url, login_first, options)
+            key = job_key(job)
+            if key in old:
+                due = old[key][2]
+            else:
+                due = now + random.uniform(0, interval * self.jitter)
+            self.jobs[key] = (job, interval, due)
+            self._push(key, due)
+
+    def wait_time(self):
+        """
+        Seconds until the next job is due, or None if nothing is scheduled.
+        """
+        if not self.queue:
+            return None
+        return max(self.queue[0][0] - self.clock(), 0)
+
+    def pop(self):
+        """
+        Returns the job that is most overdue and schedules its next run, or
+        returns None if no job is due yet.
+        """
+        now = self.clock()
+        if not self.queue or self.queue[0][0] > now:
+            return None
+        _, key = heapq.heappop(self.queue)
+        job, interval, _ = self.jobs[key]
+        self._push(key, self._next_due(interval, now))
+        return job
@@ -0,0 +1,171 @@
+"""
+Sources of urls to profile, read lazily so that large lists never have to
+be held in memory, and stable sharding of urls across profiling nodes.
+
+`url_sources` in the config is a list of sources, each a mapping with one
+of these keys:
+
+    file: a text file with one url per line, or JSON lines holding any
+        form of `urls` entry (a url, a [url, login_first] list or a
+        mapping with a `url` key)
+    sitemap: the path or http(s) url of a sitemap.xml (gzipped if it ends
+        in .gz), parsed incrementally; sitemap indexes are followed
+    course_ids: a file with one course id per line, or a list of ids; only
+        ids matching the `match` glob (default *) are used, each put into
+        `url_template` as {course_id}
+
+Any other keys of a source (e.g. `login_first` or `samples`) apply to
+every url it yields.
+"""
+
+import fnmatch
+import gzip
+import hashlib
+import json
+from xml.etree import cElementTree
+import zlib
+
+import requests
+
+SOURCE_KEYS = ('file', 'sitemap', 'course_ids', 'match', 'url_template')
+
+
+def shard_of(url, shard_count):
+    """
+    The shard a url belongs to. The hash is stable across processes and
+    machines, so every node assigns every url to the same shard.
+    """
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return int(digest[:15], 16) % shard_count
+
+
+def read_url_file(path):
+    """
+    Yields the `urls` entries of a text or JSON lines file. Blank lines and
+    lines starting with # are skipped.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line[0] in '{["':
+                yield json.loads(line)
+            else:
+                yield line.decode('utf-8')
+
+
+class GunzipStream(object):
+    """
+    Decompresses a gzipped stream as it is read; gzip.GzipFile needs to
+    seek, which a streamed http response can't.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=16384):
+        data = ''
+        while not data:
+            chunk = self.stream.read(size)
+            if not chunk:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(chunk)
+        return data
+
+
+def _open_sitemap(location):
+    if location.startswith(('http://', 'https://')):
+        response = requests.get(location, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        stream = response.raw
+        if location.endswith('.gz'):
+            stream = GunzipStream(stream)
+        return stream
+    if location.endswith('.gz'):
+        return gzip.open(location, 'rb')
+    return open(location, 'rb')
+
+
+def read_sitemap(location):
+    """
+    Yields the page urls of a sitemap, following sitemap indexes. Each
+    element is discarded once read, so memory use doesn't grow with the
+    size of the sitemap.
+    """
+    stream = _open_sitemap(location)
+    try:
+        root = None
+        children = []
+        for event, element in cElementTree.iterparse(
+                stream, events=('start', 'end')):
+            if root is None:
+                root = element
+                continue
+            if event != 'end' or element.tag.split('}')[-1] != 'loc':
+                continue
+            loc = (element.text or '').strip()
+            if root.tag.endswith('sitemapindex'):
+                children.append(loc)
+            elif loc:
+                yield loc
+            root.clear()
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+    for child in children:
+        for url in read_sitemap(child):
+            yield url
+
+
+def read_course_ids(source):
+    """
+    Yields a url for every course id of a `course_ids` source that matches
+    its `match` glob.
+    """
+    course_ids = source['course_ids']
+    if isinstance(course_ids, basestring):
+        course_ids = read_url_file(course_ids)
+    pattern = source.get('match') or '*'
+    for course_id in course_ids:
+        if fnmatch.fnmatchcase(course_id, pattern):
+            yield source['url_template'].format(course_id=course_id)
+
+
+def read_source(source):
+    """
+    Yields the `urls` entries of one of `url_sources`.
+    """
+    if 'file' in source:
+        entries = read_url_file(source['file'])
+    elif 'sitemap' in source:
+        entries = read_sitemap(source['sitemap'])
+    elif 'course_ids' in source:
+        entries = read_course_ids(source)
+    else:
+        raise ValueError('url source needs file, sitemap or course_ids')
+
+    options = dict(
+        (key, value) for key, value in source.items()
+        if key not in SOURCE_KEYS
+    )
+    for entry in entries:
+        if options and isinstance(entry, basestring):
+            entry = dict(options, url=entry)
+        elif options and isinstance(entry, dict):
+            entry = dict(options, **entry)
+        yield entry
+
+
+def iter_url_configs(config):
+    """
+    Yields the `urls` entries of the config, then those of its
+    `url_sources`.
+    """
+    for url_config in config.get('urls') or []:
+        yield url_config
+    for source in config.get('url_sources') or []:
+        for url_config in read_source(source):
+            yield url_config
@@ -0,0 +1,173 @@
+"""
+A durable record of HAR uploads: those that failed and when to retry them,
+and a ledger of those harstorage has confirmed.
+
+Each HAR that fails to upload with a transient error gets a row with its
+number of attempts, the time of its next retry and the last error. Retries
+back off exponentially, with jitter, so that after a harstorage outage the
+backlog drains gradually instead of every file being retried at once.
+
+Uploaded HARs are recorded by the SHA-256 of their content, so a file that
+shows up again (e.g. copied back into the HAR directory, or left behind
+when moving it to completed_uploads failed) isn't stored twice.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_RETRY_DELAY = 60
+DEFAULT_MAX_RETRY_DELAY = 6 * 3600
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS spool (
+        name TEXT PRIMARY KEY,
+        attempts INTEGER NOT NULL,
+        next_retry REAL NOT NULL,
+        last_error TEXT,
+        first_failure REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS spool_next_retry ON spool (next_retry);
+    CREATE TABLE IF NOT EXISTS uploaded (
+        sha256 TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        uploaded REAL NOT NULL
+    );
+"""
+
+
+class Spool:
+    """
+    SQLite tables of failed uploads, keyed by file name like the catalog,
+    and of uploaded content hashes.
+
+    A Spool can be shared between threads.
+    """
+
+    def __init__(self, db_path, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY,
+                 max_retry_delay=DEFAULT_MAX_RETRY_DELAY, clock=time.time):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            db_path, timeout=30, check_same_thread=False
+        )
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def backoff(self, attempts):
+        """
+        Seconds to wait after the given number of failed attempts: the
+        delay doubles with every attempt up to `max_retry_delay`, and a
+        random half of it is taken off so retries spread out.
+        """
+        delay = min(
+            self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay
+        )
+        return random.uniform(delay / 2.0, delay)
+
+    def due(self, paths):
+        """
+        Splits `paths` into the files to upload now and the files still
+        waiting for their next retry. Files to upload are ordered with new
+        files first, then retries by how long they have been due.
+        """
+        now = self.clock()
+        with self.lock:
+            rows = dict(
+                (row['name'], row['next_retry'])
+                for row in self.conn.execute(
+                    'SELECT name, next_retry FROM spool'
+                )
+            )
+        ready, waiting = [], []
+        for path in paths:
+            next_retry = rows.get(os.path.basename(path))
+            if next_retry is not None and next_retry > now:
+                waiting.append(path)
+            else:
+                ready.append((next_retry or 0, path))
+        return [path for _, path in sorted(ready)], waiting
+
+    def get(self, path):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT * FROM spool WHERE name = ?',
+                (os.path.basename(path),)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def failed(self, path, error):
+        """
+        Records a failed attempt and schedules the next retry. Returns the
+        number of attempts so far.
+        """
+        name = os.path.basename(path)
+        now = self.clock()
+        with self.lock:
+            with self.conn:
+                row = self.conn.execute(
+                    'SELECT attempts, first_failure FROM spool '
+                    'WHERE name = ?', (name,)
+                ).fetchone()
+                attempts = row['attempts'] + 1 if row else 1
+                first_failure = row['first_failure'] if row else now
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO spool (name, attempts, '
+                    'next_retry, last_error, first_failure) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (name, attempts, now + self.backoff(attempts),
+                     error, first_failure)
+                )
+        return attempts
+
+    def exhausted(self, attempts):
+        return attempts >= self.max_attempts
+
+    def remove(self, path):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'DELETE FROM spool WHERE name = ?',
+                    (os.path.basename(path),)
+                )
+
+    def uploaded_as(self, digest):
+        """
+        Returns the name the content with this digest was uploaded as, or
+        None if it hasn't been.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT name FROM uploaded WHERE sha256 = ?', (digest,)
+            ).fetchone()
+        return row['name'] if row is not None else None
+
+    def record_upload(self, digest, path, uploaded=None):
+        """
+        Adds confirmed content to the ledger. Returns False if it was
+        already there.
+        """
+        with self.lock:
+            with self.conn:
+                cursor = self.conn.execute(
+                    'INSERT OR IGNORE INTO uploaded (sha256, name, uploaded) '
+                    'VALUES (?, ?, ?)',
+                    (digest, os.path.basename(path),
+                     uploaded if uploaded is not None else self.clock())
+                )
+        return cursor.rowcount == 1
@@ -0,0 +1,125 @@
+"""
+Summary statistics for page load metrics taken from HAR files.
+"""
+
+import math
+
+
+METRICS = ('onContentLoad', 'onLoad', 'bytes', 'requests')
+
+
+def entry_bytes(entry):
+    """
+    Bytes transferred for one HAR entry: response headers plus body. Sizes
+    the proxy didn't record (-1) count as 0.
+    """
+    response = entry['response']
+    return (max(response.get('headersSize', 0), 0) +
+            max(response.get('bodySize', 0), 0))
+
+
+def har_metrics(har):
+    """
+    Returns the page timings, total transferred bytes and request count of
+    the first page in a HAR. Timings the HAR doesn't have are None.
+    """
+    log = har['log']
+    timings = log['pages'][0].get('pageTimings', {}) if log['pages'] else {}
+    return {
+        'onContentLoad': timings.get('onContentLoad'),
+        'onLoad': timings.get('onLoad'),
+        'bytes': sum(entry_bytes(entry) for entry in log['entries']),
+        'requests': len(log['entries']),
+    }
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0-100) of values, interpolating linearly
+    between the closest ranks.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    low = int(math.floor(rank))
+    high = int(math.ceil(rank))
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def mean(values):
+    return float(sum(values)) / len(values) if values else None
+
+
+def stddev(values):
+    """
+    Sample standard deviation; 0 for fewer than two values.
+    """
+    if len(values) < 2:
+        return 0.0
+    avg = mean(values)
+    return math.sqrt(
+        sum((v - avg) ** 2 for v in values) / (len(values) - 1)
+    )
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    return {
+        'count': len(values),
+        'mean': mean(values),
+        'median': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p95': percentile(values, 95),
+        'stddev': stddev(values),
+        'min': min(values) if values else None,
+        'max': max(values) if values else None,
+    }
+
+
+def summarize_metrics(samples):
+    """
+    Summarizes a list of har_metrics() dicts, metric by metric.
+    """
+    return dict(
+        (metric, summarize([sample[metric] for sample in samples]))
+        for metric in METRICS
+    )
+
+
+def mann_whitney_u(baseline, current):
+    """
+    One-sided Mann-Whitney U test of whether `current` values tend to be
+    larger than `baseline` values. Returns the p-value from the normal
+    approximation (with tie correction), or None if either side has no
+    values.
+    """
+    n1, n2 = len(baseline), len(current)
+    if not n1 or not n2:
+        return None
+
+    combined = sorted(
+        [(v, 0) for v in baseline] + [(v, 1) for v in current]
+    )
+    ranks = [0.0] * len(combined)
+    ties = 0.0
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        size = j - i + 1
+        ties += size ** 3 - size
+        i = j + 1
+
+    rank_sum = sum(r for r, (v, group) in zip(ranks, combined) if group)
+    u = rank_sum - n2 * (n2 + 1) / 2.0
+    n = n1 + n2
+    variance = n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    # continuity-corrected z score for U being larger than expected
+    z = (u - n1 * n2 / 2.0 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
@@ -7,21 +7,132 @@ Send HAR files to a HarStorage server via HTTP POST.
 import argparse
 from collections import Counter
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
+import shutil
+import signal
+import tempfile
+import threading
 import urlparse
+import uuid
+import zlib
 
 import requests
 
+from harblobs import BlobStore
+from harcatalog import Catalog
+from harfiles import (
+    find_har_files, har_digest, har_size, is_har_file, load_har, open_har,
+    write_har
+)
+from harmetrics import metrics
+from harspool import DEFAULT_MAX_ATTEMPTS, Spool
+
 logging.basicConfig(format="%(levelname)s [%(name)s] %(message)s")
 log = logging.getLogger('haruploader')
 log.setLevel(logging.INFO)
 
+CHUNK_SIZE = 64 * 1024
+DEFAULT_WATCH_INTERVAL = 5
+# gzipped HARs this big or bigger are uploaded as a form instead
+MAX_STREAM_SIZE = 2 ** 32
+
+
+class StreamingUpload(object):
+    """
+    File-like multipart/form-data body that sends a har file as the `file`
+    field without reading the whole file into memory.
+
+    harstorage accepts the `file` field either urlencoded or as a multipart
+    file upload. Gzipped hars are decompressed as they are read. With
+    compress=True the body is gzipped on the fly and sent with
+    `Content-Encoding: gzip`, which the harstorage server (or a proxy in
+    front of it) has to support.
+    """
+
+    def __init__(self, filepath, compress=False, size=None):
+        self.filepath = filepath
+        self.compress = compress
+        boundary = uuid.uuid4().hex
+        filename = os.path.basename(filepath)
+        if filename.endswith('.gz'):
+            filename = filename[:-len('.gz')]
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            boundary
+        )
+        self.head = (
+            '--{}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="{}"\r\n'
+            'Content-Type: application/json\r\n\r\n'
+        ).format(boundary, filename)
+        self.tail = '\r\n--{}--\r\n'.format(boundary)
+
+        # requests sends a Content-Length when it knows `len`, otherwise
+        # it falls back to a chunked transfer, which WSGI servers such as
+        # harstorage's don't decode; only a body gzipped on the fly has no
+        # length known in advance
+        if compress:
+            self.len = None
+        else:
+            if size is None:
+                size = har_size(filepath)
+            self.len = len(self.head) + size + len(self.tail)
+
+        self._chunks = self._gzip() if compress else self._parts()
+        self._buffer = ''
+
+    def _parts(self):
+        yield self.head
+        with open_har(self.filepath) as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                yield chunk
+        yield self.tail
+
+    def _gzip(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for part in self._parts():
+            chunk = compressor.compress(part)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def __iter__(self):
+        for chunk in iter(lambda: self.read(CHUNK_SIZE), ''):
+            yield chunk
+
 
 class Uploader:
 
-    def __init__(self, path, url):
+    def __init__(self, path, url, workers=1, stream=False, compress=False,
+                 catalog=None, spool=None, blobs=None):
         self.path = os.path.realpath(path)
         self.url = urlparse.urljoin(url, '/results/upload')
+        self.workers = max(workers, 1)
+        self.stream = stream or compress
+        self.compress = compress
+        self.catalog = catalog
+        self.spool = spool
+        self.blobs = blobs
+
+        # one keep-alive connection per upload thread
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.workers
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def _save_file(self, filepath):
         """
@@ -29,6 +140,9 @@ class Uploader:
 
         If the requests lib raises an exception, we will leave the file in
         the folder to be retried later. The error will still be logged though.
+        With a spool, the retry waits for a backoff that grows with every
+        attempt, and after the spool's maximum number of attempts the file is
+        put in the failed folder instead.
         These exceptions include:
             * requests.exceptions.ConnectionError
             * requests.exceptions.TooManyRedirects
@@ -39,42 +153,116 @@ class Uploader:
         If any other exception is raised, we will put the file in another
         folder.  It will not be retried, assuming the cause in this case is a
         poorly formatted har file.
+
+        With a spool, content it has a record of uploading is not sent
+        again; the file goes straight to the completed folder.
         """
 
         basename = os.path.basename(filepath)
-        headers = {
-            "Content-type": "application/x-www-form-urlencoded",
-            "Automated": "true",
-        }
 
+        digest = uploaded_as = None
         try:
-            with open(filepath) as f:
-                data = {'file': f.read()}
-                resp = requests.post(self.url, data=data, headers=headers)
-
-                # Raise exception if 4XX or 5XX response code is returned
-                # The exception raised here will be a subclass or instance
-                # of requests.exceptions.RequestException.
-                resp.raise_for_status()
-
-                # Raise exception if response code is OK but response
-                # text doesn't indicate success. This seems to happen
-                # when the file isn't formatted exactly as expected.
-                # e.g. 'KeyError: timings'
-                if resp.text != 'Successful':
-                    raise Exception(resp.text)
+            # Hashing reads the whole file, so a corrupt or truncated HAR
+            # fails here like any other bad upload.
+            if self.spool is not None:
+                digest = har_digest(filepath)
+                uploaded_as = self.spool.uploaded_as(digest)
+            if uploaded_as is not None:
+                log.info("{}: already uploaded as {}, skipping".format(
+                    basename, uploaded_as
+                ))
+                self._move_file(filepath, 'success')
+                return 3
+
+            with metrics.timer('upload'):
+                resp = self._post(filepath)
+
+            # Raise exception if 4XX or 5XX response code is returned
+            # The exception raised here will be a subclass or instance
+            # of requests.exceptions.RequestException.
+            resp.raise_for_status()
+
+            # Raise exception if response code is OK but response
+            # text doesn't indicate success. This seems to happen
+            # when the file isn't formatted exactly as expected.
+            # e.g. 'KeyError: timings'
+            if resp.text != 'Successful':
+                raise Exception(resp.text)
         except requests.exceptions.RequestException as e:
             log.info("{}: {}".format(basename, e.message))
-            return 2
+            return self._retry_later(filepath, e)
         except Exception as e:
             log.info("{}: {}".format(basename, e.message))
             self._move_file(filepath, 'failed')
             return 1
         else:
             log.info("{}: Successful".format(basename))
+            if digest is not None:
+                self.spool.record_upload(digest, filepath)
             self._move_file(filepath, 'success')
             return 0
 
+    def _retry_later(self, filepath, error):
+        if self.spool is not None:
+            attempts = self.spool.failed(filepath, str(error))
+            if self.spool.exhausted(attempts):
+                log.warning("{}: giving up after {} attempts".format(
+                    os.path.basename(filepath), attempts
+                ))
+                self._move_file(filepath, 'failed')
+                return 1
+        if self.catalog is not None:
+            self.catalog.set_upload_status(filepath, 'retry')
+        return 2
+
+    def _post(self, filepath):
+        if self.blobs is None:
+            return self._post_one(filepath)
+
+        # put the response bodies back into a temporary copy, so that
+        # harstorage gets a standard HAR
+        tmp_dir = tempfile.mkdtemp(prefix='haruploader-')
+        try:
+            har = load_har(filepath)
+            self.blobs.rehydrate(har)
+            name = os.path.basename(filepath)
+            if name.endswith('.gz'):
+                name = name[:-len('.gz')]
+            tmp_path = os.path.join(tmp_dir, name)
+            write_har(har, tmp_path, 'compact')
+            del har
+            return self._post_one(tmp_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _post_one(self, filepath):
+        if not self.stream:
+            return self._post_form(filepath)
+        size = None if self.compress else har_size(filepath)
+        if (size is not None and size >= MAX_STREAM_SIZE and
+                filepath.endswith('.gz')):
+            return self._post_form(filepath)
+        return self._post_stream(filepath, size)
+
+    def _post_form(self, filepath):
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Automated": "true",
+        }
+        with open_har(filepath) as f:
+            data = {'file': f.read()}
+            return self.session.post(self.url, data=data, headers=headers)
+
+    def _post_stream(self, filepath, size=None):
+        body = StreamingUpload(filepath, self.compress, size)
+        headers = {
+            "Content-type": body.content_type,
+            "Automated": "true",
+        }
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+        return self.session.post(self.url, data=body, headers=headers)
+
     def _move_file(self, filepath, dest):
         base_dir = os.path.dirname(filepath)
 
@@ -84,39 +272,227 @@ class Uploader:
         }
 
         if not os.path.isdir(dirs[dest]):
-            os.makedirs(dirs[dest])
+            try:
+                os.makedirs(dirs[dest])
+            except OSError:
+                # another upload worker made it first
+                if not os.path.isdir(dirs[dest]):
+                    raise
 
+        status = dest
         dest = os.path.join(dirs[dest], os.path.basename(filepath))
         os.rename(filepath, dest)
+        if self.spool is not None:
+            self.spool.remove(filepath)
+        if self.catalog is not None:
+            self.catalog.set_upload_status(filepath, status, dest)
 
-    def upload_hars(self):
-        log.info(
-            "Uploading har files from {} to {}".format(self.path, self.url)
-        )
-        results = Counter()
-
+    def find_files(self):
+        """
+        Returns the HAR files to upload now, and those waiting for their next
+        retry.
+        """
         if os.path.isfile(self.path):
-            results.update([
-                self._save_file(self.path, self.url)
-            ])
+            filepaths = [self.path]
         elif os.path.isdir(self.path):
-            for f in os.listdir(self.path):
-                if f.endswith('.har'):
-                    results.update([
-                        self._save_file(os.path.join(self.path, f))
-                    ])
+            filepaths = [
+                os.path.join(self.path, f)
+                for f in os.listdir(self.path) if is_har_file(f)
+            ]
         else:
             raise Exception(
                 "Can't find file or directory {}".format(self.path)
             )
 
+        waiting = []
+        if self.spool is not None:
+            filepaths, waiting = self.spool.due(filepaths)
+        return filepaths, waiting
+
+    def log_results(self, results, waiting=0):
         log.info(
             'Done.'
             '\n{} files successfully uploaded.'
             '\n{} files failed to upload and will not be retried.'
             '\n{} files failed to upload and will be retried next run.'
-            ''.format(results[0], results[1], results[2])
+            '\n{} files are waiting for their next retry.'
+            '\n{} files were already uploaded and were skipped.'
+            ''.format(results[0], results[1], results[2], waiting,
+                      results[3])
+        )
+
+    def upload_hars(self):
+        log.info(
+            "Uploading har files from {} to {}".format(self.path, self.url)
         )
+        results = Counter()
+        filepaths, waiting = self.find_files()
+
+        if self.workers > 1 and len(filepaths) > 1:
+            pool = ThreadPool(self.workers)
+            try:
+                results.update(pool.imap_unordered(self._save_file, filepaths))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results.update(self._save_file(f) for f in filepaths)
+
+        self.log_results(results, len(waiting))
+
+    def reconcile(self):
+        """
+        Adds every HAR in completed_uploads/ to the spool's ledger of
+        uploaded content, e.g. for files uploaded before there was a
+        ledger. Returns the number of files added and already known.
+        """
+        base_dir = (
+            os.path.dirname(self.path) if os.path.isfile(self.path)
+            else self.path
+        )
+        completed = os.path.join(base_dir, 'completed_uploads')
+        added = known = 0
+        if os.path.isdir(completed):
+            for filepath in find_har_files(completed):
+                if self.spool.record_upload(
+                        har_digest(filepath), filepath,
+                        os.path.getmtime(filepath)):
+                    added += 1
+                else:
+                    known += 1
+        log.info(
+            'reconciled {}: {} files added to the ledger, {} already '
+            'in it'.format(completed, added, known)
+        )
+        return added, known
+
+
+class UploadPipeline:
+    """
+    Uploads HAR files in background threads as they are submitted, so that
+    uploading overlaps with profiling instead of waiting for it to finish.
+
+    Each file is queued at most once at a time; the uploader's workers set
+    the number of upload threads.
+    """
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.results = Counter()
+        self.threads = []
+        for _ in range(uploader.workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, filepath):
+        """
+        Queues a HAR file for upload. Returns False if it is already queued
+        or being uploaded.
+        """
+        filepath = os.path.realpath(filepath)
+        with self.lock:
+            if filepath in self.pending:
+                return False
+            self.pending.add(filepath)
+        self.queue.put(filepath)
+        return True
+
+    def sweep(self):
+        """
+        Queues every HAR file that is due, e.g. files left by an earlier run
+        or retries whose backoff has passed.
+        """
+        filepaths, _ = self.uploader.find_files()
+        for filepath in filepaths:
+            self.submit(filepath)
+
+    def poll(self, seen):
+        """
+        Queues the due HAR files whose size and modification time are the
+        same as in `seen`, the result of the previous poll, so that files
+        still being written aren't uploaded half finished. Returns the
+        sizes and times for the next poll.
+        """
+        current = {}
+        filepaths, _ = self.uploader.find_files()
+        for filepath in filepaths:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                # uploaded and moved away since it was listed
+                continue
+            current[filepath] = (stat.st_size, stat.st_mtime)
+            if seen.get(filepath) == current[filepath]:
+                self.submit(filepath)
+        return current
+
+    def watch(self, interval=DEFAULT_WATCH_INTERVAL, stopped=None):
+        """
+        Polls the uploader's directory for new HAR files every `interval`
+        seconds, until `stopped` (a threading.Event) is set.
+        """
+        stopped = stopped or threading.Event()
+        log.info("Watching {} for har files to upload to {}".format(
+            self.uploader.path, self.uploader.url
+        ))
+        seen = {}
+        while not stopped.is_set():
+            seen = self.poll(seen)
+            stopped.wait(interval)
+
+    def _run(self):
+        while True:
+            filepath = self.queue.get()
+            if filepath is None:
+                return
+            try:
+                # another sweep may have uploaded it in the meantime
+                if os.path.isfile(filepath):
+                    result = self.uploader._save_file(filepath)
+                    with self.lock:
+                        self.results[result] += 1
+            except Exception:
+                log.exception("{}: upload failed".format(
+                    os.path.basename(filepath)
+                ))
+            finally:
+                with self.lock:
+                    self.pending.discard(filepath)
+
+    def close(self):
+        """
+        Uploads the files still queued, then stops the upload threads.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.uploader.log_results(self.results)
+
+
+def watch(uploader, interval=DEFAULT_WATCH_INTERVAL):
+    """
+    Uploads new HAR files as they appear until SIGTERM or SIGINT.
+    """
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        log.info('stopping once the queued uploads are done')
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    pipeline = UploadPipeline(uploader)
+    try:
+        pipeline.watch(interval, stopped)
+    finally:
+        pipeline.close()
 
 
 def main():
@@ -128,6 +504,25 @@ def main():
 
     Options:
         --url = URL of harstorage instance (default: 'http://localhost:5000')
+        --workers = Number of files to upload concurrently (default: 1)
+        --stream = Stream files as multipart uploads instead of reading
+                   them into memory
+        --gzip = Gzip the streamed request bodies (implies --stream)
+        --catalog = Path to a harcatalog database to record upload status in
+        --spool = Path to a database of failed uploads, to retry them with
+                  backoff
+        --max-attempts = Attempts before a file is moved to failed_uploads
+                         when using a spool (default: 8)
+        --blob-dir = Blob store to put response bodies back into HARs from
+                     before uploading them
+        --reconcile = Add the files in completed_uploads to the spool's
+                      ledger of uploaded content before uploading
+        --metrics-file = Path to write upload timings to, in the Prometheus
+                         text format
+        --watch = Keep running, uploading new HAR files as they appear in the
+                  directory
+        --interval = Seconds between checks for new files with --watch
+                     (default: 5)
 
     Example:
         python haruploader.py /path/to/HAR/file.har --url http://127.0.0.1:8000
@@ -147,10 +542,96 @@ def main():
         default='http://localhost:5000',
         help="URL of harstorage instance (default: 'http://localhost:5000')"
     )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help="Number of files to upload concurrently (default: 1)"
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help="Stream files as multipart uploads instead of reading them "
+             "into memory"
+    )
+    parser.add_argument(
+        '--gzip',
+        action='store_true',
+        help="Gzip the streamed request bodies (implies --stream)"
+    )
+    parser.add_argument(
+        '--catalog',
+        help="Path to a harcatalog database to record upload status in"
+    )
+    parser.add_argument(
+        '--spool',
+        help="Path to a database of failed uploads, to retry them with "
+             "backoff"
+    )
+    parser.add_argument(
+        '--max-attempts',
+        default=DEFAULT_MAX_ATTEMPTS,
+        type=int,
+        help="Attempts before a file is moved to failed_uploads when using "
+             "a spool (default: 8)"
+    )
+    parser.add_argument(
+        '--blob-dir',
+        help="Blob store to put response bodies back into HARs from before "
+             "uploading them"
+    )
+    parser.add_argument(
+        '--reconcile',
+        action='store_true',
+        help="Add the files in completed_uploads to the spool's ledger of "
+             "uploaded content before uploading"
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help="Path to write upload timings to, in the Prometheus text format"
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help="Keep running, uploading new HAR files as they appear in the "
+             "directory"
+    )
+    parser.add_argument(
+        '--interval',
+        default=DEFAULT_WATCH_INTERVAL,
+        type=float,
+        help="Seconds between checks for new files with --watch (default: 5)"
+    )
     args = parser.parse_args()
+    if args.reconcile and not args.spool:
+        parser.error('--reconcile needs --spool')
+    if args.watch and not os.path.isdir(args.harpath):
+        parser.error('--watch needs a directory')
 
-    uploader = Uploader(args.harpath, args.url)
-    uploader.upload_hars()
+    catalog = Catalog(args.catalog) if args.catalog else None
+    spool = Spool(args.spool, args.max_attempts) if args.spool else None
+    if args.watch and spool is None:
+        # without a spool, a failing file would be retried on every check
+        spool = Spool(':memory:', args.max_attempts)
+    blobs = BlobStore(args.blob_dir) if args.blob_dir else None
+    uploader = Uploader(
+        args.harpath, args.url, args.workers, args.stream, args.gzip, catalog,
+        spool, blobs
+    )
+    try:
+        if args.reconcile:
+            uploader.reconcile()
+        if args.watch:
+            watch(uploader, args.interval)
+        else:
+            uploader.upload_hars()
+    finally:
+        if catalog is not None:
+            catalog.close()
+        if spool is not None:
+            spool.close()
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file, 'haruploader')
 
 
 if __name__ == "__main__":
@@ -1,17 +1,40 @@
 #!/usr/bin/env python
 
+from contextlib import contextmanager
+import cgi
 import glob
+import gzip
+import json
 import logging
 import os
+import re
 import shutil
+import socket
+import subprocess
+import threading
+import time
 import unittest
 import uuid
+import wsgiref.simple_server
 
 from httmock import urlmatch, HTTMock
 import requests
+from selenium.webdriver.common.proxy import Proxy
+from StringIO import StringIO
 import yaml
 
+import benchmark
+import haranalyze
+import harblobs
+import harcatalog
+import harcompare
+import harfiles
+import harmetrics
 import harprofiler
+import harscheduler
+import harsources
+import harspool
+import harstats
 import haruploader
 
 
@@ -19,6 +42,11 @@ import haruploader
 loggers = [
     logging.getLogger('haruploader'),
     logging.getLogger('harprofiler'),
+    logging.getLogger('haranalyze'),
+    logging.getLogger('harcatalog'),
+    logging.getLogger('harcompare'),
+    logging.getLogger('harblobs'),
+    logging.getLogger('benchmark'),
 ]
 
 for log in loggers:
@@ -71,6 +99,21 @@ class ProfilerTest(unittest.TestCase):
         slug = profiler.slugify(url)
         self.assertEqual(slug, expected_slug)
 
+    def test_har_names_never_collide(self):
+        url = 'https://www.edx.org/'
+        config = yaml.load(file('test_config.yaml'))
+        names = set()
+        for worker in [None, None, 0, 1]:
+            profiler = harprofiler.HarProfiler(config, url, worker=worker)
+            names.update([profiler.har_name, profiler.cached_har_name])
+        self.assertEqual(len(names), 8)
+
+    def test_worker_har_name(self):
+        url = 'https://www.edx.org/'
+        config = yaml.load(file('test_config.yaml'))
+        profiler = harprofiler.HarProfiler(config, url, worker=3)
+        self.assertTrue(profiler.har_name.endswith('-w3.har'))
+
     def test_default_config(self):
         cfg = yaml.load(file('test_config.yaml'))
         self.assertEqual(
@@ -83,6 +126,236 @@ class ProfilerTest(unittest.TestCase):
         self.assertEqual(cfg['virtual_display_size_y'], 768)
 
 
+class FakeElement(object):
+    def __init__(self, driver):
+        self.driver = driver
+
+    def send_keys(self, keys):
+        self.driver.actions.append(('send_keys', keys))
+
+    def clear(self):
+        self.driver.actions.append(('clear',))
+
+    def click(self):
+        self.driver.actions.append(('click',))
+
+    def submit(self):
+        if FakeDriver.login_fails:
+            return
+        self.driver.current_url = 'https://courses.edx.org/dashboard'
+        self.driver.cookies = [{
+            'name': 'sessionid', 'value': 'abc', 'domain': '.edx.org',
+            'expiry': self.driver.cookie_expiry, 'sameSite': 'None',
+        }]
+
+
+class FakeDriver(object):
+    """
+    Stands in for a selenium webdriver in tests that don't need a browser.
+    """
+    # urls the next get() calls land on instead, e.g. a login redirect;
+    # None for no redirect
+    redirects = []
+    # url: exception that loading it raises
+    errors = {}
+    # whether submitting the login form leaves the browser on the login page
+    login_fails = False
+    cookie_expiry = 4102444800
+    CONTEXT_CHROME = 'chrome'
+
+    def __init__(self):
+        self.urls = []
+        self.cookies = []
+        self.current_url = None
+        self.quit_called = False
+        self.contexts = []
+        self.actions = []
+        self.timeouts = {}
+
+    @contextmanager
+    def context(self, context):
+        self.contexts.append(context)
+        yield
+
+    def get(self, url):
+        self.urls.append(url)
+        if url in FakeDriver.errors:
+            raise FakeDriver.errors[url]
+        self.current_url = url
+        if FakeDriver.redirects:
+            self.current_url = FakeDriver.redirects.pop(0) or url
+
+    def find_element_by_css_selector(self, selector):
+        self.actions.append(('find', selector))
+        return FakeElement(self)
+
+    def get_cookies(self):
+        return self.cookies
+
+    def add_cookie(self, cookie):
+        self.cookies.append(cookie)
+
+    def execute_script(self, script):
+        return {
+            'navigation': {
+                'navigationStart': 1000,
+                'domContentLoadedEventEnd': 1200,
+                'loadEventEnd': 1500,
+            },
+            'resources': [
+                {'name': 'https://www.edx.org/app.js', 'duration': 20.5},
+            ],
+            'paint': {'first-paint': 150.25},
+        }
+
+    def execute_async_script(self, script):
+        self.actions.append(('execute_async_script',))
+
+    def execute_cdp_cmd(self, cmd, args):
+        self.actions.append((cmd, args))
+
+    def set_page_load_timeout(self, seconds):
+        self.timeouts['page_load'] = seconds
+
+    def set_script_timeout(self, seconds):
+        self.timeouts['script'] = seconds
+
+    def quit(self):
+        self.quit_called = True
+
+
+class FakeProxy(object):
+    """
+    Stands in for a browsermob proxy client.
+    """
+    host = 'http://fakeproxy'
+    port = 8081
+
+    def __init__(self):
+        self.ref = None
+        self.har_options = None
+        self.closed = False
+        self.limit_options = None
+        self.rules = []
+
+    def limits(self, options):
+        self.limit_options = options
+
+    def whitelist(self, regexp, status_code):
+        self.rules.append(('whitelist', regexp, status_code))
+
+    def blacklist(self, regexp, status_code):
+        self.rules.append(('blacklist', regexp, status_code))
+
+    def rewrite_url(self, match, replace):
+        self.rules.append(('rewrite', match, replace))
+
+    def selenium_proxy(self):
+        return Proxy({
+            'httpProxy': 'localhost:8081', 'sslProxy': 'localhost:8081'
+        })
+
+    def new_har(self, ref=None, options=None):
+        self.ref = ref
+        self.har_options = options
+        self.pages = [ref]
+
+    def new_page(self, ref=None, title=None):
+        self.pages.append(ref)
+
+    @property
+    def har(self):
+        return {'log': {
+            'pages': [{'id': ref, 'pageTimings': {}} for ref in self.pages],
+            'entries': [
+                {'response': {'headersSize': 100, 'bodySize': 1000}},
+                {'response': {'headersSize': 100, 'bodySize': -1}},
+            ],
+        }}
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.proxies = []
+
+    def create_proxy(self, params=None):
+        proxy = FakeProxy()
+        self.proxies.append(proxy)
+        return proxy
+
+    def stop(self):
+        pass
+
+
+def fake_webdriver(profiler):
+    return FakeDriver(), profiler.server.create_proxy()
+
+
+class BrowserLauncherTest(unittest.TestCase):
+    def setUp(self):
+        original = harprofiler.webdriver.Firefox
+        harprofiler.webdriver.Firefox = (
+            lambda firefox_profile, options: (firefox_profile, options)
+        )
+        self.addCleanup(
+            setattr, harprofiler.webdriver, 'Firefox', original
+        )
+
+    def test_profiles_are_cloned_from_template(self):
+        launcher = harprofiler.BrowserLauncher({
+            'headless': True,
+            'firefox_preferences': {'browser.cache.disk.capacity': 1234},
+            # the fake Firefox above returns its arguments, not a driver
+            'page_load_timeout': None,
+            'script_timeout': None,
+        })
+        self.addCleanup(launcher.close)
+        profile1, options = launcher.start(FakeProxy())
+        template = launcher.template.path
+        profile2, _ = launcher.start(FakeProxy())
+        self.assertEqual(launcher.template.path, template)
+        self.assertNotEqual(profile1.path, profile2.path)
+        self.assertNotEqual(profile1.path, template)
+        self.assertEqual(
+            profile2.default_preferences['browser.cache.disk.capacity'],
+            1234
+        )
+        self.assertEqual(
+            profile2.default_preferences['network.proxy.http'],
+            'localhost'
+        )
+        self.assertIn('-headless', options.arguments)
+        self.assertEqual(len(launcher.startup_times), 2)
+
+        launcher.close()
+        self.assertFalse(os.path.isdir(template))
+
+    def test_timeouts(self):
+        harprofiler.webdriver.Firefox = (
+            lambda firefox_profile, options: FakeDriver()
+        )
+        launcher = harprofiler.BrowserLauncher({'script_timeout': 10})
+        self.addCleanup(launcher.close)
+        driver = launcher.start(FakeProxy())
+        self.assertEqual(
+            driver.timeouts,
+            {'page_load': harprofiler.DEFAULT_PAGE_LOAD_TIMEOUT, 'script': 10}
+        )
+
+    def test_headless_skips_virtual_display(self):
+        config = yaml.load(file('test_config.yaml'))
+        config['headless'] = True
+        profiler = harprofiler.HarProfiler(config, 'https://www.edx.org/')
+        self.assertFalse(profiler.virtual_display)
+
+    def test_unknown_browser(self):
+        with self.assertRaises(ValueError):
+            harprofiler.BrowserLauncher({'browser': 'lynx'})
+
+
 class HarFileTestCase(unittest.TestCase):
     def setUp(self):
         self.config = yaml.load(file('test_config.yaml'))
@@ -103,6 +376,1343 @@ class AcceptanceTest(HarFileTestCase):
         self.assertEqual(num_hars, num_pageloads)
 
 
+class SessionTest(HarFileTestCase):
+    def setUp(self):
+        super(SessionTest, self).setUp()
+        original = harprofiler.HarProfiler._make_proxied_webdriver
+        harprofiler.HarProfiler._make_proxied_webdriver = fake_webdriver
+        self.addCleanup(
+            setattr, harprofiler.HarProfiler,
+            '_make_proxied_webdriver', original
+        )
+        self.make_proxied_webdriver = original
+
+    def test_parse_url_config(self):
+        self.assertEqual(
+            harprofiler.parse_url_config('https://www.edx.org'),
+            ('https://www.edx.org', False, {})
+        )
+        self.assertEqual(
+            harprofiler.parse_url_config(['https://www.edx.org', True]),
+            ('https://www.edx.org', True, {})
+        )
+        self.assertEqual(
+            harprofiler.parse_url_config(
+                {'url': 'https://www.edx.org', 'samples': 5}
+            ),
+            ('https://www.edx.org', False, {'samples': 5})
+        )
+
+    def test_profile_shares_server(self):
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.profile('https://www.edx.org/')
+        session.profile('https://www.edx.org/course-search')
+        self.assertEqual(session.pages, 2)
+        self.assertEqual(len(session.server.proxies), 2)
+        self.assertTrue(all(p.closed for p in session.server.proxies))
+        num_hars = len(glob.glob(os.path.join(self.test_dir, '*.har')))
+        self.assertEqual(num_hars, 4)
+
+    def test_samples_summary(self):
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        profiler = session.profile(
+            'https://www.edx.org/', options={'samples': 3}
+        )
+        num_hars = len(glob.glob(os.path.join(self.test_dir, '*-s?.har')))
+        self.assertEqual(num_hars, 6)
+
+        summary_files = glob.glob(
+            os.path.join(self.test_dir, '*-summary.json')
+        )
+        self.assertEqual(len(summary_files), 1)
+        summary = harfiles.load_har(summary_files[0])
+        self.assertEqual(summary, profiler.summary())
+        self.assertEqual(summary['samples'], 3)
+        self.assertEqual(summary['cold']['onLoad']['median'], 500)
+        self.assertEqual(summary['warm']['bytes']['mean'], 1200)
+        self.assertEqual(summary['warm']['requests']['count'], 3)
+
+    def test_profile_records_catalog(self):
+        self.config['catalog'] = os.path.join(self.test_dir, 'cat.sqlite')
+        session = harprofiler.ProfilerSession(self.config)
+        session.catalog = harcatalog.Catalog(self.config['catalog'])
+        self.addCleanup(session.catalog.close)
+        session.server = FakeServer()
+        session.profile('https://www.edx.org/')
+        rows = session.catalog.query()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(
+            [row['cached'] for row in rows], [0, 1]
+        )
+
+    def test_profile_queues_uploads(self):
+        """
+        Each HAR is submitted to the session's upload pipeline as soon as
+        it is saved.
+        """
+        submitted = []
+
+        class FakePipeline(object):
+            def submit(self, filepath):
+                submitted.append(filepath)
+
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.uploads = FakePipeline()
+        session.profile('https://www.edx.org/')
+        self.assertEqual(
+            sorted(submitted),
+            sorted(glob.glob(os.path.join(self.test_dir, '*.har')))
+        )
+        self.assertEqual(len(submitted), 2)
+
+    def test_streamed_har(self):
+        """
+        Compact HARs are streamed from the proxy to disk, with the
+        browser's timings patched into the page.
+        """
+        self.config['har_format'] = 'compact'
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+
+        @urlmatch(netloc='fakeproxy', path=r'/proxy/8081/har')
+        def proxy_mock_har(url, request):
+            return {
+                'status_code': 200,
+                'content': json.dumps(session.server.proxies[-1].har),
+            }
+
+        with HTTMock(proxy_mock_har):
+            profiler = session.profile('https://www.edx.org/')
+
+        har = harfiles.load_har(
+            os.path.join(self.test_dir, profiler.har_name)
+        )
+        page = har['log']['pages'][0]
+        self.assertEqual(page['id'], profiler.label)
+        self.assertEqual(page['pageTimings']['onLoad'], 500)
+        self.assertEqual(len(har['log']['entries']), 2)
+        self.assertEqual(profiler.results['cold'][0], {
+            'onContentLoad': 200, 'onLoad': 500, 'bytes': 1200,
+            'requests': 2,
+        })
+
+    def test_journey(self):
+        """
+        Each step of a journey is a page of one HAR, with its own timings.
+        """
+        self.config['run_cached'] = False
+        self.config['journeys'] = [{
+            'name': 'Find a course',
+            'steps': [
+                {'navigate': 'https://www.edx.org/'},
+                {'fill': '#search', 'text': 'python', 'name': 'search'},
+                {'click': '.course-card', 'wait_for': '.course-about'},
+            ],
+        }]
+        jobs = list(harprofiler.profile_jobs(
+            self.config, harprofiler.select_urls(self.config)
+        ))
+        self.assertEqual(len(jobs), 2)
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        profiler = session.profile(*jobs[1])
+
+        self.assertIsInstance(profiler, harprofiler.JourneyProfiler)
+        self.assertEqual(profiler.label, 'testprefix-find-a-course')
+        proxy = session.server.proxies[-1]
+        self.assertEqual(proxy.pages, [
+            'testprefix-find-a-course-1-navigate',
+            'testprefix-find-a-course-2-search',
+            'testprefix-find-a-course-3-click',
+        ])
+        # one browser and proxy for the whole journey
+        self.assertEqual(len(session.server.proxies), 1)
+
+        har = harfiles.load_har(
+            os.path.join(self.test_dir, profiler.har_name)
+        )
+        self.assertEqual(
+            len(glob.glob(os.path.join(self.test_dir, '*.har'))), 1
+        )
+        pages = har['log']['pages']
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0]['pageTimings']['onLoad'], 500)
+        # the fake browser never loads another document
+        self.assertEqual(pages[1]['pageTimings']['onLoad'], -1)
+        self.assertEqual(pages[2]['pageTimings']['onContentLoad'], -1)
+        for page in pages:
+            self.assertGreaterEqual(page['pageTimings']['_stepTime'], 0)
+
+    def test_journey_without_page_load_timeout(self):
+        """
+        With the page load timeout off, journey steps run unguarded.
+        """
+        self.config['run_cached'] = False
+        journey = harprofiler.journey_url_config({
+            'name': 'home', 'steps': [{'navigate': 'https://www.edx.org/'}],
+        })['journey']
+        for timeout in (None, 0):
+            self.config['page_load_timeout'] = timeout
+            session = harprofiler.ProfilerSession(self.config)
+            session.server = FakeServer()
+            profiler = session.profile(
+                'https://www.edx.org/', options={'journey': journey}
+            )
+            self.assertEqual(session.failures, [])
+            self.assertEqual(session.pages, 1)
+            self.assertIsNone(profiler._step_deadline())
+
+    def test_journey_runs_steps_in_one_browser(self):
+        driver = FakeDriver()
+        profiler = harprofiler.JourneyProfiler(
+            dict(self.config, journey=harprofiler.journey_url_config({
+                'name': 'search',
+                'steps': [
+                    {'navigate': 'https://www.edx.org/'},
+                    {'fill': '#search', 'text': 'python'},
+                    {'click': '.course-card', 'wait_for': '.course-about'},
+                    {'wait_for': '.video'},
+                ],
+            })['journey']),
+            'https://www.edx.org/', server=FakeServer()
+        )
+        for step in profiler.steps:
+            profiler._run_step(driver, step)
+        self.assertEqual(driver.urls, ['https://www.edx.org/'])
+        self.assertEqual(driver.actions, [
+            ('find', '#search'), ('clear',), ('send_keys', 'python'),
+            ('find', '.course-card'), ('click',), ('find', '.course-about'),
+            ('find', '.video'),
+        ])
+
+    def test_journey_config_errors(self):
+        for journey in [
+            {'steps': [{'navigate': 'https://www.edx.org/'}]},
+            {'name': 'empty', 'steps': []},
+            {'name': 'click first', 'steps': [{'click': 'a'}]},
+            {'name': 'two actions', 'steps': [
+                {'navigate': 'https://www.edx.org/', 'click': 'a'},
+            ]},
+            {'name': 'no text', 'steps': [
+                {'navigate': 'https://www.edx.org/'}, {'fill': '#search'},
+            ]},
+            {'name': 'no action', 'steps': [
+                {'navigate': 'https://www.edx.org/'}, {'name': 'nothing'},
+            ]},
+        ]:
+            with self.assertRaises(ValueError):
+                harprofiler.journey_url_config(journey)
+
+    def test_browser_timings(self):
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        profiler = session.profile('https://www.edx.org/')
+        har = harfiles.load_har(
+            os.path.join(self.test_dir, profiler.har_name)
+        )
+        page = har['log']['pages'][0]
+        self.assertEqual(page['pageTimings']['onContentLoad'], 200)
+        self.assertEqual(page['pageTimings']['onLoad'], 500)
+        self.assertEqual(page['pageTimings']['_firstPaint'], 150.25)
+        self.assertNotIn('_firstContentfulPaint', page['pageTimings'])
+        self.assertEqual(page['_navigationTiming']['loadEventEnd'], 1500)
+        self.assertEqual(len(page['_resourceTiming']), 1)
+
+    def test_timings_go_to_matching_page(self):
+        pages = [
+            {'id': 'first', 'pageTimings': {}},
+            {'id': 'second', 'pageTimings': {}},
+            {'id': 'third', 'pageTimings': {}},
+        ]
+        self.assertIs(harprofiler.find_page(pages, 'second'), pages[1])
+        self.assertIs(harprofiler.find_page(pages, 'missing'), pages[2])
+
+    def test_profile_jobs_sweep_network_profiles(self):
+        self.config['profiles'] = ['cable', '3g']
+        jobs = list(harprofiler.profile_jobs(self.config, [
+            'https://www.edx.org/',
+            {'url': 'https://www.edx.org/about', 'profiles': ['dsl']},
+        ]))
+        self.assertEqual(jobs, [
+            ('https://www.edx.org/', False, {'network_profile': 'cable'}),
+            ('https://www.edx.org/', False, {'network_profile': '3g'}),
+            ('https://www.edx.org/about', False, {'network_profile': 'dsl'}),
+        ])
+
+    def test_profile_jobs_without_network_profiles(self):
+        jobs = list(harprofiler.profile_jobs(
+            self.config, ['https://www.edx.org/']
+        ))
+        self.assertEqual(jobs, [('https://www.edx.org/', False, {})])
+
+    def test_network_profile_limits_proxy(self):
+        self.config['network_profiles'] = {
+            'slow': {'downstream_kbps': 100, 'latency': 500},
+        }
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        profiler = session.profile(
+            'https://www.edx.org/', options={'network_profile': 'slow'}
+        )
+        self.assertEqual(profiler.label, 'testprefix-https-www-edx-org-slow')
+        self.assertEqual(
+            profiler.cached_label, 'testprefix-https-www-edx-org-slow-cached'
+        )
+        self.assertEqual(
+            session.server.proxies[0].limit_options,
+            {'downstream_kbps': 100, 'latency': 500}
+        )
+
+    def test_proxy_rules(self):
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.profile('https://www.edx.org/', options={
+            'capture_headers': True,
+            'capture_content': False,
+            'host_whitelist': ['edx.org', '*.edx.org'],
+            'host_blacklist': ['www.google-analytics.com'],
+            'rewrite_rules': [{'match': 'cdn1', 'replace': 'cdn2'}],
+        })
+        proxy = session.server.proxies[0]
+        self.assertEqual(proxy.har_options, {
+            'captureHeaders': True, 'captureContent': False,
+        })
+        self.assertEqual(proxy.rules, [
+            ('whitelist', ','.join([
+                harprofiler.host_pattern('edx.org'),
+                harprofiler.host_pattern('*.edx.org'),
+            ]), 204),
+            ('blacklist',
+             harprofiler.host_pattern('www.google-analytics.com'), 204),
+            ('rewrite', 'cdn1', 'cdn2'),
+        ])
+
+    def test_pooled_proxy_rules(self):
+        cleared = []
+        original = harprofiler.ProxyRules.clear
+        harprofiler.ProxyRules.clear = staticmethod(
+            lambda proxy, timeout=None: cleared.append((proxy, timeout))
+        )
+        self.addCleanup(setattr, harprofiler.ProxyRules, 'clear', original)
+        self.config['browser_pool'] = True
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        blocked = {'host_blacklist': ['ads.example.com']}
+        session.profile('https://www.edx.org/', options=blocked)
+        session.profile('https://www.edx.org/about', options=blocked)
+        proxy = session.server.proxies[0]
+        self.assertEqual(len(proxy.rules), 1)
+        self.assertEqual(cleared, [])
+        session.profile('https://www.edx.org/')
+        self.assertEqual(
+            cleared, [(proxy, harprofiler.DEFAULT_HAR_FETCH_TIMEOUT)]
+        )
+        self.assertEqual(len(session.server.proxies), 1)
+
+    def test_host_pattern(self):
+        pattern = re.compile(harprofiler.host_pattern('*.edx.org'))
+        self.assertTrue(pattern.match('https://courses.edx.org/dashboard'))
+        self.assertTrue(pattern.match('courses.edx.org:443'))
+        self.assertFalse(pattern.match('https://edx.org/'))
+        self.assertFalse(pattern.match('https://a.edx.org.example.com/'))
+        self.assertFalse(pattern.match('https://example.com/?a.edx.org'))
+
+    def test_unknown_network_profile(self):
+        self.config['network_profile'] = 'carrier-pigeon'
+        with self.assertRaises(ValueError):
+            harprofiler.HarProfiler(self.config, 'https://www.edx.org/')
+
+    def test_login_once_per_session(self):
+        self.config.update({'login_user': 'u', 'login_password': 'p'})
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.profile('https://courses.edx.org/dashboard', True)
+        session.profile('https://courses.edx.org/courses', True)
+        self.assertEqual(session.login_session.logins, 1)
+        self.assertEqual(session.login_session.cookies, [{
+            'name': 'sessionid', 'value': 'abc', 'domain': '.edx.org',
+            'expiry': 4102444800,
+        }])
+
+    def test_login_again_when_redirected_to_login(self):
+        self.config.update({'login_user': 'u', 'login_password': 'p'})
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.profile('https://courses.edx.org/dashboard', True)
+        # the first get() is the cookie domain page, the second the url
+        FakeDriver.redirects = [None, 'https://courses.edx.org/login?next=/d']
+        self.addCleanup(setattr, FakeDriver, 'redirects', [])
+        session.profile('https://courses.edx.org/dashboard', True)
+        self.assertEqual(session.login_session.logins, 2)
+
+    def test_login_again_when_cookies_expire(self):
+        self.config.update({'login_user': 'u', 'login_password': 'p'})
+        login_session = harprofiler.LoginSession(self.config)
+        login_session.login(FakeDriver())
+        self.assertFalse(login_session.expired())
+        login_session.cookies[0]['expiry'] = 1
+        self.assertTrue(login_session.expired())
+        login_session.cookies[0]['expiry'] = None
+        login_session.ttl = 60
+        login_session.logged_in_at -= 61
+        self.assertTrue(login_session.expired())
+
+    def test_login_that_never_completes(self):
+        self.config.update({
+            'login_user': 'u', 'login_password': 'p', 'login_timeout': 0.1,
+        })
+        FakeDriver.login_fails = True
+        self.addCleanup(setattr, FakeDriver, 'login_fails', False)
+        login_session = harprofiler.LoginSession(self.config)
+        with self.assertRaises(RuntimeError):
+            login_session.login(FakeDriver())
+        self.assertIsNone(login_session.cookies)
+        self.assertEqual(login_session.logins, 0)
+
+    def test_login_cookie_file(self):
+        cookie_file = os.path.join(self.test_dir, 'cookies.json')
+        self.config.update({
+            'login_user': 'u',
+            'login_password': 'p',
+            'login_cookie_file': cookie_file,
+        })
+        harprofiler.LoginSession(self.config).login(FakeDriver())
+        self.assertEqual(os.stat(cookie_file).st_mode & 0o777, 0o600)
+
+        login_session = harprofiler.LoginSession(self.config)
+        self.assertFalse(login_session.expired())
+        driver = FakeDriver()
+        login_session.apply(driver)
+        self.assertEqual(login_session.logins, 0)
+        self.assertEqual(driver.urls, ['https://courses.edx.org/robots.txt'])
+        self.assertEqual(driver.cookies[0]['value'], 'abc')
+
+    def test_phases_are_timed(self):
+        harmetrics.metrics.phases.clear()
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.profile('https://www.edx.org/')
+        snapshot = harmetrics.metrics.snapshot()
+        for phase in ['page_load', 'har_fetch', 'har_save']:
+            self.assertEqual(snapshot[phase]['count'], 2)
+
+    def test_pool_reuses_browsers(self):
+        self.config.update({'browser_pool': True, 'pool_recycle_pages': 2})
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        for _ in range(3):
+            session.profile('https://www.edx.org/')
+        self.assertEqual(session.pool.started, 2)
+        self.assertEqual(session.pool.recycled, 1)
+        first, second = session.server.proxies
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertEqual(second.limit_options, harprofiler.NO_LIMITS)
+        session.pool.close()
+        self.assertTrue(second.closed)
+
+    def test_pool_resets_reused_browsers(self):
+        pool = harprofiler.BrowserPool(
+            harprofiler.BrowserLauncher({}), {}
+        )
+        driver = FakeDriver()
+        browser = pool.lease(lambda: (driver, FakeProxy()))
+        pool.release(browser)
+        self.assertIs(pool.lease(lambda: None), browser)
+        self.assertEqual(driver.urls, ['about:blank'])
+        self.assertEqual(driver.contexts, ['chrome'])
+        self.assertEqual(driver.actions, [('execute_async_script',)])
+
+    def test_chrome_reset_clears_last_origin(self):
+        launcher = harprofiler.BrowserLauncher({'browser': 'chrome'})
+        driver = FakeDriver()
+        driver.get('https://courses.edx.org/dashboard')
+        launcher.reset(driver)
+        self.assertEqual([action[0] for action in driver.actions], [
+            'Network.clearBrowserCache', 'Network.clearBrowserCookies',
+            'Storage.clearDataForOrigin',
+        ])
+        self.assertEqual(
+            driver.actions[-1][1]['origin'], 'https://courses.edx.org'
+        )
+
+    def test_pool_discards_broken_browsers(self):
+        pool = harprofiler.BrowserPool(
+            harprofiler.BrowserLauncher({}), {}
+        )
+        browser = pool.lease(lambda: (FakeDriver(), FakeProxy()))
+        pool.release(browser, broken=True)
+        self.assertEqual(pool.idle, [])
+        self.assertTrue(browser.driver.quit_called)
+        self.assertTrue(browser.proxy.closed)
+
+    def test_pool_recycles_on_memory(self):
+        pool = harprofiler.BrowserPool(
+            harprofiler.BrowserLauncher({}), {'pool_recycle_memory_mb': 500}
+        )
+        browser = pool.lease(lambda: (FakeDriver(), FakeProxy()))
+        browser.memory = lambda: 400 * 2**20
+        pool.release(browser)
+        self.assertEqual(pool.idle, [browser])
+        browser = pool.lease(lambda: None)
+        browser.memory = lambda: 600 * 2**20
+        pool.release(browser)
+        self.assertEqual(pool.recycled, 1)
+        self.assertEqual(pool.idle, [])
+
+    @unittest.skipUnless(os.path.isdir('/proc'), 'needs /proc')
+    def test_process_tree_rss(self):
+        self.assertIn(os.getpid(), harprofiler.process_tree(os.getpid()))
+        self.assertGreater(harprofiler.process_tree_rss(os.getpid()), 0)
+
+    def test_watchdog_kills_hung_process_tree(self):
+        process = subprocess.Popen(['sleep', '30'])
+        self.addCleanup(harprofiler.kill_process_tree, process.pid)
+        with self.assertRaises(harprofiler.PhaseTimeout) as raised:
+            with harprofiler.watchdog('page_load', 0.1, 'browser',
+                                      process.pid):
+                process.wait()
+        self.assertEqual(raised.exception.killed, 'browser')
+        self.assertEqual(process.returncode, -9)
+
+    def test_watchdog_leaves_quick_phases_alone(self):
+        process = subprocess.Popen(['sleep', '30'])
+        self.addCleanup(harprofiler.kill_process_tree, process.pid)
+        with harprofiler.watchdog('page_load', 0.1, 'browser', process.pid):
+            pass
+        time.sleep(0.2)
+        self.assertIsNone(process.poll())
+
+    def test_main_returns_failures(self):
+        FakeDriver.errors = {
+            'https://www.edx.org/broken':
+                harprofiler.TimeoutException('page load timed out'),
+        }
+        self.addCleanup(setattr, FakeDriver, 'errors', {})
+        original = harprofiler.ProfilerSession._start_server
+        harprofiler.ProfilerSession._start_server = lambda session: setattr(
+            session, 'server', FakeServer()
+        )
+        self.addCleanup(
+            setattr, harprofiler.ProfilerSession, '_start_server', original
+        )
+        config_file = os.path.join(self.test_dir, 'config.yaml')
+        with open(config_file, 'w') as f:
+            yaml.dump(dict(
+                self.config, harstorage_url=None, virtual_display=False,
+                urls=['https://www.edx.org/', 'https://www.edx.org/broken'],
+            ), f)
+        self.assertEqual(harprofiler.main(config_file), 1)
+
+    @unittest.skipUnless(os.path.isdir('/proc'), 'needs /proc')
+    def test_watchdog_kills_hung_browser_launch(self):
+        """
+        A browser launch that hangs has the processes it started killed,
+        and its proxy is closed.
+        """
+        harprofiler.HarProfiler._make_proxied_webdriver = (
+            self.make_proxied_webdriver
+        )
+        launched = []
+
+        def hang(proxy):
+            process = subprocess.Popen(['sleep', '30'])
+            self.addCleanup(harprofiler.kill_process_tree, process.pid)
+            launched.append(process)
+            process.wait()
+
+        self.config['webdriver_startup_timeout'] = 0.1
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.browsers.start = hang
+        profiler = session.profile('https://www.edx.org/')
+
+        self.assertEqual(session.pages, 0)
+        self.assertEqual(profiler.failure['phase'], 'webdriver_startup')
+        self.assertEqual(profiler.failure['killed'], 'browser')
+        self.assertEqual(launched[0].returncode, -9)
+        self.assertTrue(session.server.proxies[0].closed)
+
+    def test_hung_cleanup_is_logged_and_proxy_restarted(self):
+        """
+        A proxy that hangs on closing once the page is saved is killed and
+        restarted, without failing the url.
+        """
+        self.config['har_fetch_timeout'] = 0.5
+        session = harprofiler.ProfilerSession(self.config)
+        old_server = session.server = FakeServer()
+        process = subprocess.Popen(['sleep', '30'])
+        self.addCleanup(harprofiler.kill_process_tree, process.pid)
+        old_server.process = process
+        create_proxy = old_server.create_proxy
+
+        def hanging_proxy(params=None):
+            proxy = create_proxy(params)
+            proxy.close = process.wait
+            return proxy
+
+        old_server.create_proxy = hanging_proxy
+        session._start_server = lambda: setattr(
+            session, 'server', FakeServer()
+        )
+        session.profile('https://www.edx.org/')
+
+        self.assertEqual(session.pages, 1)
+        self.assertEqual(session.failures, [])
+        self.assertEqual(process.returncode, -9)
+        self.assertIsNot(session.server, old_server)
+
+    def test_failed_url_is_recorded(self):
+        """
+        A url that fails is recorded as a failure, and the session goes on
+        with the next one.
+        """
+        FakeDriver.errors = {
+            'https://www.edx.org/broken':
+                harprofiler.TimeoutException('page load timed out'),
+        }
+        self.addCleanup(setattr, FakeDriver, 'errors', {})
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        failed = session.profile('https://www.edx.org/broken')
+        session.profile('https://www.edx.org/')
+
+        self.assertEqual(session.pages, 1)
+        self.assertEqual(session.failures, [failed.failure])
+        self.assertEqual(session.stats()['failed'], 1)
+        self.assertTrue(all(p.closed for p in session.server.proxies))
+        failure = harfiles.load_har(glob.glob(
+            os.path.join(self.test_dir, '*-failure.json')
+        )[0])
+        self.assertEqual(failure['url'], 'https://www.edx.org/broken')
+        self.assertEqual(failure['phase'], 'page_load')
+        self.assertEqual(failure['error'], 'TimeoutException')
+        self.assertTrue(failure['timed_out'])
+        self.assertIn('page load timed out', failure['message'])
+
+    def test_killed_proxy_is_restarted(self):
+        def hang(*args, **kwargs):
+            raise harprofiler.PhaseTimeout('har_fetch', 120, 'proxy')
+
+        original = harprofiler.HarProfiler._save_recording
+        harprofiler.HarProfiler._save_recording = hang
+        self.addCleanup(
+            setattr, harprofiler.HarProfiler, '_save_recording', original
+        )
+        self.config['browser_pool'] = True
+        session = harprofiler.ProfilerSession(self.config)
+        old_server = session.server = FakeServer()
+        session._start_server = lambda: setattr(
+            session, 'server', FakeServer()
+        )
+        profiler = session.profile('https://www.edx.org/')
+
+        self.assertIsNot(session.server, old_server)
+        self.assertEqual(profiler.failure['killed'], 'proxy')
+        self.assertEqual(profiler.failure['phase'], 'har_fetch')
+        self.assertEqual(session.pool.idle, [])
+
+    def test_reload(self):
+        session = harprofiler.ProfilerSession(self.config)
+        login_session = session.login_session
+        self.assertTrue(session.reload(dict(self.config, samples=3)))
+        self.assertEqual(session.config['samples'], 3)
+        self.assertIs(session.login_session, login_session)
+        self.assertTrue(session.reload(dict(self.config, login_user='x')))
+        self.assertEqual(session.login_session.user, 'x')
+        self.assertFalse(session.reload(dict(self.config, browser='chrome')))
+        self.assertFalse(
+            session.reload(dict(self.config, page_load_timeout=10))
+        )
+        self.assertFalse(session.reload(dict(self.config, upload_workers=4)))
+
+    def test_time_saved(self):
+        session = harprofiler.ProfilerSession(self.config)
+        session.startup_time = 2.0
+        session.teardown_time = 1.0
+        session.pages = 5
+        self.assertEqual(session.time_saved(), 12.0)
+
+    def test_teardown_time_is_server_and_display_only(self):
+        """
+        Waiting for queued uploads isn't a per-url cost, so it isn't
+        counted in the time saved.
+        """
+        class SlowPipeline(object):
+            def close(self):
+                time.sleep(0.2)
+
+        session = harprofiler.ProfilerSession(self.config)
+        session.server = FakeServer()
+        session.uploads = SlowPipeline()
+        session.__exit__(None, None, None)
+        self.assertLess(session.teardown_time, 0.1)
+
+
+class HarFilesTest(HarFileTestCase):
+    har = {'log': {'pages': [{'id': u'caf\xe9'}], 'entries': []}}
+
+    def test_formats_round_trip(self):
+        for har_format in harfiles.HAR_FORMATS:
+            path = os.path.join(
+                self.test_dir, 'test' + harfiles.har_extension(har_format)
+            )
+            harfiles.write_har(self.har, path, har_format)
+            self.assertEqual(harfiles.load_har(path), self.har)
+
+    def test_compact_is_smaller(self):
+        pretty = os.path.join(self.test_dir, 'pretty.har')
+        compact = os.path.join(self.test_dir, 'compact.har')
+        harfiles.write_har(self.har, pretty, 'pretty')
+        harfiles.write_har(self.har, compact, 'compact')
+        self.assertLess(
+            os.path.getsize(compact), os.path.getsize(pretty)
+        )
+
+    def test_write_leaves_no_temp_files(self):
+        path = os.path.join(self.test_dir, 'test.har')
+        harfiles.write_har(self.har, path)
+        self.assertEqual(os.listdir(self.test_dir), ['test.har'])
+
+    def test_unknown_format(self):
+        path = os.path.join(self.test_dir, 'test.har')
+        with self.assertRaises(ValueError):
+            harfiles.write_har(self.har, path, 'xml')
+        self.assertEqual(os.listdir(self.test_dir), [])
+
+    def test_stream_har(self):
+        har = benchmark.synthetic_har('bench', resources=3)
+        har['log']['entries'][0]['response']['content']['text'] = (
+            u'caf\xe9 ' * 100
+        )
+        data = json.dumps(har, ensure_ascii=False).encode('utf-8')
+
+        def patch_pages(pages):
+            pages[0]['pageTimings']['onLoad'] = 750
+
+        for har_format in ('compact', 'gzip'):
+            path = os.path.join(
+                self.test_dir, 'test' + harfiles.har_extension(har_format)
+            )
+            # chunks that split values, and multibyte characters
+            chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+            outline = harfiles.stream_har(
+                chunks, path, har_format, patch_pages
+            )
+            saved = harfiles.load_har(path)
+            self.assertEqual(saved['log']['entries'], har['log']['entries'])
+            self.assertEqual(
+                saved['log']['pages'][0]['pageTimings']['onLoad'], 750
+            )
+            self.assertEqual(
+                harstats.har_metrics(outline), harstats.har_metrics(saved)
+            )
+
+    def test_har_size(self):
+        for har_format in harfiles.HAR_FORMATS:
+            path = os.path.join(
+                self.test_dir, 'test' + harfiles.har_extension(har_format)
+            )
+            harfiles.write_har(self.har, path, har_format)
+            with harfiles.open_har(path) as f:
+                size = len(f.read())
+            self.assertEqual(harfiles.har_size(path), size)
+
+        # too big to trust the gzip trailer, so it is counted
+        original = harfiles.GZIP_ISIZE_SAFE
+        harfiles.GZIP_ISIZE_SAFE = 0
+        self.addCleanup(setattr, harfiles, 'GZIP_ISIZE_SAFE', original)
+        self.assertEqual(harfiles.har_size(path), size)
+
+    def test_stream_truncated_har(self):
+        data = json.dumps(benchmark.synthetic_har('bench', resources=3))
+        path = os.path.join(self.test_dir, 'test.har')
+        with self.assertRaises(ValueError):
+            harfiles.stream_har([data[:len(data) // 2]], path)
+        with self.assertRaises(ValueError):
+            harfiles.stream_har([data], path, 'pretty')
+        self.assertEqual(os.listdir(self.test_dir), [])
+
+    def test_profiler_gzip_names(self):
+        self.config['har_format'] = 'gzip'
+        profiler = harprofiler.HarProfiler(self.config, 'https://edx.org')
+        self.assertTrue(profiler.har_name.endswith('.har.gz'))
+        self.assertTrue(profiler.cached_har_name.endswith('.har.gz'))
+
+    def test_digest_ignores_compression(self):
+        plain = os.path.join(self.test_dir, 'a.har')
+        gzipped = os.path.join(self.test_dir, 'a.har.gz')
+        harfiles.write_har(self.har, plain, 'compact')
+        harfiles.write_har(self.har, gzipped, 'gzip')
+        self.assertEqual(
+            harfiles.har_digest(plain), harfiles.har_digest(gzipped)
+        )
+
+    def test_is_har_file(self):
+        self.assertTrue(harfiles.is_har_file('a.har'))
+        self.assertTrue(harfiles.is_har_file('a.har.gz'))
+        self.assertFalse(harfiles.is_har_file('.a.tmp'))
+
+
+def make_entry(url, mime, time, body_size, pageref=None):
+    entry = {
+        'request': {'url': url},
+        'response': {
+            'headersSize': 100,
+            'bodySize': body_size,
+            'content': {'mimeType': mime},
+        },
+        'time': time,
+        'timings': {
+            'dns': -1, 'connect': -1, 'ssl': -1,
+            'send': 1, 'wait': time - 2, 'receive': 1,
+        },
+    }
+    if pageref is not None:
+        entry['pageref'] = pageref
+    return entry
+
+
+def make_har(label, entries, on_load=500, on_content_load=200):
+    return {'log': {
+        'pages': [{
+            'id': label,
+            'pageTimings': {
+                'onLoad': on_load, 'onContentLoad': on_content_load,
+            },
+        }],
+        'entries': entries,
+    }}
+
+
+class AnalyzeTest(HarFileTestCase):
+    def setUp(self):
+        super(AnalyzeTest, self).setUp()
+        for i in range(3):
+            har = make_har('home', [
+                make_entry('https://www.edx.org/', 'text/html', 100, 900),
+                make_entry('https://cdn.edx.org/app.js',
+                           'application/javascript; charset=utf-8',
+                           200 + i, 1900),
+            ])
+            harfiles.write_har(
+                har, os.path.join(self.test_dir, 'home-{}.har'.format(i))
+            )
+        har = make_har('search', [
+            make_entry('https://www.edx.org/search', 'text/html', 50, 400),
+        ])
+        harfiles.write_har(
+            har, os.path.join(self.test_dir, 'search.har.gz'), 'gzip'
+        )
+        with open(os.path.join(self.test_dir, 'broken.har'), 'w') as f:
+            f.write('not json')
+
+    def test_load_with_process_pool(self):
+        table = haranalyze.HarTable.load(
+            [self.test_dir], processes=2, batch_size=2
+        )
+        self.assertEqual(len(table), 7)
+
+    def test_phase_breakdown(self):
+        table = haranalyze.HarTable.load([self.test_dir], processes=1)
+        rows = dict(
+            (row['label'], row) for row in table.phase_breakdown('label')
+        )
+        self.assertEqual(rows['home']['requests'], 6)
+        self.assertEqual(rows['home']['dns'], 0)
+        self.assertEqual(rows['home']['time'], 150.5)
+        self.assertEqual(rows['search']['wait'], 48)
+
+    def test_bytes_by_mime(self):
+        table = haranalyze.HarTable.load([self.test_dir], processes=1)
+        by_host = table.bytes_by_mime('host')
+        self.assertEqual(by_host['cdn.edx.org'], {
+            'application/javascript': 6000
+        })
+        self.assertEqual(by_host['www.edx.org'], {'text/html': 3500})
+
+    def test_slowest(self):
+        table = haranalyze.HarTable.load([self.test_dir], processes=1)
+        slowest = table.slowest(2)
+        self.assertEqual([row['time'] for row in slowest], [202, 201])
+
+
+class CatalogTest(HarFileTestCase):
+    def setUp(self):
+        super(CatalogTest, self).setUp()
+        self.catalog = harcatalog.Catalog(
+            os.path.join(self.test_dir, 'catalog.sqlite')
+        )
+        self.addCleanup(self.catalog.close)
+        self.har_path = os.path.join(
+            self.test_dir, 'home-1414436400.500000-w1-s0.har'
+        )
+        harfiles.write_har(make_har('home', [
+            make_entry('https://www.edx.org/', 'text/html', 100, 900),
+        ]), self.har_path)
+        cached_path = os.path.join(
+            self.test_dir, 'home-cached-1414436400.500000.har.gz'
+        )
+        harfiles.write_har(
+            make_har('home-cached', []), cached_path, 'gzip'
+        )
+
+    def test_parse_har_name(self):
+        self.assertEqual(
+            harcatalog.parse_har_name('a-2881-b-1414436400.5-w1.har'),
+            ('a-2881-b', 1414436400.5)
+        )
+        self.assertEqual(
+            harcatalog.parse_har_name('a-1414436400.har.gz'),
+            ('a', 1414436400)
+        )
+        self.assertEqual(harcatalog.parse_har_name('a.har'), (None, None))
+
+    def test_rebuild_is_incremental(self):
+        self.assertEqual(self.catalog.rebuild([self.test_dir]), (2, 0))
+        self.assertEqual(self.catalog.rebuild([self.test_dir]), (0, 2))
+        os.utime(self.har_path, (0, 0))
+        self.assertEqual(self.catalog.rebuild([self.test_dir]), (1, 1))
+
+    def test_query(self):
+        self.catalog.rebuild([self.test_dir])
+        rows = self.catalog.query(label='home')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['url'], 'https://www.edx.org/')
+        self.assertEqual(rows[0]['epoch'], 1414436400.5)
+        self.assertEqual(rows[0]['on_load'], 500)
+        self.assertEqual(rows[0]['entries'], 1)
+        self.assertEqual(rows[0]['total_bytes'], 1000)
+        self.assertEqual(rows[0]['upload_status'], 'pending')
+        self.assertEqual(len(self.catalog.query(cached=True)), 1)
+        self.assertEqual(self.catalog.query(since=1414436401), [])
+
+    def test_uploader_records_status(self):
+        self.catalog.rebuild([self.test_dir])
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            return {
+                'status_code': 200,
+                'content': 'Successful'
+            }
+
+        with HTTMock(harstorage_mock_success):
+            uploader = haruploader.Uploader(
+                self.har_path, 'http://edx.mockharstorage.com',
+                catalog=self.catalog
+            )
+            uploader.upload_hars()
+
+        row = self.catalog.query(label='home')[0]
+        self.assertEqual(row['upload_status'], 'success')
+        self.assertEqual(row['path'], os.path.join(
+            os.path.abspath(self.test_dir), 'completed_uploads',
+            os.path.basename(self.har_path)
+        ))
+        # moving files doesn't make the next rebuild re-index them
+        self.assertEqual(self.catalog.rebuild([self.test_dir]), (0, 2))
+
+
+class CompareTest(HarFileTestCase):
+    budget = {'absolute': 50, 'relative': 0.1}
+
+    def test_clear_regression(self):
+        result = harcompare.compare_metric(
+            [500, 510, 490, 505, 495], [700, 710, 690, 705, 695], self.budget
+        )
+        self.assertEqual(result['status'], 'regression')
+        self.assertEqual(result['delta'], 200)
+        self.assertLess(result['p_value'], 0.05)
+
+    def test_noise_is_not_a_regression(self):
+        # the median moves over budget, but the samples overlap too much
+        # for the difference to be significant
+        result = harcompare.compare_metric(
+            [400, 900, 450, 800, 500], [420, 910, 600, 850, 480], self.budget
+        )
+        self.assertEqual(result['status'], 'ok')
+        self.assertGreater(result['p_value'], 0.05)
+
+    def test_within_budget(self):
+        result = harcompare.compare_metric(
+            [500, 510, 490], [540, 545, 530], self.budget
+        )
+        self.assertEqual(result['status'], 'ok')
+
+    def test_single_samples_use_budget_only(self):
+        result = harcompare.compare_metric([500], [600], self.budget)
+        self.assertEqual(result['status'], 'regression')
+        self.assertIsNone(result['p_value'])
+
+    def test_improvement(self):
+        result = harcompare.compare_metric([500], [300], self.budget)
+        self.assertEqual(result['status'], 'improvement')
+
+    def test_compare_runs(self):
+        baseline_dir = os.path.join(self.test_dir, 'baseline')
+        current_dir = os.path.join(self.test_dir, 'current')
+        os.makedirs(baseline_dir)
+        os.makedirs(current_dir)
+        entry = make_entry('https://www.edx.org/', 'text/html', 100, 900)
+        for i in range(3):
+            harfiles.write_har(
+                make_har('home', [entry], on_load=500 + i),
+                os.path.join(baseline_dir, 'home-{}.har'.format(i))
+            )
+            harfiles.write_har(
+                make_har('home', [entry, entry], on_load=900 + i),
+                os.path.join(current_dir, 'home-{}.har'.format(i))
+            )
+            harfiles.write_har(
+                make_har('home-cached', [entry], on_load=100),
+                os.path.join(current_dir, 'home-cached-{}.har'.format(i))
+            )
+        baseline_file = os.path.join(self.test_dir, 'baseline.json')
+        harcompare.save_baseline(
+            harcompare.collect([baseline_dir]), baseline_file
+        )
+
+        results = harcompare.compare(
+            harcompare.load_baseline(baseline_file),
+            harcompare.collect([current_dir]),
+            {'bytes': {'absolute': 5000}}
+        )
+        statuses = dict(
+            ((r['label'], r['metric']), r['status']) for r in results
+        )
+        self.assertEqual(statuses[('home', 'onLoad')], 'regression')
+        self.assertEqual(statuses[('home', 'onContentLoad')], 'ok')
+        self.assertEqual(statuses[('home', 'requests')], 'ok')
+        self.assertEqual(statuses[('home', 'bytes')], 'ok')
+        self.assertEqual(statuses[('home-cached', 'onLoad')], 'new')
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = harmetrics.Metrics()
+
+    def test_timer(self):
+        with self.metrics.timer('page_load'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('page_load'):
+                raise ValueError()
+        stats = self.metrics.snapshot()['page_load']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['errors'], 1)
+
+    def test_merge(self):
+        self.metrics.record('login', 2.0)
+        other = harmetrics.Metrics()
+        other.record('login', 3.0, error=True)
+        other.record('upload', 1.0)
+        self.metrics.merge(other.snapshot())
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['login'], {
+            'count': 2, 'sum': 5.0, 'max': 3.0, 'errors': 1
+        })
+        self.assertEqual(snapshot['upload']['count'], 1)
+
+    def test_prometheus(self):
+        self.metrics.record('har_save', 0.5)
+        self.metrics.record('har_save', 1.5)
+        text = self.metrics.prometheus()
+        self.assertIn('# TYPE harprofiler_phase_seconds summary', text)
+        self.assertIn(
+            'harprofiler_phase_seconds_sum{phase="har_save"} 2.000000', text
+        )
+        self.assertIn(
+            'harprofiler_phase_seconds_count{phase="har_save"} 2', text
+        )
+        self.assertIn(
+            'harprofiler_phase_seconds_max{phase="har_save"} 1.500000', text
+        )
+        self.assertIn(
+            'harprofiler_phase_errors_total{phase="har_save"} 0', text
+        )
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        self.metrics.configure({
+            'statsd_host': '127.0.0.1',
+            'statsd_port': server.getsockname()[1],
+        })
+        self.metrics.record('upload', 0.25, error=True)
+        self.assertEqual(server.recv(1024), 'harprofiler.upload:250.000|ms')
+        self.assertEqual(server.recv(1024), 'harprofiler.upload.errors:1|c')
+
+
+class BlobStoreTest(HarFileTestCase):
+    def setUp(self):
+        super(BlobStoreTest, self).setUp()
+        self.store = harblobs.BlobStore(
+            os.path.join(self.test_dir, 'blobs'), min_size=10
+        )
+
+    def make_har(self, *bodies):
+        return {'log': {'pages': [], 'entries': [
+            {'response': {'content': {'text': body, 'size': len(body)}}}
+            for body in bodies
+        ]}}
+
+    def test_round_trip(self):
+        bundle = u'var caf\xe9 = 1;' * 100
+        har = self.make_har(bundle, u'tiny', bundle)
+        original = json.loads(json.dumps(har))
+        self.assertEqual(self.store.dehydrate(har), 2 * len(bundle))
+        contents = [e['response']['content'] for e in har['log']['entries']]
+        self.assertNotIn('text', contents[0])
+        self.assertEqual(contents[0]['_blob'], contents[2]['_blob'])
+        self.assertEqual(contents[1]['text'], u'tiny')
+        blobs = glob.glob(os.path.join(self.test_dir, 'blobs', '*', '*.gz'))
+        self.assertEqual(len(blobs), 1)
+
+        self.assertEqual(self.store.rehydrate(har), 2)
+        self.assertEqual(har, original)
+
+    def test_profiler_stores_bodies(self):
+        self.config['blob_dir'] = os.path.join(self.test_dir, 'blobs')
+        profiler = harprofiler.HarProfiler(self.config, 'https://edx.org')
+        profiler._save_har(self.make_har(u'x' * 1000))
+        har = harfiles.load_har(
+            os.path.join(self.test_dir, profiler.har_name)
+        )
+        content = har['log']['entries'][0]['response']['content']
+        self.assertNotIn('text', content)
+        self.assertTrue(content['_blob'].startswith('sha256:'))
+
+    def test_uploader_rehydrates(self):
+        har_path = os.path.join(self.test_dir, 'page-1.har')
+        har = self.make_har(u'x' * 1000)
+        self.store.dehydrate(har)
+        harfiles.write_har(har, har_path)
+        bodies = []
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(url, request):
+            bodies.append(request.body.read())
+            return {'status_code': 200, 'content': 'Successful'}
+
+        with HTTMock(harstorage_mock_success):
+            haruploader.Uploader(
+                har_path, 'http://localhost:5000', stream=True,
+                blobs=self.store
+            ).upload_hars()
+        self.assertIn('x' * 1000, bodies[0])
+        self.assertNotIn('_blob', bodies[0])
+        # the stored copy keeps the reference
+        self.assertIn('_blob', open(os.path.join(
+            self.test_dir, 'completed_uploads', 'page-1.har'
+        )).read())
+
+
+class BenchmarkTest(HarFileTestCase):
+    def test_fixture_site(self):
+        site = benchmark.start_fixture_site(resources=3, resource_size=100)
+        self.addCleanup(site.server_close)
+        self.addCleanup(site.shutdown)
+        page = requests.get(site.url + '/page/1').text
+        self.assertEqual(page.count('<script src="/static/1/'), 3)
+        script = requests.get(site.url + '/static/1/0.js')
+        self.assertEqual(len(script.content), 100)
+
+    def test_har_write(self):
+        results = benchmark.bench_har_write(self.test_dir, 2, 5, 100)
+        self.assertEqual(sorted(results), sorted(harfiles.HAR_FORMATS))
+        self.assertLess(results['gzip']['bytes'], results['pretty']['bytes'])
+        self.assertEqual(os.listdir(self.test_dir), [])
+
+    def test_upload(self):
+        results = benchmark.bench_upload(self.test_dir, 3, 5, 100)
+        self.assertEqual(
+            sorted(results), sorted(mode for mode, _ in benchmark.UPLOAD_MODES)
+        )
+        for mode in results:
+            self.assertEqual(results[mode]['uploads'], 3)
+        self.assertLess(
+            results['gzip']['bytes_sent'], results['stream']['bytes_sent']
+        )
+
+
+SITEMAP = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url><loc>https://www.edx.org/course/a</loc><priority>1</priority></url>
+  <url><loc> https://www.edx.org/course/b </loc></url>
+</urlset>
+"""
+
+SITEMAP_INDEX = """<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>{}</loc></sitemap>
+</sitemapindex>
+"""
+
+
+class SourcesTest(HarFileTestCase):
+    def write(self, name, text):
+        path = os.path.join(self.test_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_url_file(self):
+        path = self.write('urls.txt', '\n'.join([
+            '# course pages',
+            'https://www.edx.org/course/a',
+            '',
+            '["https://courses.edx.org/dashboard", true]',
+            '{"url": "https://www.edx.org/course/b", "samples": 3}',
+        ]))
+        self.assertEqual(list(harsources.read_url_file(path)), [
+            'https://www.edx.org/course/a',
+            ['https://courses.edx.org/dashboard', True],
+            {'url': 'https://www.edx.org/course/b', 'samples': 3},
+        ])
+
+    def test_sitemap_index(self):
+        child = os.path.join(self.test_dir, 'courses.xml.gz')
+        with gzip.open(child, 'wb') as f:
+            f.write(SITEMAP)
+        index = self.write('sitemap.xml', SITEMAP_INDEX.format(child))
+        self.assertEqual(list(harsources.read_sitemap(index)), [
+            'https://www.edx.org/course/a', 'https://www.edx.org/course/b',
+        ])
+
+    def test_gunzip_stream(self):
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(SITEMAP)
+        stream = harsources.GunzipStream(StringIO(buf.getvalue()))
+        self.assertEqual(
+            ''.join(iter(lambda: stream.read(10), '')), SITEMAP
+        )
+
+    def test_course_ids(self):
+        path = self.write('courses.txt', '\n'.join([
+            'course-v1:edX+DemoX+Demo_Course',
+            'course-v1:MITx+6.002x+2013_Spring',
+            'course-v1:edX+CS50+2015',
+        ]))
+        urls = list(harsources.read_source({
+            'course_ids': path,
+            'match': 'course-v1:edX+*',
+            'url_template': 'https://courses.edx.org/courses/{course_id}/',
+            'login_first': True,
+        }))
+        self.assertEqual(urls, [
+            {'url': 'https://courses.edx.org/courses/'
+                    'course-v1:edX+DemoX+Demo_Course/', 'login_first': True},
+            {'url': 'https://courses.edx.org/courses/'
+                    'course-v1:edX+CS50+2015/', 'login_first': True},
+        ])
+
+    def test_shards_are_stable_and_disjoint(self):
+        urls = ['https://www.edx.org/course/{}'.format(i) for i in range(8)]
+        self.assertEqual(
+            [harsources.shard_of(url, 4) for url in urls],
+            [3, 1, 3, 3, 2, 3, 0, 0]
+        )
+        self.config['urls'] = urls[:4]
+        self.config['url_sources'] = [
+            {'file': self.write('urls.txt', '\n'.join(urls[4:]))}
+        ]
+        shards = []
+        for index in range(3):
+            self.config.update({'shard_index': index, 'shard_count': 3})
+            shards.append(list(harprofiler.select_urls(self.config)))
+        self.assertEqual(sorted(sum(shards, [])), sorted(urls))
+        self.config['shard_index'] = 3
+        with self.assertRaises(ValueError):
+            list(harprofiler.select_urls(self.config))
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.scheduler = harscheduler.Scheduler(
+            interval=100, jitter=0.1, clock=lambda: self.now
+        )
+
+    def test_intervals_with_jitter(self):
+        self.scheduler.update([
+            ('https://a', False, {}),
+            ('https://b', False, {'interval': 1000}),
+        ])
+        self.assertLessEqual(self.scheduler.wait_time(), 10)
+        self.now += 100
+        due = sorted([self.scheduler.pop(), self.scheduler.pop()])
+        self.assertEqual(due, [
+            ('https://a', False, {}), ('https://b', False, {})
+        ])
+        self.assertIsNone(self.scheduler.pop())
+        self.assertTrue(90 <= self.scheduler.wait_time() <= 110)
+        self.now += 110
+        self.assertEqual(self.scheduler.pop()[0], 'https://a')
+        self.assertIsNone(self.scheduler.pop())
+        self.now += 1000
+        self.assertEqual(
+            sorted(job[0] for job in [
+                self.scheduler.pop(), self.scheduler.pop()
+            ]),
+            ['https://a', 'https://b']
+        )
+
+    def test_update_keeps_schedule(self):
+        job = ('https://a', False, {})
+        self.scheduler.update([job])
+        self.now += 10
+        self.scheduler.pop()
+        key = harscheduler.job_key(job)
+        due = self.scheduler.jobs[key][2]
+        self.scheduler.update([job, ('https://b', True, {})])
+        self.assertEqual(len(self.scheduler.jobs), 2)
+        self.assertEqual(self.scheduler.jobs[key][2], due)
+        self.now += 10
+        self.assertEqual(self.scheduler.pop()[0], 'https://b')
+
+    def test_empty(self):
+        self.scheduler.update([])
+        self.assertIsNone(self.scheduler.wait_time())
+        self.assertIsNone(self.scheduler.pop())
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(harstats.percentile(values, 50), 3)
+        self.assertEqual(harstats.percentile(values, 90), 4.6)
+        self.assertEqual(harstats.percentile(values, 100), 5)
+        self.assertIsNone(harstats.percentile([], 50))
+
+    def test_summarize(self):
+        summary = harstats.summarize([2, 4, 4, 4, 5, 5, 7, 9, None])
+        self.assertEqual(summary['count'], 8)
+        self.assertEqual(summary['mean'], 5)
+        self.assertEqual(summary['median'], 4.5)
+        self.assertAlmostEqual(summary['stddev'], 2.138, places=3)
+
+    def test_mann_whitney_u(self):
+        p = harstats.mann_whitney_u([1, 2, 3, 4, 5], [6, 7, 8, 9, 10])
+        self.assertLess(p, 0.01)
+        p = harstats.mann_whitney_u([6, 7, 8, 9, 10], [1, 2, 3, 4, 5])
+        self.assertGreater(p, 0.99)
+        self.assertEqual(harstats.mann_whitney_u([3, 3], [3, 3]), 1.0)
+        self.assertIsNone(harstats.mann_whitney_u([], [1]))
+
+    def test_summarize_single_value(self):
+        summary = harstats.summarize([7])
+        self.assertEqual(summary['stddev'], 0)
+        self.assertEqual(summary['p95'], 7)
+
+
 class StorageTest(HarFileTestCase):
     """
     Tests to confirm that the response handling for sending to harstorage works
@@ -141,6 +1751,183 @@ class StorageTest(HarFileTestCase):
 
         self.assertTrue(os.path.isfile(expected_file))
 
+    def test_success_single_file(self):
+        """
+        A path to a single har file is uploaded on its own.
+        """
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            return {
+                'status_code': 200,
+                'content': 'Successful'
+            }
+
+        with HTTMock(harstorage_mock_success):
+            uploader = haruploader.Uploader(self.test_file, self.url)
+            uploader.upload_hars()
+
+        expected_file = os.path.join(
+            self.test_dir,
+            'completed_uploads',
+            os.path.basename(self.test_file)
+        )
+
+        self.assertTrue(os.path.isfile(expected_file))
+
+    def test_success_concurrent(self):
+        """
+        With several workers, every file still ends up in the
+        'completed_uploads' folder.
+        """
+        for _ in range(9):
+            path = os.path.join(self.test_dir, str(uuid.uuid4()) + '.har')
+            with open(path, 'w') as f:
+                f.write("I'm a fake har file")
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            return {
+                'status_code': 200,
+                'content': 'Successful'
+            }
+
+        with HTTMock(harstorage_mock_success):
+            uploader = haruploader.Uploader(self.test_dir, self.url, 4)
+            uploader.upload_hars()
+
+        completed = glob.glob(
+            os.path.join(self.test_dir, 'completed_uploads', '*.har')
+        )
+        self.assertEqual(len(completed), 10)
+        self.assertEqual(
+            glob.glob(os.path.join(self.test_dir, '*.har')), []
+        )
+
+    def test_success_streaming(self):
+        """
+        Streamed uploads send the file as a multipart `file` field with a
+        Content-Length.
+        """
+        bodies = []
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(url, request):
+            bodies.append((request.headers, request.body.read()))
+            return {
+                'status_code': 200,
+                'content': 'Successful'
+            }
+
+        with HTTMock(harstorage_mock_success):
+            uploader = haruploader.Uploader(self.test_dir, self.url,
+                                            stream=True)
+            uploader.upload_hars()
+
+        headers, body = bodies[0]
+        self.assertTrue(
+            headers['Content-type'].startswith('multipart/form-data')
+        )
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertIn('name="file"', body)
+        self.assertIn("I'm a fake har file", body)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir,
+            'completed_uploads',
+            os.path.basename(self.test_file)
+        )))
+
+    def test_success_streaming_gzip(self):
+        """
+        Compressed uploads gzip the whole multipart body.
+        """
+        bodies = []
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(url, request):
+            bodies.append((request.headers, ''.join(request.body)))
+            return {
+                'status_code': 200,
+                'content': 'Successful'
+            }
+
+        with HTTMock(harstorage_mock_success):
+            uploader = haruploader.Uploader(self.test_dir, self.url,
+                                            compress=True)
+            uploader.upload_hars()
+
+        headers, body = bodies[0]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self.assertIn("I'm a fake har file", body)
+
+    def test_success_gzip_file(self):
+        """
+        Gzipped har files are decompressed before they are uploaded.
+        """
+        gz_file = os.path.join(self.test_dir, str(uuid.uuid4()) + '.har.gz')
+        with gzip.open(gz_file, 'wb') as f:
+            f.write("I'm a gzipped fake har file")
+        bodies = []
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(url, request):
+            bodies.append(request.body.read())
+            return {
+                'status_code': 200,
+                'content': 'Successful'
+            }
+
+        with HTTMock(harstorage_mock_success):
+            uploader = haruploader.Uploader(gz_file, self.url, stream=True)
+            uploader.upload_hars()
+
+        self.assertIn("I'm a gzipped fake har file", bodies[0])
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'completed_uploads', os.path.basename(gz_file)
+        )))
+
+    def test_streamed_gzip_file_reaches_wsgi_server(self):
+        """
+        A gzipped HAR is streamed with a Content-Length, so a WSGI server,
+        which doesn't decode chunked bodies, gets the whole file.
+        """
+        har = {'log': {'entries': [
+            {'request': {'url': 'https://www.edx.org/{}'.format(i)}}
+            for i in range(20000)
+        ]}}
+        gz_file = os.path.join(self.test_dir, 'big.har.gz')
+        harfiles.write_har(har, gz_file, 'gzip')
+        received = []
+
+        def app(environ, start_response):
+            received.append(environ.get('HTTP_TRANSFER_ENCODING'))
+            form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+            received.append(json.loads(form['file'].value))
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['Successful']
+
+        class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = wsgiref.simple_server.make_server(
+            '127.0.0.1', 0, app, handler_class=QuietHandler
+        )
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        haruploader.Uploader(
+            gz_file, 'http://127.0.0.1:{}'.format(server.server_port),
+            stream=True
+        ).upload_hars()
+        thread.join()
+
+        self.assertEqual(received, [None, har])
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'completed_uploads', 'big.har.gz'
+        )))
+
     def test_failure_bad_file(self):
         """
         If a file fails to be sent to harstorage because it is malformed,
@@ -214,6 +2001,231 @@ class StorageTest(HarFileTestCase):
 
         self.assertTrue(os.path.isfile(self.test_file))
 
+    def make_spool(self, **kwargs):
+        self.now = 1000.0
+        spool = harspool.Spool(
+            os.path.join(self.test_dir, 'spool.sqlite'),
+            clock=lambda: self.now, **kwargs
+        )
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_spool_backs_off(self):
+        """
+        With a spool, a file that failed to upload isn't retried until its
+        backoff has passed.
+        """
+        posts = []
+
+        @urlmatch(method='post')
+        def harstorage_mock_server_error(*args, **kwargs):
+            posts.append(1)
+            return {'status_code': 503, 'content': 'Unavailable'}
+
+        spool = self.make_spool(retry_delay=60)
+        uploader = haruploader.Uploader(self.test_dir, self.url, spool=spool)
+        with HTTMock(harstorage_mock_server_error):
+            uploader.upload_hars()
+            row = spool.get(self.test_file)
+            self.assertEqual(row['attempts'], 1)
+            self.assertTrue(1030 <= row['next_retry'] <= 1060)
+            self.assertIn('503', row['last_error'])
+
+            uploader.upload_hars()
+            self.assertEqual(len(posts), 1)
+
+            self.now += 60
+            uploader.upload_hars()
+            self.assertEqual(len(posts), 2)
+            row = spool.get(self.test_file)
+            self.assertEqual(row['attempts'], 2)
+            self.assertTrue(1120 <= row['next_retry'] <= 1180)
+        self.assertTrue(os.path.isfile(self.test_file))
+
+    def test_spool_gives_up(self):
+        """
+        After the spool's maximum attempts, the file is put in the failed
+        folder.
+        """
+        @urlmatch(method='post')
+        def harstorage_mock_bad_connection(*args, **kwargs):
+            raise requests.exceptions.ConnectionError('ConnectionError')
+
+        spool = self.make_spool(max_attempts=3)
+        uploader = haruploader.Uploader(self.test_dir, self.url, spool=spool)
+        with HTTMock(harstorage_mock_bad_connection):
+            for _ in range(3):
+                uploader.upload_hars()
+                self.now += harspool.DEFAULT_MAX_RETRY_DELAY
+
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'failed_uploads', os.path.basename(self.test_file)
+        )))
+        self.assertIsNone(spool.get(self.test_file))
+
+    def test_spool_cleared_on_success(self):
+        spool = self.make_spool()
+        spool.failed(self.test_file, 'ConnectionError')
+        self.now += harspool.DEFAULT_MAX_RETRY_DELAY
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            return {'status_code': 200, 'content': 'Successful'}
+
+        with HTTMock(harstorage_mock_success):
+            haruploader.Uploader(
+                self.test_dir, self.url, spool=spool
+            ).upload_hars()
+        self.assertIsNone(spool.get(self.test_file))
+
+    def test_spool_backoff_is_capped(self):
+        spool = self.make_spool(retry_delay=10, max_retry_delay=100)
+        self.assertTrue(5 <= spool.backoff(1) <= 10)
+        self.assertTrue(20 <= spool.backoff(3) <= 40)
+        self.assertTrue(50 <= spool.backoff(20) <= 100)
+
+    def test_ledger_skips_duplicates(self):
+        """
+        Content the spool's ledger has a record of uploading isn't posted
+        again, whatever the file is called.
+        """
+        posts = []
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            posts.append(1)
+            return {'status_code': 200, 'content': 'Successful'}
+
+        spool = self.make_spool()
+        with HTTMock(harstorage_mock_success):
+            haruploader.Uploader(
+                self.test_dir, self.url, spool=spool
+            ).upload_hars()
+            copy = os.path.join(self.test_dir, 'copy.har')
+            shutil.copy(os.path.join(
+                self.test_dir, 'completed_uploads',
+                os.path.basename(self.test_file)
+            ), copy)
+            haruploader.Uploader(
+                self.test_dir, self.url, spool=spool
+            ).upload_hars()
+
+        self.assertEqual(len(posts), 1)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'completed_uploads', 'copy.har'
+        )))
+
+    def test_corrupt_har_fails_alone(self):
+        """
+        With a spool, a HAR that can't be hashed is put in the failed folder
+        and the rest of the directory is still uploaded.
+        """
+        corrupt = os.path.join(self.test_dir, 'corrupt.har.gz')
+        with open(corrupt, 'w') as f:
+            f.write('not gzip')
+
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            return {'status_code': 200, 'content': 'Successful'}
+
+        uploader = haruploader.Uploader(
+            self.test_dir, self.url, spool=self.make_spool()
+        )
+        with HTTMock(harstorage_mock_success):
+            uploader.upload_hars()
+
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'failed_uploads', 'corrupt.har.gz'
+        )))
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'completed_uploads',
+            os.path.basename(self.test_file)
+        )))
+
+    def test_reconcile(self):
+        """
+        Reconciling adds the files already in completed_uploads to the
+        ledger.
+        """
+        completed = os.path.join(self.test_dir, 'completed_uploads')
+        os.makedirs(completed)
+        shutil.copy(self.test_file, completed)
+        spool = self.make_spool()
+        uploader = haruploader.Uploader(self.test_dir, self.url, spool=spool)
+        self.assertEqual(uploader.reconcile(), (1, 0))
+        self.assertEqual(uploader.reconcile(), (0, 1))
+
+        @urlmatch(method='post')
+        def harstorage_mock_unreachable(*args, **kwargs):
+            raise AssertionError('should not upload')
+
+        with HTTMock(harstorage_mock_unreachable):
+            uploader.upload_hars()
+        self.assertFalse(os.path.isfile(self.test_file))
+
+    def test_pipeline(self):
+        """
+        Files submitted to the pipeline are uploaded in the background, and
+        closing it waits for them.
+        """
+        @urlmatch(method='post')
+        def harstorage_mock_success(*args, **kwargs):
+            return {'status_code': 200, 'content': 'Successful'}
+
+        with HTTMock(harstorage_mock_success):
+            pipeline = haruploader.UploadPipeline(
+                haruploader.Uploader(self.test_dir, self.url, workers=2)
+            )
+            pipeline.submit(self.test_file)
+            pipeline.close()
+
+        self.assertEqual(pipeline.results[0], 1)
+        self.assertEqual(pipeline.pending, set())
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.test_dir, 'completed_uploads',
+            os.path.basename(self.test_file)
+        )))
+
+    def test_watch_skips_files_being_written(self):
+        """
+        Polling only submits a file once it is unchanged since the previous
+        poll.
+        """
+        pipeline = haruploader.UploadPipeline(
+            haruploader.Uploader(self.test_dir, self.url)
+        )
+        self.addCleanup(pipeline.close)
+        submitted = []
+        pipeline.submit = submitted.append
+
+        seen = pipeline.poll({})
+        self.assertEqual(submitted, [])
+        with open(self.test_file, 'a') as f:
+            f.write(' and then some')
+        seen = pipeline.poll(seen)
+        self.assertEqual(submitted, [])
+        pipeline.poll(seen)
+        self.assertEqual(submitted, [os.path.realpath(self.test_file)])
+
+    def test_watch_waits_for_retries(self):
+        """
+        Files waiting for their next retry aren't submitted.
+        """
+        spool = self.make_spool()
+        spool.failed(self.test_file, 'ConnectionError')
+        pipeline = haruploader.UploadPipeline(
+            haruploader.Uploader(self.test_dir, self.url, spool=spool)
+        )
+        self.addCleanup(pipeline.close)
+        submitted = []
+        pipeline.submit = submitted.append
+
+        pipeline.poll(pipeline.poll({}))
+        self.assertEqual(submitted, [])
+        self.now += harspool.DEFAULT_MAX_RETRY_DELAY
+        pipeline.poll(pipeline.poll({}))
+        self.assertEqual(submitted, [os.path.realpath(self.test_file)])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)